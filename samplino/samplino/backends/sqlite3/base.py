@@ -0,0 +1,17 @@
+""" sqlite3 database backend of samplino, django's own with write transactions which wait for each other """
+from django.db.backends.sqlite3 import base
+
+__all__ = ["DatabaseWrapper"]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    starts transactions with BEGIN IMMEDIATE instead of a deferred BEGIN (django 5.0 has no "transaction_mode"
+    option). a deferred transaction takes the write lock at its first write, one which read before that can not wait
+    for the lock (its snapshot may be stale by then) and fails with "database is locked" at once, whatever
+    busy_timeout is. taking the lock at BEGIN makes every transaction (update_or_create, claims of confirm_code,
+    escalate_ban) queue for up to busy_timeout instead. autocommit statements outside transactions are not affected
+    """
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
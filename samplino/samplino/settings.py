@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import datetime
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'users.middleware.InstrumentationMiddleware',
+    'users.middleware.RateLimitMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,11 +78,66 @@ WSGI_APPLICATION = 'samplino.wsgi.application'
 
 
 # Database
+# SAMPLINO_DB_ENGINE=postgres uses the PostgreSQL server of SAMPLINO_DB_{NAME,USER,PASSWORD,HOST,PORT} (install
+# psycopg for it), "sqlite" (the default) the local db.sqlite3 file tuned by SQLITE_PRAGMAS, through
+# samplino.backends.sqlite3 whose transactions take the write lock at BEGIN. connections are kept
+# SAMPLINO_DB_CONN_MAX_AGE seconds (0 opens one per request) and health checked before reuse. django 5.0 has no
+# connection pool of its own, put pgbouncer in transaction mode in front of postgres and set SAMPLINO_DB_PGBOUNCER=1,
+# which disables server side cursors
+
+DATABASE_ENGINE = os.environ.get("SAMPLINO_DB_ENGINE", "sqlite")
+DATABASE_CONN_MAX_AGE = int(os.environ.get("SAMPLINO_DB_CONN_MAX_AGE", 60))
+
+if DATABASE_ENGINE == "postgres":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get("SAMPLINO_DB_NAME", "samplino"),
+            'USER': os.environ.get("SAMPLINO_DB_USER", "samplino"),
+            'PASSWORD': os.environ.get("SAMPLINO_DB_PASSWORD", ""),
+            'HOST': os.environ.get("SAMPLINO_DB_HOST", "localhost"),
+            'PORT': os.environ.get("SAMPLINO_DB_PORT", "5432"),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get("SAMPLINO_DB_PGBOUNCER") == "1",
+            'OPTIONS': {'connect_timeout': 5},
+        }
+    }
+elif DATABASE_ENGINE == "sqlite":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'samplino.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            # a file instead of the shared in memory database, so concurrency tests can write from many threads
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        }
+    }
+else:
+    raise ValueError(f"SAMPLINO_DB_ENGINE must be postgres or sqlite, not {DATABASE_ENGINE}")
+
+# set by users.signals on every new sqlite connection: in WAL mode readers (ban checks) do not wait for writers (try
+# inserts) and synchronous=normal skips an fsync per commit, a power loss may drop the last commits but never
+# corrupts the file. busy_timeout (ms) is how long a writer waits for the lock, 5000 is also the default of python's
+# sqlite3 and is set here to be explicit. it only helps writers which ask for the lock before reading, autocommit
+# statements and transactions of samplino.backends.sqlite3 (BEGIN IMMEDIATE). set in this order, busy_timeout first
+# so switching journal_mode waits for other connections too
+SQLITE_PRAGMAS = {
+    "busy_timeout": 5000,
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -16000,  # KiB
+    "temp_store": "memory",
+}
+
 
-DATABASES = {
+# Cache
+# LocMemCache is per process, use django.core.cache.backends.redis.RedisCache to share limiter state between workers
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
@@ -116,11 +174,143 @@ AUTH_USER_MODEL = "users.CustomUser"
 
 SMS_MAX_WRONG_RETRY = 3
 REGISTRATION_SMS_CODE_LENGTH = 6
+REGISTRATION_SMS_TEXT = "your registration code is {code}"
 BAN_RETRY_DURATION = datetime.timedelta(hours=1)
+# bans escalate: a phone_number or ip banned again gets the next ban level, lasting BAN_RETRY_DURATION *
+# BAN_ESCALATION_FACTOR ** (level - 1) up to BAN_MAX_DURATION. a level drops by one for every BAN_LEVEL_DECAY passed
+# since its last ban ended
+BAN_ESCALATION_FACTOR = 2
+BAN_MAX_DURATION = datetime.timedelta(days=1)
+BAN_LEVEL_DECAY = datetime.timedelta(days=1)
+
+# "users.limiters.DatabaseLimiterBackend" counts tries in sql tables,
+# "users.limiters.CacheLimiterBackend" keeps sliding window counters in LIMITER_CACHE_ALIAS cache
+LIMITER_BACKEND = "users.limiters.DatabaseLimiterBackend"
+LIMITER_CACHE_ALIAS = "default"
+LIMITER_WINDOW = datetime.timedelta(hours=1)
+# tries older than this and expired bans are deleted by `manage.py purge_limiter_records`, keep it >= LIMITER_WINDOW
+LIMITER_RETENTION = datetime.timedelta(days=1)
+
+# networks of reverse proxies (load balancers, nginx) allowed to set X-Forwarded-For, client ip is the rightmost
+# address of the chain which is not one of them. with no trusted proxy X-Forwarded-For is ignored
+TRUSTED_PROXIES = ["127.0.0.1/32", "::1/128"]
+
+# failures are also counted per network of the client ip (its /LIMITER_IPV4_PREFIX or /LIMITER_IPV6_PREFIX), a network
+# with LIMITER_NETWORK_MAX_WRONG_RETRY failures in LIMITER_WINDOW is banned as a whole. banned networks are checked in
+# an in process index, reloaded every NETWORK_BAN_REFRESH seconds (at once in the process which created a ban)
+LIMITER_IPV4_PREFIX = 24
+LIMITER_IPV6_PREFIX = 64
+LIMITER_NETWORK_MAX_WRONG_RETRY = 30
+NETWORK_BAN_REFRESH = 5
+
+# tries and bans are summed per hour and per ip or phone_number into TryRollup by `manage.py rollup_tries` (run it
+# from cron every minute), records newer than ROLLUP_LAG seconds wait for a later run. /user/analytics/ reads only
+# these rollups. with ROLLUPS_ENABLED purge_limiter_records keeps records until they are rolled up, rollups are
+# deleted after ROLLUP_RETENTION
+ROLLUPS_ENABLED = True
+ROLLUP_LAG = 60
+ROLLUP_BATCH_SIZE = 10000
+ROLLUP_RETENTION = datetime.timedelta(days=90)
+
+# read through cache in front of DatabaseLimiterBackend ban checks, active bans are cached until they end and
+# "not banned" answers for BAN_CACHE_NEGATIVE_TTL seconds, the latter only if BAN_CACHE_ALIAS is shared by every
+# process (redis, memcached)
+BAN_CACHE_ENABLED = True
+BAN_CACHE_ALIAS = "default"
+BAN_CACHE_NEGATIVE_TTL = 5
+BAN_CACHE_LOCAL_SIZE = 10000
+
+# write behind batching of try records, see users.buffers.TryBuffer for durability, records not yet flushed are lost
+# if the process is killed
+TRY_BUFFER_ENABLED = False
+TRY_BUFFER_FLUSH_SIZE = 500
+TRY_BUFFER_FLUSH_INTERVAL = 1.0
+TRY_BUFFER_MAX_SIZE = 10000
+
+# stateless registration: send_registration_sms answers a signed "challenge" which confirm_registration_sms takes
+# back with the code, instead of writing and reading PhoneNumberValidation records. a challenge expires after
+# REGISTRATION_CHALLENGE_TTL seconds, used ones are remembered in REGISTRATION_CHALLENGE_ALIAS cache (use a shared
+# one when running more than one process)
+REGISTRATION_CHALLENGE_ENABLED = False
+REGISTRATION_CHALLENGE_TTL = 60 * 5
+REGISTRATION_CHALLENGE_ALIAS = "default"
+
+# sms are queued by views and sent by SMS_WORKERS threads in batches of SMS_BATCH_SIZE, a failed batch is retried
+# SMS_MAX_RETRIES times after SMS_RETRY_BACKOFF * 2 ** attempt seconds. SMS_PROVIDER is the import path of a
+# users.sms.BaseSMSProvider gateway, it must be set when DEBUG is off (startup fails otherwise), FakeSMSProvider only
+# keeps sms in memory and is the default and only allowed with DEBUG
+SMS_PROVIDER = os.environ.get("SAMPLINO_SMS_PROVIDER", "users.sms.FakeSMSProvider" if DEBUG else None)
+SMS_WORKERS = 4
+SMS_QUEUE_SIZE = 10000
+SMS_BATCH_SIZE = 50
+SMS_MAX_RETRIES = 3
+SMS_RETRY_BACKOFF = 0.5
+
+# password hashing of sign in and registration runs in this many processes (0 hashes in the request thread), at most
+# PASSWORD_HASHING_MAX_PENDING hashes wait or run, a request waits PASSWORD_HASHING_QUEUE_TIMEOUT seconds for a slot
+PASSWORD_HASHING_WORKERS = os.cpu_count() or 1
+PASSWORD_HASHING_MAX_PENDING = 64
+PASSWORD_HASHING_QUEUE_TIMEOUT = 2.0
+
+# bloom filter of registered phone_numbers, answers definite "not registered" without database. the filter is built
+# and published by `manage.py rebuild_existence_index`, run it from cron well within EXISTENCE_INDEX_RECENT_TTL, an
+# older one is not used. EXISTENCE_INDEX_ALIAS must be a cache shared by every process (redis, memcached), with a per
+# process cache (LocMemCache) every check asks database
+EXISTENCE_INDEX_ENABLED = True
+EXISTENCE_INDEX_ALIAS = "default"
+EXISTENCE_INDEX_ERROR_RATE = 0.01
+EXISTENCE_INDEX_REFRESH = 60
+EXISTENCE_INDEX_RECENT_TTL = 60 * 60 * 24
+
+# stage timings (ban check, try insert, db, hash, token, sms enqueue) of INSTRUMENTATION_SAMPLE_RATE of requests,
+# exported in prometheus text format at /metrics to INSTRUMENTATION_METRICS_IPS
+INSTRUMENTATION_ENABLED = True
+INSTRUMENTATION_SAMPLE_RATE = 0.1
+INSTRUMENTATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+INSTRUMENTATION_METRICS_IPS = ["127.0.0.1", "::1"]
+
+# GCRA (token bucket) limits checked by users.middleware.RateLimitMiddleware before views run, a request must pass
+# every rule whose path regex matches its path. key is "ip", "phone" (posted phone_number) or "route", rate is
+# "<count>/<s|m|h|d>" and burst the requests allowed at once. "users.ratelimit.LocalRateStore" limits every process
+# on its own, "users.ratelimit.CacheRateStore" shares states through RATE_LIMIT_CACHE_ALIAS cache
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_STORE = "users.ratelimit.LocalRateStore"
+RATE_LIMIT_CACHE_ALIAS = "default"
+RATE_LIMIT_LOCAL_SIZE = 100000
+RATE_LIMIT_RULES = [
+    {"name": "user-ip", "path": r"/user/", "key": "ip", "rate": "10/s", "burst": 50},
+    {"name": "signin-phone", "path": r"/user/(async/)?token/signin/", "key": "phone", "rate": "10/m", "burst": 5},
+    {"name": "signup-phone", "path": r"/user/(async/)?signup/", "key": "phone", "rate": "6/m", "burst": 3},
+    {"name": "user-route", "path": r"/user/", "key": "route", "rate": "2000/s", "burst": 4000},
+]
+
+# users of authenticated requests are built from snapshots cached USER_CACHE_TTL seconds in USER_CACHE_ALIAS cache and
+# USER_CACHE_LOCAL_TTL seconds in process (0 disables it, at most 5), saving a user drops its snapshot, another
+# process may use its local copy for USER_CACHE_LOCAL_TTL seconds more. USER_CACHE_ALIAS is only used when it is a
+# shared cache (not LocMemCache), otherwise snapshots are kept in process only
+USER_CACHE_ALIAS = "default"
+USER_CACHE_TTL = 60 * 5
+USER_CACHE_LOCAL_TTL = 5
+USER_CACHE_LOCAL_SIZE = 10000
+
+# `manage.py import_users` and /user/import/ insert users in chunks of USER_IMPORT_CHUNK_SIZE rows, each one
+# transaction, and report the first USER_IMPORT_MAX_ERRORS rejected rows
+USER_IMPORT_CHUNK_SIZE = 1000
+USER_IMPORT_MAX_ERRORS = 100
+
+# every refresh returns a new refresh token, the used one and the ones revoked by logout are kept in a denylist until
+# they expire. "users.tokens.LocalTokenDenylist" only knows this process, "users.tokens.CacheTokenDenylist" shares it
+# through TOKEN_DENYLIST_ALIAS cache
+TOKEN_DENYLIST_BACKEND = "users.tokens.LocalTokenDenylist"
+TOKEN_DENYLIST_ALIAS = "default"
+
+SIMPLE_JWT = {
+    "ROTATE_REFRESH_TOKENS": True,
+}
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     )
 }
 
@@ -0,0 +1,34 @@
+"""
+API only deployment profile of samplino, select it with DJANGO_SETTINGS_MODULE=samplino.settings_api.
+
+Same as samplino.settings without the admin, sessions, messages, static files and templates apps and their
+middleware, which the JWT endpoints under /user/ never use. Compare both with `manage.py benchmark startup`.
+"""
+from samplino.settings import *  # noqa: F401,F403
+from samplino.settings import REST_FRAMEWORK
+
+INSTALLED_APPS = [
+    # auth and contenttypes hold CustomUser and its permissions
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'rest_framework',
+    'rest_framework_simplejwt',
+    "users.apps.UsersConfig"
+]
+
+# no session, csrf (every view is csrf exempt and authenticated by JWT), django auth, messages or clickjacking
+# middleware, rest_framework sets request.user from JWTs itself
+MIDDLEWARE = [
+    'users.middleware.InstrumentationMiddleware',
+    'users.middleware.RateLimitMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+TEMPLATES = []
+
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,
+    # the browsable api renderer needs templates
+    'DEFAULT_RENDERER_CLASSES': ('rest_framework.renderers.JSONRenderer',),
+}
@@ -17,8 +17,13 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+import users.async_urls
 import users.urls
+from users.views import metrics_view
 
 urlpatterns = [
     path('user/', include(users.urls)),
+    # native async versions of the same views, meant to be served by samplino.asgi
+    path('user/async/', include(users.async_urls)),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users'
+
+    def ready(self):
+        import users.signals  # noqa: F401
+        from users.sms import get_sms_provider_class
+        # fail at startup rather than on the first registration sms
+        get_sms_provider_class()
@@ -0,0 +1,14 @@
+from django.urls import path
+
+from users.async_views import (AsyncUserExistView, AsyncSignInView, AsyncSendSMSForRegistrationView,
+                               AsyncRegistrationConfirmSMSView)
+
+urlpatterns = [
+    path('token/signin/', AsyncSignInView.as_view(), name='token_sign_in_async'),
+
+    path('signin/userexists/', AsyncUserExistView.as_view(), name='user_exists_async'),
+    path('signup/send_registration_sms/', AsyncSendSMSForRegistrationView.as_view(),
+         name='send_registration_sms_async'),
+    path('signup/confirm_registration_sms/', AsyncRegistrationConfirmSMSView.as_view(),
+         name='confirm_registration_sms_async'),
+]
@@ -0,0 +1,144 @@
+"""
+contain native async versions of users views, to be served by samplino.asgi.
+they answer the same payloads as users.views. the async ORM is used for direct queries, limiter calls (which may use
+sync cache clients) run through sync_to_async and password hashing and sms sending are offloaded explicitly.
+"""
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.views import exception_handler
+
+from users.challenges import aconfirm_challenge, aissue_challenge
+from users.hashing import HashingUnavailable, authenticate
+from users.models import BannedFromSignUp, PhoneNumberValidation, BannedFromSignIn, UserSignInTry
+from users.serializers import (UserPhoneNumberSerializer, PhoneNumberValidationSerializer,
+                               UserSignInSerializer)
+from users.sms import SMSQueueFull
+from users.utils import get_user_ip, send_registration_code, auser_exists
+from users.views import get_token_pair, no_active_account
+
+from samplino.settings import REGISTRATION_CHALLENGE_ENABLED
+__all__ = ["AsyncUserExistView", "AsyncSignInView", "AsyncSendSMSForRegistrationView",
+           "AsyncRegistrationConfirmSMSView"]
+
+
+class AsyncAPIView(View):
+    """ base of async views, like rest_framework APIView it is csrf exempt and answers validation errors with 400 """
+    http_method_names = ["post", "options"]
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            return await super().dispatch(request, *args, **kwargs)
+        except ValidationError as e:
+            return JsonResponse(e.detail, status=status.HTTP_400_BAD_REQUEST, safe=False)
+
+    @staticmethod
+    async def validate(serializer_class, data) -> dict:
+        """
+        will validate data with given serializer and return its validated data. serializers of these views never
+        query the database, so they run in the event loop instead of a thread
+        """
+        serializer = serializer_class(data=data)
+        serializer.is_valid(raise_exception=True)
+        return serializer.data
+
+
+class AsyncUserExistView(AsyncAPIView):
+    """ will answer if a user with a phone_number exist or not """
+
+    async def post(self, request):
+        """
+        take a phone number and return True if user exists else False.
+        """
+        data = await self.validate(UserPhoneNumberSerializer, request.POST)
+        user_exist = await auser_exists(data["phone_number"])
+        return JsonResponse({"exist": user_exist}, status=status.HTTP_200_OK)
+
+
+class AsyncSendSMSForRegistrationView(AsyncAPIView):
+    """ will send sms for registration if user is not registered """
+
+    async def post(self, request):
+        """
+        take a phone number and will return success status for sending sms
+        """
+        data = await self.validate(UserPhoneNumberSerializer, request.POST)
+        user_ip = get_user_ip(request)
+        phone_number = data["phone_number"]
+        if await sync_to_async(BannedFromSignUp.is_banned)(phone_number=phone_number, user_ip=user_ip):
+            return JsonResponse({"success": False, "errors": ["user is restricted"]},
+                                status=status.HTTP_403_FORBIDDEN)
+
+        if await auser_exists(phone_number):
+            return JsonResponse({"success": False, "errors": ["user already registered"]},
+                                status=status.HTTP_409_CONFLICT)
+        try:
+            sms_code = await sync_to_async(send_registration_code, thread_sensitive=False)(phone_number=phone_number)
+        except SMSQueueFull:
+            return JsonResponse({"success": False, "errors": ["sms service is busy, try again later"]},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if REGISTRATION_CHALLENGE_ENABLED:
+            challenge = await aissue_challenge(phone_number=phone_number, user_ip=user_ip, sms_code=sms_code)
+            return JsonResponse({"success": True, "errors": None, "challenge": challenge}, status=status.HTTP_200_OK)
+        await PhoneNumberValidation.aadd_new_validation_code(phone_number=phone_number, user_ip=user_ip,
+                                                             sms_code=sms_code)
+        return JsonResponse({"success": True, "errors": None}, status=status.HTTP_200_OK)
+
+
+class AsyncRegistrationConfirmSMSView(AsyncAPIView):
+    """ will confirm sms sent to a number and generate a unique id/key for registration """
+
+    async def post(self, request):
+        """ take number and code as argument and return a unique id if is valid """
+        data = await self.validate(PhoneNumberValidationSerializer, request.POST)
+        phone_number = data["phone_number"]
+        code = data["code"]
+        user_ip = get_user_ip(request)
+        if await sync_to_async(BannedFromSignUp.is_banned)(phone_number=phone_number, user_ip=user_ip):
+            return JsonResponse({"success": False, "errors": ["user is restricted"]},
+                                status=status.HTTP_403_FORBIDDEN)
+        if REGISTRATION_CHALLENGE_ENABLED:
+            register_id = await aconfirm_challenge(challenge=data.get("challenge"), phone_number=phone_number,
+                                                   code=code, user_ip=user_ip)
+        else:
+            register_id = await PhoneNumberValidation.aconfirm_code(phone_number=phone_number, code=code,
+                                                                    user_ip=user_ip)
+        if register_id is not None:
+            return JsonResponse({"success": True, "errors": None, "registerId": register_id})
+        return JsonResponse({"success": False, "errors": ["combination is wrong!"], "registerId": None})
+
+
+class AsyncSignInView(AsyncAPIView):
+    """ will take user credentials and return a JWT token, it also has a limiter to stop abusers """
+
+    async def post(self, request):
+        """ check limiter, then authenticate out of the event loop """
+        data = await self.validate(UserSignInSerializer, request.POST)
+        user_ip = get_user_ip(request)
+        phone_number = data["phone_number"]
+        if await sync_to_async(BannedFromSignIn.is_banned)(phone_number=phone_number, user_ip=user_ip):
+            return JsonResponse({}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        try:
+            # hashing itself runs in the hashing executor, waiting for it must not block the shared ORM thread
+            user = await sync_to_async(authenticate, thread_sensitive=False)(phone_number=phone_number,
+                                                                             password=data["password"])
+        except HashingUnavailable:
+            # not the user's fault, no try is counted
+            return JsonResponse({}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception:
+            await sync_to_async(UserSignInTry.add_try)(phone_number=phone_number, user_ip=user_ip)
+            raise
+        if user is None:
+            await sync_to_async(UserSignInTry.add_try)(phone_number=phone_number, user_ip=user_ip)
+            # same body as SignInView, built by the exception handler of rest_framework
+            response = exception_handler(no_active_account(), {})
+            return JsonResponse(response.data, status=response.status_code)
+        return JsonResponse(await sync_to_async(get_token_pair)(user), status=status.HTTP_200_OK)
@@ -0,0 +1,60 @@
+""" contain authentication classes of rest_framework """
+from django.db import router
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from users.caches import user_snapshot_cache
+from users.models import CustomUser
+from users.tokens import get_token_denylist
+
+__all__ = ["CachedJWTAuthentication"]
+
+# loaded fields of users built from snapshots, others are deferred and loaded on access, save() only writes these.
+# in model order, as Model.from_db expects values
+SNAPSHOT_FIELDS = tuple(field.attname for field in CustomUser._meta.concrete_fields if field.attname in {
+    "id", "phone_number", "username", "is_active", "is_staff", "is_superuser"})
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    like JWTAuthentication but the user is built from a snapshot in user_snapshot_cache, so an authenticated request
+    costs no query while the snapshot is cached, and tokens revoked in the token denylist are rejected. the snapshot
+    keeps a hash of the password hash, for CHECK_REVOKE_TOKEN, and is dropped when the user is saved or deleted (not
+    by queryset.update()).
+    """
+    user_model = CustomUser
+
+    def get_validated_token(self, raw_token):
+        """ like parent but tokens revoked by logout are rejected, one denylist lookup """
+        validated_token = super().get_validated_token(raw_token)
+        if get_token_denylist().is_denied(validated_token[api_settings.JTI_CLAIM]):
+            raise InvalidToken(_("Token is blacklisted"))
+        return validated_token
+
+    def get_user(self, validated_token) -> CustomUser:
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        snapshot = user_snapshot_cache.get(user_id)
+        if snapshot is None:
+            values = self.user_model.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).values(
+                *SNAPSHOT_FIELDS, "password").first()
+            if values is None:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            snapshot = {**values, "password": get_md5_hash_password(values["password"])}  # only as a change marker
+            user_snapshot_cache.set(user_id, snapshot)
+
+        if not snapshot["is_active"]:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != \
+                snapshot["password"]:
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return self.user_model.from_db(router.db_for_read(self.user_model), SNAPSHOT_FIELDS,
+                                       [snapshot[field] for field in SNAPSHOT_FIELDS])
@@ -0,0 +1,703 @@
+""" contain data generators and suites used by `manage.py benchmark` """
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.db import DatabaseError, connection, connections
+from django.db.backends.sqlite3 import base as sqlite_base
+from django.db.models import Count, Q
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from rest_framework import serializers
+
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.caches import ban_cache
+from users.existence import phone_existence_index
+from users.imports import UserImporter
+from users.limiters import SIGN_IN, MAX_BAN_LEVEL, DatabaseLimiterBackend
+from users.models import (CustomUser, PhoneNumberValidation, UserSignInTry, BannedFromSignIn, BannedFromSignUp,
+                          LimiterCounter)
+from users.ratelimit import LocalRateStore, get_rate_store
+from users.rollups import aggregate, top_offenders
+from users.serializers import PhoneNumberValidationSerializer, UserPhoneNumberSerializer
+from users.tokens import CacheTokenDenylist, LocalTokenDenylist
+from users.utils import set_sqlite_pragmas
+
+from samplino.settings import (BASE_DIR, BAN_RETRY_DURATION, LIMITER_WINDOW, REGISTRATION_SMS_CODE_LENGTH,
+                               TOKEN_DENYLIST_BACKEND, SQLITE_PRAGMAS, ROLLUP_BATCH_SIZE)
+
+__all__ = ["SUITES", "percentile", "measure", "random_phone_number", "random_ip", "seed_sign_in_tries", "seed_bans",
+           "seed_users"]
+
+
+def percentile(samples: list, percent: float) -> float:
+    """ will return the given percentile of samples using nearest rank """
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(func, arguments: list) -> dict:
+    """ will call func once for every item of arguments and return latency stats in milliseconds """
+    samples = []
+    for argument in arguments:
+        start = time.perf_counter()
+        func(*argument)
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples),
+        "p50_ms": percentile(samples, 50),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": max(samples),
+    }
+
+
+def random_phone_number(rng: random.Random) -> str:
+    return "0912" + "".join(rng.choices("0123456789", k=7))
+
+
+def random_ip(rng: random.Random) -> str:
+    return f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+
+
+def seed_sign_in_tries(rows: int, rng: random.Random, chunk_size: int = 10000, bans: int = 0):
+    """
+    will insert `rows` sign in tries for a pool of rows/10 phone_numbers and ips, most of them already used for ban
+    or successful like an old table, and `bans` mostly expired ban records
+    """
+    pool_size = max(1, rows // 10)
+    phone_numbers = [random_phone_number(rng) for _ in range(pool_size)]
+    ips = [random_ip(rng) for _ in range(pool_size)]
+    for offset in range(0, rows, chunk_size):
+        UserSignInTry.objects.bulk_create([
+            UserSignInTry(phone_number=rng.choice(phone_numbers), user_ip=rng.choice(ips),
+                          is_success=rng.random() < 0.3, is_used_for_ban=rng.random() < 0.9)
+            for _ in range(min(chunk_size, rows - offset))
+        ])
+    seed_bans(BannedFromSignIn, bans, phone_numbers, ips, rng, chunk_size=chunk_size)
+    return phone_numbers, ips
+
+
+def seed_ban_states(phone_numbers: list, ips: list, rng: random.Random, chunk_size: int = 10000) -> int:
+    """ will insert the LimiterCounter state of every phone_number and ip, 5% of them still banned """
+    now = timezone.now()
+    keys = {f"phone:{phone_number}" for phone_number in phone_numbers} | {f"ip:{ip}" for ip in ips}
+    LimiterCounter.objects.bulk_create([
+        LimiterCounter(scope=SIGN_IN, key=key, window_start=now, ban_level=rng.randint(1, MAX_BAN_LEVEL),
+                       banned_until=now + BAN_RETRY_DURATION * (1 if rng.random() < 0.05 else -1))
+        for key in keys
+    ], batch_size=chunk_size)
+    return len(keys)
+
+
+def seed_bans(model, rows: int, phone_numbers: list, ips: list, rng: random.Random, chunk_size: int = 10000):
+    """ will insert `rows` ban records of model for given phone_numbers and ips, 5% of them still active """
+    now = timezone.now()
+    for offset in range(0, rows, chunk_size):
+        model.objects.bulk_create([
+            model(phone_number=rng.choice(phone_numbers), user_ip=rng.choice(ips),
+                  banned_until=now + BAN_RETRY_DURATION * (1 if rng.random() < 0.05 else -1))
+            for _ in range(min(chunk_size, rows - offset))
+        ])
+
+
+def seed_users(rows: int, rng: random.Random, password: str, chunk_size: int = 10000) -> list:
+    """
+    will insert `rows` users with unique phone_numbers, all with given password, and return their phone_numbers.
+    the password is hashed once, bulk_create does not send post_save so phone_existence_index is rebuilt here.
+    """
+    encoded = make_password(password)
+    phone_numbers = [f"0912{number:07d}" for number in rng.sample(range(10 ** 7), rows)]
+    for offset in range(0, rows, chunk_size):
+        CustomUser.objects.bulk_create([
+            CustomUser(phone_number=phone_number, username=phone_number, password=encoded)
+            for phone_number in phone_numbers[offset:offset + chunk_size]
+        ])
+    phone_existence_index.rebuild()
+    return phone_numbers
+
+
+def or_form_lookup(phone_number: str, user_ip: str):
+    """ ban and unused failed try lookups written with `phone OR ip` filters, as they were before the UNION rewrite """
+    now = timezone.now()
+    is_banned = BannedFromSignIn.objects.filter(Q(phone_number=phone_number) | Q(user_ip=user_ip),
+                                                banned_until__gt=now).exists()
+    tries = UserSignInTry.objects.filter(Q(phone_number=phone_number) | Q(user_ip=user_ip),
+                                         is_used_for_ban=False, is_success=False,
+                                         created__gte=now - LIMITER_WINDOW).count()
+    return is_banned, tries
+
+
+def current_form_lookup(phone_number: str, user_ip: str):
+    """
+    ban and unused failed try lookups as DatabaseLimiterBackend runs them: the ban is read from the LimiterCounter
+    states of phone_number and ip (is_banned), tries are matched by phone_number and by ip separately (ban)
+    """
+    now = timezone.now()
+    is_banned = DatabaseLimiterBackend().get_banned_until(SIGN_IN, phone_number, user_ip) is not None
+    tries = UserSignInTry.objects.filter(is_used_for_ban=False, is_success=False, created__gte=now - LIMITER_WINDOW)
+    tries = tries.filter(phone_number=phone_number).values("pk").union(
+        tries.filter(user_ip=user_ip).values("pk")).count()
+    return is_banned, tries
+
+
+def limiter_queries_suite(rows: int, lookups: int, seed: int, stdout, **options) -> dict:
+    """
+    will seed try/ban tables and ban states and compare plans and latency of the lookups of the limiter before the
+    UNION rewrite (OR filters, bans read from the ban table) with the current ones
+    """
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    phone_numbers, ips = seed_sign_in_tries(rows, rng, bans=rows // 100)
+    states = seed_ban_states(phone_numbers, ips, rng)
+    stdout.write(f"seeded {rows} tries, {rows // 100} bans and {states} states in {time.perf_counter() - start:.1f}s")
+
+    phone_number, user_ip = phone_numbers[0], ips[0]
+    now = timezone.now()
+    since = now - LIMITER_WINDOW
+    stdout.write("OR plan:\n" + UserSignInTry.objects.filter(
+        Q(phone_number=phone_number) | Q(user_ip=user_ip), is_used_for_ban=False, is_success=False,
+        created__gte=since).explain())
+    tries = UserSignInTry.objects.filter(is_used_for_ban=False, is_success=False, created__gte=since)
+    stdout.write("UNION plan:\n" + tries.filter(phone_number=phone_number).values("pk").union(
+        tries.filter(user_ip=user_ip).values("pk")).explain())
+    stdout.write("ban state plan:\n" + LimiterCounter.objects.filter(
+        scope=SIGN_IN, key__in=[f"phone:{phone_number}", f"ip:{user_ip}"], banned_until__gt=now).explain())
+
+    # lookups are read only, a ban would mark tries and change the data between the two runs
+    arguments = [(rng.choice(phone_numbers), rng.choice(ips)) for _ in range(lookups)]
+    return {
+        "rows": rows,
+        "or_query": measure(or_form_lookup, arguments),
+        "current_query": measure(current_form_lookup, arguments),
+    }
+
+
+def run_wsgi(path: str, payloads: list, concurrency: int) -> list:
+    """
+    will post (data, ip) payloads to path through the wsgi handler from `concurrency` threads, return latencies in ms
+    """
+    local = threading.local()
+
+    def post(payload):
+        if not hasattr(local, "client"):
+            local.client = Client()
+        data, ip = payload
+        start = time.perf_counter()
+        local.client.post(path, data, headers={"X-Forwarded-For": ip})
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(post, payloads))
+
+
+def run_asgi(path: str, payloads: list, concurrency: int) -> list:
+    """ will post (data, ip) payloads to path through the asgi handler with `concurrency` tasks, return latencies """
+    async def main():
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def post(payload):
+            data, ip = payload
+            async with semaphore:
+                start = time.perf_counter()
+                await client.post(path, data, headers={"X-Forwarded-For": ip})
+                return (time.perf_counter() - start) * 1000
+
+        return await asyncio.gather(*(post(payload) for payload in payloads))
+
+    return asyncio.run(main())
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    """ will return latency stats in ms and throughput of samples measured in elapsed seconds """
+    return {
+        "count": len(samples),
+        "throughput_rps": len(samples) / elapsed,
+        "p50_ms": percentile(samples, 50),
+        "p99_ms": percentile(samples, 99),
+    }
+
+
+def wsgi_asgi_suite(lookups: int, concurrency: int, seed: int, stdout, **options) -> dict:
+    """
+    will compare sync views under the wsgi handler with async views under the asgi handler at given concurrency.
+    both run in this process with django test clients, so the numbers compare request handling (thread pool hops,
+    blocking ORM calls) and not a real server's network stack.
+    """
+    rng = random.Random(seed)
+    results = {"concurrency": concurrency}
+    for name, path, make_payload in [
+        ("userexists", "signin/userexists/", lambda: {"phone_number": random_phone_number(rng)}),
+        ("signin", "token/signin/", lambda: {"phone_number": random_phone_number(rng), "password": "wrong-pass"}),
+    ]:
+        payloads = [(make_payload(), random_ip(rng)) for _ in range(lookups)]
+        for handler, prefix, run in [("wsgi", "/user/", run_wsgi), ("asgi", "/user/async/", run_asgi)]:
+            start = time.perf_counter()
+            samples = run(prefix + path, payloads, concurrency)
+            results[f"{name}_{handler}"] = summarize(samples, time.perf_counter() - start)
+            stdout.write(f"{name} {handler}: {results[f'{name}_{handler}']}")
+    return results
+
+
+def run_load(path: str, payloads: list, concurrency: int) -> dict:
+    """
+    will post (data, ip) payloads to path through the wsgi handler from `concurrency` threads, return latency,
+    throughput, database queries per request and response status counts
+    """
+    local = threading.local()
+
+    def post(payload):
+        if not hasattr(local, "client"):
+            # server errors (e.g. a locked sqlite database) are part of the results, not failures of the run
+            local.client = Client(raise_request_exception=False)
+        data, ip = payload
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = local.client.post(path, data, headers={"X-Forwarded-For": ip})
+            latency = (time.perf_counter() - start) * 1000
+        return latency, len(queries), response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(post, payloads))
+    elapsed = time.perf_counter() - start
+    queries = [count for _, count, _ in results]
+    return {
+        **summarize([latency for latency, _, _ in results], elapsed),
+        "queries_mean": statistics.fmean(queries),
+        "queries_max": max(queries),
+        "statuses": dict(Counter(str(status) for _, _, status in results)),
+    }
+
+
+# share of legitimate requests in each traffic mix, the rest are abusive
+TRAFFIC_MIXES = {"normal": 0.95, "attack": 0.1}
+
+
+def endpoint_payloads(endpoint: str, count: int, legit_share: float, users: list, rng: random.Random) -> list:
+    """
+    will return `count` (data, ip) payloads of endpoint. legitimate clients come from many ips and use registered
+    numbers (or new ones when registering) with right credentials. abusers come from a few ips, enumerate random
+    numbers and guess passwords and codes. numbers confirming a code get a validation record here.
+    """
+    attacker_ips = [random_ip(rng) for _ in range(16)]
+    confirm_numbers = []
+    payloads = []
+    for _ in range(count):
+        legit = rng.random() < legit_share
+        ip = random_ip(rng) if legit else rng.choice(attacker_ips)
+        if endpoint == "signin":
+            data = {"phone_number": rng.choice(users), "password": "password"} if legit else \
+                {"phone_number": rng.choice((rng.choice(users), random_phone_number(rng))),
+                 "password": f"guess-{rng.randrange(10 ** 6)}"}
+        elif endpoint == "userexists":
+            data = {"phone_number": rng.choice(users) if legit else random_phone_number(rng)}
+        elif endpoint == "send_registration_sms":
+            data = {"phone_number": random_phone_number(rng)}
+        else:
+            phone_number = random_phone_number(rng)
+            confirm_numbers.append(phone_number)
+            data = {"phone_number": phone_number, "code": "123456" if legit else f"{rng.randrange(10 ** 6):06d}"}
+        payloads.append((data, ip))
+    PhoneNumberValidation.objects.bulk_create(
+        [PhoneNumberValidation(phone_number=phone_number, last_sent_sms_code="123456",
+                               last_sent_sms_datetime=timezone.now()) for phone_number in confirm_numbers],
+        ignore_conflicts=True)
+    return payloads
+
+
+ENDPOINTS = {
+    "signin": "/user/token/signin/",
+    "userexists": "/user/signin/userexists/",
+    "send_registration_sms": "/user/signup/send_registration_sms/",
+    "confirm_registration_sms": "/user/signup/confirm_registration_sms/",
+}
+
+
+def endpoints_suite(rows: int, lookups: int, concurrency: int, seed: int, stdout, **options) -> dict:
+    """
+    will seed `rows` users and sign in tries and rows/100 bans of both scopes, then load every endpoint of ENDPOINTS
+    with `lookups` requests of every traffic mix, through the wsgi handler of this process
+    """
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    users = seed_users(rows, rng, password="password")
+    phone_numbers, ips = seed_sign_in_tries(rows, rng, bans=rows // 100)
+    seed_bans(BannedFromSignUp, rows // 100, phone_numbers, ips, rng)
+    stdout.write(f"seeded {rows} users, {rows} tries and {rows // 100} bans of each scope "
+                 f"in {time.perf_counter() - start:.1f}s")
+
+    results = {"rows": rows, "concurrency": concurrency}
+    for mix, legit_share in TRAFFIC_MIXES.items():
+        for cache in caches.all():
+            cache.clear()
+        ban_cache.local.clear()
+        if isinstance(get_rate_store(), LocalRateStore):
+            get_rate_store().states.clear()
+        for endpoint, path in ENDPOINTS.items():
+            payloads = endpoint_payloads(endpoint, lookups, legit_share, users, rng)
+            results[f"{endpoint}_{mix}"] = run_load(path, payloads, concurrency)
+            stdout.write(f"{endpoint} {mix}: {results[f'{endpoint}_{mix}']}")
+    return results
+
+
+def token_refresh_suite(lookups: int, concurrency: int, seed: int, stdout, **options) -> dict:
+    """
+    will refresh `lookups` distinct refresh tokens, replay them (all rejected as used), log out as many, and compare
+    deny/is_denied of both token denylist backends
+    """
+    rng = random.Random(seed)
+    user = CustomUser.objects.create_user(phone_number=random_phone_number(rng), password="password")
+
+    def payloads():
+        return [({"refresh": str(RefreshToken.for_user(user))}, random_ip(rng)) for _ in range(lookups)]
+
+    results = {"backend": TOKEN_DENYLIST_BACKEND, "concurrency": concurrency}
+    refreshes = payloads()
+    for name, path, requests in [("refresh", "/user/token/refresh/", refreshes),
+                                 ("refresh_reused", "/user/token/refresh/", refreshes),
+                                 ("logout", "/user/token/logout/", payloads())]:
+        results[name] = run_load(path, requests, concurrency)
+        stdout.write(f"{name}: {results[name]}")
+
+    expires_at = time.time() + 60
+    jtis = [(f"{rng.getrandbits(128):032x}",) for _ in range(lookups)]
+    for denylist in (LocalTokenDenylist(), CacheTokenDenylist()):
+        name = type(denylist).__name__
+        results[f"{name}_deny"] = measure(lambda jti: denylist.deny(jti, expires_at), jtis)
+        results[f"{name}_is_denied"] = measure(denylist.is_denied, jtis)
+        stdout.write(f"{name}: deny {results[f'{name}_deny']}, is_denied {results[f'{name}_is_denied']}")
+    return results
+
+
+# (name, pragmas set on each new connection, connection kept between requests, transactions start with BEGIN
+# IMMEDIATE) compared by db_contention_suite. stock pragmas (busy_timeout is python's default 5s either way), one
+# connection per request and deferred BEGIN was the behavior before SQLITE_PRAGMAS, CONN_MAX_AGE and
+# samplino.backends.sqlite3
+DB_MODES = {
+    "sqlite": [
+        ("sqlite_default", {"journal_mode": "delete", "synchronous": "full"}, False, False),
+        ("sqlite_wal_deferred", SQLITE_PRAGMAS, True, False),
+        ("sqlite_wal_new_connection", SQLITE_PRAGMAS, False, True),
+        ("sqlite_wal_persistent", SQLITE_PRAGMAS, True, True),
+    ],
+    "postgresql": [
+        ("postgres_new_connection", {}, False, True),
+        ("postgres_persistent", {}, True, True),
+    ],
+}
+# operations of db_contention_suite, every one is a write path of an endpoint
+DB_OPERATIONS = ("sign_in_try", "send_registration_sms", "confirm_registration_sms", "escalate_ban")
+
+
+def run_db_operation(operation: str, phone_number: str, user_ip: str):
+    """ will run the database work of operation for phone_number and ip, as its endpoint does """
+    if operation == "sign_in_try":
+        if not BannedFromSignIn.is_banned(phone_number=phone_number, user_ip=user_ip):
+            UserSignInTry.add_try(phone_number=phone_number, user_ip=user_ip)
+    elif operation == "send_registration_sms":
+        PhoneNumberValidation.add_new_validation_code(phone_number=phone_number, user_ip=user_ip, sms_code="123456")
+    elif operation == "confirm_registration_sms":
+        PhoneNumberValidation.confirm_code(phone_number=phone_number, code="123456", user_ip=user_ip)
+    else:
+        UserSignInTry.add_try(phone_number=phone_number, user_ip=user_ip)
+        LimiterCounter.escalate_ban(SIGN_IN, [f"phone:{phone_number}", f"ip:{user_ip}"], timezone.now())
+
+
+def db_contention_suite(lookups: int, concurrency: int, seed: int, stdout, **options) -> dict:
+    """
+    will run `lookups` DB_OPERATIONS (failed sign in tries, sms code upserts, code confirmations and ban escalations)
+    from `concurrency` threads against the database of the current profile in each of its DB_MODES, and count
+    "database is locked" like errors. without a postgres server run it with SAMPLINO_DB_ENGINE=postgres against a
+    throwaway one (e.g. a container)
+    """
+    rng = random.Random(seed)
+    # distinct ips, so tries are not cut short by bans and every one writes. registrations share a few numbers so
+    # their upserts and claims meet on the same records
+    registering = [random_phone_number(rng) for _ in range(max(1, concurrency))]
+    payloads = []
+    for index in range(lookups):
+        operation = DB_OPERATIONS[index % len(DB_OPERATIONS)]
+        phone_number = rng.choice(registering) if "registration" in operation else random_phone_number(rng)
+        payloads.append((operation, phone_number, random_ip(rng)))
+    results = {"concurrency": concurrency}
+    for name, pragmas, persistent, immediate in DB_MODES[connection.vendor]:
+        if connection.vendor == "sqlite":
+            # journal_mode is stored in the file, it is switched while this is the only open connection
+            set_sqlite_pragmas(connection, {"journal_mode": pragmas["journal_mode"]})
+        caches["default"].clear()
+        ban_cache.local.clear()
+        samples, errors = [], Counter()
+        lock = threading.Lock()
+
+        def worker(chunk):
+            for operation, phone_number, user_ip in chunk:
+                start = time.perf_counter()
+                try:
+                    run_db_operation(operation, phone_number, user_ip)
+                except DatabaseError as error:
+                    with lock:
+                        errors[f"{operation}: {error}"] += 1
+                latency = (time.perf_counter() - start) * 1000
+                if not persistent:
+                    connection.close()
+                with lock:
+                    samples.append(latency)
+            connection.close()
+
+        # the deferred BEGIN of django's own sqlite backend
+        begin = contextlib.nullcontext() if immediate else mock.patch.object(
+            type(connections["default"]), "_start_transaction_under_autocommit",
+            sqlite_base.DatabaseWrapper._start_transaction_under_autocommit)
+        with mock.patch("users.signals.SQLITE_PRAGMAS", pragmas), begin:
+            threads = [threading.Thread(target=worker, args=(payloads[index::concurrency],))
+                       for index in range(concurrency)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        results[name] = {**summarize(samples, elapsed), "errors": dict(errors)}
+        stdout.write(f"{name}: {results[name]}")
+    return results
+
+
+# run in a fresh interpreter by startup_suite with DJANGO_SETTINGS_MODULE of a profile, sys.argv[1] is the number of
+# requests. the request is answered 400 by serializer validation, so it costs the middleware and view stack only
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import resolve
+resolve("/user/signin/userexists/")
+resolved = time.perf_counter()
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment
+setup_test_environment(debug=False)
+client, samples, statuses = Client(), [], set()
+for index in range(int(sys.argv[1])):
+    ip = f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+    request_start = time.perf_counter()
+    statuses.add(client.post("/user/signin/userexists/", {"phone_number": "x"}, headers={"X-Forwarded-For": ip})
+                 .status_code)
+    samples.append((time.perf_counter() - request_start) * 1000)
+print(json.dumps({"setup_ms": (setup - start) * 1000, "resolve_ms": (resolved - setup) * 1000, "samples": samples,
+                  "statuses": sorted(statuses), "connected": connection.connection is not None}))
+"""
+STARTUP_PROFILES = ("samplino.settings", "samplino.settings_api")
+STARTUP_RUNS = 10
+
+
+def run_startup_script(profile: str, requests: int) -> dict:
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, str(requests)], check=True, capture_output=True,
+                            text=True, cwd=BASE_DIR, env={**os.environ, "DJANGO_SETTINGS_MODULE": profile}).stdout
+    result = {**json.loads(output), "process_ms": (time.perf_counter() - start) * 1000}
+    if result["connected"] or result["statuses"] not in ([], [400]):
+        raise RuntimeError(f"requests of {profile} were expected to be answered 400 without database")
+    return result
+
+
+def startup_suite(lookups: int, stdout, **options) -> dict:
+    """
+    will compare settings profiles by median of STARTUP_RUNS cold starts (whole interpreter, django.setup() and first
+    url resolution, which imports every view) and overhead of `lookups` requests in one more process
+    """
+    results = {"runs": STARTUP_RUNS}
+    for profile in STARTUP_PROFILES:
+        runs = [run_startup_script(profile, 0) for _ in range(STARTUP_RUNS)]
+        samples = run_startup_script(profile, lookups)["samples"]
+        results[profile] = {
+            **{key: statistics.median(run[key] for run in runs) for key in ("process_ms", "setup_ms", "resolve_ms")},
+            "request_mean_ms": statistics.fmean(samples),
+            "request_p50_ms": percentile(samples, 50),
+            "request_p99_ms": percentile(samples, 99),
+        }
+        stdout.write(f"{profile}: {results[profile]}")
+    return results
+
+
+class ModelPhoneNumberValidationSerializer(serializers.ModelSerializer):
+    """ PhoneNumberValidationSerializer as it was before plain serializers, with the unique check of phone_number """
+    code = serializers.CharField(max_length=REGISTRATION_SMS_CODE_LENGTH, min_length=REGISTRATION_SMS_CODE_LENGTH)
+
+    class Meta:
+        model = CustomUser
+        fields = ['phone_number', 'code']
+
+
+def validation_suite(lookups: int, seed: int, stdout, **options) -> dict:
+    """
+    will compare validation cost per request (serializer creation, is_valid and data) and its queries for the
+    ModelSerializer of CustomUser and the plain serializers, with valid and with malformed phone_numbers
+    """
+    rng = random.Random(seed)
+    payloads = {
+        "valid": [({"phone_number": random_phone_number(rng), "code": "123456"},) for _ in range(lookups)],
+        "invalid": [({"phone_number": "08" + random_phone_number(rng)[2:], "code": "123456"},) for _ in range(lookups)],
+    }
+
+    def validate(serializer_class):
+        def run(data):
+            serializer = serializer_class(data=data)
+            if serializer.is_valid():
+                return serializer.data
+            return serializer.errors
+        return run
+
+    def count_query(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    results = {}
+    for name, serializer_class in [("model_serializer", ModelPhoneNumberValidationSerializer),
+                                   ("plain_serializer", PhoneNumberValidationSerializer),
+                                   ("phone_number_only", UserPhoneNumberSerializer)]:
+        for kind, arguments in payloads.items():
+            queries = [0]
+            with connection.execute_wrapper(count_query):
+                stats = measure(validate(serializer_class), arguments)
+            results[f"{name}_{kind}"] = {**stats, "queries": queries[0]}
+            stdout.write(f"{name} {kind}: {results[f'{name}_{kind}']}")
+    return results
+
+
+def user_import_suite(rows: int, lookups: int, seed: int, stdout, **options) -> dict:
+    """
+    will compare rows/s of `lookups` users created one by one with create_user, imported with plain passwords
+    (hashed in the pool) and `rows` users imported with pre-hashed passwords
+    """
+    rng = random.Random(seed)
+    phone_numbers = iter(f"0912{number:07d}" for number in rng.sample(range(10 ** 7), rows + 2 * lookups))
+    encoded = make_password("password")
+    results = {}
+
+    start = time.perf_counter()
+    for _ in range(lookups):
+        phone_number = next(phone_numbers)
+        CustomUser.objects.create_user(phone_number=phone_number, username=phone_number, password="password")
+    results["create_user"] = {"rows": lookups, "rows_per_s": lookups / (time.perf_counter() - start)}
+    stdout.write(f"create_user: {results['create_user']}")
+
+    for name, count, password in [("import_plain", lookups, {"password": "password"}),
+                                  ("import_prehashed", rows, {"password_hash": encoded})]:
+        records = [(number, {"phone_number": next(phone_numbers), **password}) for number in range(1, count + 1)]
+        start = time.perf_counter()
+        report = UserImporter().run(records)
+        results[name] = {"rows": count, "created": report.created,
+                         "rows_per_s": count / (time.perf_counter() - start)}
+        stdout.write(f"{name}: {results[name]}")
+    return results
+
+
+def analytics_suite(rows: int, lookups: int, seed: int, stdout, **options) -> dict:
+    """
+    will seed `rows` sign in tries from 1000 ips and phone_numbers over the last 24 hours, measure rows/s of rolling
+    them up and compare top offender ips of the day read from TryRollup and grouped from the raw try table (at most
+    20 of those, they are slow)
+    """
+    rng = random.Random(seed)
+    phone_numbers = [random_phone_number(rng) for _ in range(1000)]
+    ips = [random_ip(rng) for _ in range(1000)]
+    for offset in range(0, rows, 10000):
+        UserSignInTry.objects.bulk_create([
+            UserSignInTry(phone_number=rng.choice(phone_numbers), user_ip=rng.choice(ips),
+                          is_success=rng.random() < 0.3)
+            for _ in range(min(10000, rows - offset))
+        ])
+    # spread tries over hourly buckets by id range, like a day of traffic
+    first_id = UserSignInTry.objects.order_by("id").values_list("id", flat=True).first()
+    now = timezone.now()
+    for hour in range(24):
+        UserSignInTry.objects.filter(id__gte=first_id + rows * hour // 24, id__lt=first_id + rows * (hour + 1) // 24
+                                     ).update(created=now - datetime.timedelta(hours=24 - hour))
+    results = {}
+
+    start = time.perf_counter()
+    added = aggregate("signin_tries", rows // ROLLUP_BATCH_SIZE + 1)
+    results["aggregate"] = {"rows": added, "rows_per_s": added / (time.perf_counter() - start)}
+    stdout.write(f"aggregate: {results['aggregate']}")
+
+    since = now - datetime.timedelta(days=1)
+
+    def raw_top_offenders(limit):
+        return list(UserSignInTry.objects.filter(created__gte=since).values("user_ip").annotate(
+            failures=Count("id", filter=Q(is_success=False))).order_by("-failures")[:limit])
+
+    for name, func, count in [("rollup_top_offenders", lambda limit: top_offenders(SIGN_IN, "ip", since, limit),
+                               lookups),
+                              ("raw_top_offenders", raw_top_offenders, min(lookups, 20))]:
+        results[name] = measure(func, [(20,)] * count)
+        stdout.write(f"{name}: {results[name]}")
+    return results
+
+
+def ban_state_suite(rows: int, lookups: int, seed: int, stdout, **options) -> dict:
+    """
+    will seed `rows` ban records of rows/10 repeat offending phone_numbers and ips with the LimiterCounter state of
+    every key, and compare ban checks from the ban table (UNION of phone_number and ip lookups, as before the states,
+    now only indexed by banned_until) and from the states
+    """
+    rng = random.Random(seed)
+    pool_size = max(1, rows // 10)
+    phone_numbers = [random_phone_number(rng) for _ in range(pool_size)]
+    ips = [random_ip(rng) for _ in range(pool_size)]
+    start = time.perf_counter()
+    seed_bans(BannedFromSignIn, rows, phone_numbers, ips, rng)
+    states = seed_ban_states(phone_numbers, ips, rng)
+    now = timezone.now()
+    stdout.write(f"seeded {rows} bans and {states} states in {time.perf_counter() - start:.1f}s")
+
+    def ban_table_lookup(phone_number: str, user_ip: str):
+        bans = BannedFromSignIn.objects.filter(banned_until__gt=timezone.now())
+        return bans.filter(phone_number=phone_number).values_list("banned_until", flat=True).union(
+            bans.filter(user_ip=user_ip).values_list("banned_until", flat=True)).order_by("-banned_until").first()
+
+    limiter = DatabaseLimiterBackend()
+    stdout.write("state plan:\n" + LimiterCounter.objects.filter(
+        scope=SIGN_IN, key__in=[f"phone:{phone_numbers[0]}", f"ip:{ips[0]}"], banned_until__gt=now).explain())
+    arguments = [(rng.choice(phone_numbers), rng.choice(ips)) for _ in range(lookups)]
+    results = {"bans": rows, "states": states}
+    for name, func in [("ban_table", ban_table_lookup),
+                       ("state", lambda phone_number, user_ip: limiter.get_banned_until(SIGN_IN, phone_number,
+                                                                                        user_ip))]:
+        results[name] = measure(func, arguments)
+        stdout.write(f"{name}: {results[name]}")
+    return results
+
+
+# name -> suite function, every suite takes the parsed command options and returns a json serializable dict
+SUITES = {
+    "analytics": analytics_suite,
+    "ban_state": ban_state_suite,
+    "db_contention": db_contention_suite,
+    "endpoints": endpoints_suite,
+    "limiter_queries": limiter_queries_suite,
+    "startup": startup_suite,
+    "token_refresh": token_refresh_suite,
+    "user_import": user_import_suite,
+    "validation": validation_suite,
+    "wsgi_asgi": wsgi_asgi_suite,
+}
@@ -0,0 +1,114 @@
+""" contain write behind buffer of try records """
+import atexit
+import logging
+import threading
+import time
+
+from django.db import close_old_connections, connection, transaction
+
+from samplino.settings import TRY_BUFFER_FLUSH_SIZE, TRY_BUFFER_FLUSH_INTERVAL, TRY_BUFFER_MAX_SIZE
+
+__all__ = ["TryBuffer", "try_buffer"]
+
+logger = logging.getLogger(__name__)
+
+
+class TryBuffer:
+    """
+    collects unsaved try records in memory and writes them with one bulk_create per model when TRY_BUFFER_FLUSH_SIZE
+    records are waiting, every TRY_BUFFER_FLUSH_INTERVAL seconds and at normal interpreter exit. a full buffer met
+    inside a transaction is flushed after it commits, a flush never writes in (or fails) the caller's transaction.
+
+    durability: a record is only in this process until it is flushed, a crash or SIGKILL loses up to the unflushed
+    records. if the database refuses a flush the records are kept and retried, but never more than
+    TRY_BUFFER_MAX_SIZE of them: the oldest ones are dropped and counted in `dropped`.
+    ban decisions do not wait for records, failures are counted by the limiter when they happen. created of a record
+    is the time it was flushed.
+    """
+
+    def __init__(self, flush_size: int = TRY_BUFFER_FLUSH_SIZE, flush_interval: float = TRY_BUFFER_FLUSH_INTERVAL,
+                 max_size: int = TRY_BUFFER_MAX_SIZE):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.dropped = 0
+        self._records = []  # (added_at, record)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, record):
+        """ will buffer an unsaved try record, flushing in the calling thread if buffer is full """
+        self._start()
+        with self._lock:
+            self._records.append((time.time(), record))
+            is_full = len(self._records) >= self.flush_size
+        if not is_full:
+            return
+        if connection.in_atomic_block:
+            # if it rolls back instead the records stay buffered for the flusher thread
+            transaction.on_commit(self.flush)
+        else:
+            self.flush()
+
+    def pending_failures(self, model, phone_number: str, user_ip: str, since: float) -> list:
+        """ will return unflushed, unused failed tries of model matching phone_number or ip added after since """
+        with self._lock:
+            return [record for added_at, record in self._records
+                    if type(record) is model and added_at >= since and not record.is_success
+                    and not record.is_used_for_ban
+                    and (record.phone_number == phone_number or record.user_ip == user_ip)]
+
+    def mark_used_for_ban(self, records: list):
+        with self._lock:
+            for record in records:
+                record.is_used_for_ban = True
+
+    def flush(self):
+        """ will write all buffered records, one bulk_create per model """
+        with self._flush_lock:
+            with self._lock:
+                records = list(self._records)
+            if not records:
+                return
+            by_model = {}
+            for _, record in records:
+                by_model.setdefault(type(record), []).append(record)
+            written = set()
+            try:
+                for model, model_records in by_model.items():
+                    # its own transaction, a failed bulk_create must not break the one of a manual caller
+                    with transaction.atomic():
+                        model.objects.bulk_create(model_records)
+                    written.update(id(record) for record in model_records)
+            except Exception:
+                logger.exception("could not flush try records, will retry")
+            # records stay visible to pending_failures() until they are in the database
+            with self._lock:
+                self._records = [item for item in self._records if id(item[1]) not in written]
+                overflow = len(self._records) - self.max_size
+                if overflow > 0:
+                    del self._records[:overflow]
+                    self.dropped += overflow
+
+    def _start(self):
+        """ will start the periodic flusher thread on first use """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="try-buffer-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+try_buffer = TryBuffer()
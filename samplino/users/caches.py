@@ -0,0 +1,231 @@
+""" contain in process and shared caches used in front of database lookups """
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import timezone
+
+from users.networks import NetworkSet
+
+from samplino.settings import (BAN_CACHE_ALIAS, BAN_CACHE_NEGATIVE_TTL, BAN_CACHE_LOCAL_SIZE, NETWORK_BAN_REFRESH,
+                               USER_CACHE_ALIAS, USER_CACHE_TTL, USER_CACHE_LOCAL_TTL, USER_CACHE_LOCAL_SIZE)
+
+__all__ = ["is_shared_cache", "LRUCache", "BanCache", "ban_cache", "NetworkBanIndex", "network_ban_index",
+           "UserSnapshotCache", "user_snapshot_cache"]
+
+_MISSING = object()
+
+# seconds a process may keep using a snapshot of a user saved by another process
+MAX_USER_CACHE_LOCAL_TTL = 5
+
+
+def is_shared_cache(alias: str) -> bool:
+    """ will tell if cache of alias is seen by every process, LocMemCache and DummyCache are per process """
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
+
+
+class LRUCache:
+    """ thread safe, size bounded in process cache whose entries expire after their own timeout """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expire_at = self._data.get(key, (_MISSING, 0))
+            if value is _MISSING:
+                return default
+            if expire_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout: float):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class BanCache:
+    """
+    read through cache of ban checks.
+    an active ban is stored per (scope, phone_number, ip) until its banned_until, both in this process and in the
+    shared cache. "not banned" is stored per phone_number and per ip for BAN_CACHE_NEGATIVE_TTL seconds in the
+    shared cache only, tagged with a version of that key. every new ban sets the versions of its phone_number and
+    ip to a new unique tag (time_ns) which never expires, so a negative entry computed before it (even by a request
+    still running, however late it stores its answer) is never used again.
+    negative entries are not kept in process, nor in a per process cache_alias (LocMemCache), another process could
+    not invalidate them.
+    """
+
+    def __init__(self, cache_alias: str = BAN_CACHE_ALIAS, negative_ttl: int = BAN_CACHE_NEGATIVE_TTL,
+                 local_size: int = BAN_CACHE_LOCAL_SIZE):
+        self.cache_alias = cache_alias
+        self.negative_ttl = negative_ttl
+        self.local = LRUCache(local_size)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def ban_key(scope: str, phone_number: str, user_ip: str) -> str:
+        return f"bancache:{scope}:ban:{phone_number}:{user_ip}"
+
+    @staticmethod
+    def negative_key(scope: str, kind: str, value: str) -> str:
+        return f"bancache:{scope}:ok:{kind}:{value}"
+
+    @staticmethod
+    def version_key(scope: str, kind: str, value: str) -> str:
+        return f"bancache:{scope}:version:{kind}:{value}"
+
+    def get(self, scope: str, phone_number: str, user_ip: str):
+        """
+        will return (is_banned, versions), is_banned is None when nothing usable is cached and versions should be
+        passed to set() after asking the database
+        """
+        ban_key = self.ban_key(scope, phone_number, user_ip)
+        if self.local.get(ban_key) is not None:
+            return True, None
+        components = [("phone", phone_number), ("ip", user_ip)]
+        keys = [ban_key]
+        for kind, value in components:
+            keys += [self.negative_key(scope, kind, value), self.version_key(scope, kind, value)]
+        cached = self.cache.get_many(keys)
+        if cached.get(ban_key) is not None:
+            return True, None
+        versions = [cached.get(self.version_key(scope, kind, value), 0) for kind, value in components]
+        if is_shared_cache(self.cache_alias) and all(cached.get(self.negative_key(scope, kind, value)) == version
+               for (kind, value), version in zip(components, versions)):
+            return False, None
+        return None, versions
+
+    def set(self, scope: str, phone_number: str, user_ip: str, banned_until: datetime.datetime | None, versions):
+        """ will store the database answer, banned_until is None if user is not banned """
+        if banned_until is not None:
+            timeout = (banned_until - timezone.now()).total_seconds()
+            if timeout > 0:
+                ban_key = self.ban_key(scope, phone_number, user_ip)
+                self.local.set(ban_key, True, timeout)
+                self.cache.set(ban_key, True, timeout=timeout)
+            return
+        if not is_shared_cache(self.cache_alias):
+            return
+        self.cache.set_many({self.negative_key(scope, "phone", phone_number): versions[0],
+                             self.negative_key(scope, "ip", user_ip): versions[1]}, timeout=self.negative_ttl)
+
+    def invalidate(self, scope: str, phone_number: str, user_ip: str):
+        """ will make cached "not banned" answers of this phone_number and ip unusable """
+        # a version restarting from an old value after expiry would make stale negative entries usable again, so
+        # versions never expire and are never reused. one small key per banned phone_number and ip
+        version = time.time_ns()
+        self.cache.set_many({self.version_key(scope, kind, value): version
+                             for kind, value in (("phone", phone_number), ("ip", user_ip))}, timeout=None)
+
+
+ban_cache = BanCache()
+
+
+class NetworkBanIndex:
+    """
+    NetworkSet of networks with an active ban, per scope, loaded from BannedNetwork every `refresh` seconds.
+    a ban is seen by other processes after at most `refresh` seconds and may outlive its banned_until as long.
+    """
+
+    def __init__(self, refresh: int = NETWORK_BAN_REFRESH):
+        self.refresh = refresh
+        # scope -> (NetworkSet, loaded at)
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    def is_banned(self, scope: str, user_ip: str) -> bool:
+        return user_ip in self.get(scope)
+
+    def get(self, scope: str) -> NetworkSet:
+        index, loaded_at = self.indexes.get(scope, (None, 0.0))
+        if index is not None and time.monotonic() - loaded_at < self.refresh:
+            return index
+        with self._lock:
+            index, loaded_at = self.indexes.get(scope, (None, 0.0))
+            if index is None or time.monotonic() - loaded_at >= self.refresh:
+                networks = apps.get_model("users.BannedNetwork").objects.filter(
+                    scope=scope, banned_until__gt=timezone.now()).values_list("network", flat=True)
+                index = NetworkSet(networks)
+                self.indexes[scope] = (index, time.monotonic())
+            return index
+
+    def invalidate(self, scope: str):
+        """ will reload index of scope on next check """
+        with self._lock:
+            self.indexes.pop(scope, None)
+
+
+network_ban_index = NetworkBanIndex()
+
+
+class UserSnapshotCache:
+    """
+    snapshots (a dict of a few fields) of users authenticated by CachedJWTAuthentication, kept `ttl` seconds in the
+    shared cache and `local_ttl` seconds (at most MAX_USER_CACHE_LOCAL_TTL) in this process. saving a user deletes
+    both, other processes may keep using their local copy up to local_ttl seconds.
+    a per process cache_alias (LocMemCache) is not used, another process could not drop a snapshot from it, then
+    only the in process tier is used.
+    """
+
+    def __init__(self, cache_alias: str = USER_CACHE_ALIAS, ttl: int = USER_CACHE_TTL,
+                 local_ttl: float = USER_CACHE_LOCAL_TTL, local_size: int = USER_CACHE_LOCAL_SIZE):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        self.local_ttl = min(local_ttl, MAX_USER_CACHE_LOCAL_TTL)
+        self.local = LRUCache(local_size)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def key(user_id) -> str:
+        return f"usersnapshot:{user_id}"
+
+    def get(self, user_id) -> dict | None:
+        key = self.key(user_id)
+        snapshot = self.local.get(key)
+        if snapshot is None and is_shared_cache(self.cache_alias):
+            snapshot = self.cache.get(key)
+            if snapshot is not None and self.local_ttl:
+                self.local.set(key, snapshot, timeout=self.local_ttl)
+        return snapshot
+
+    def set(self, user_id, snapshot: dict):
+        key = self.key(user_id)
+        if is_shared_cache(self.cache_alias):
+            self.cache.set(key, snapshot, timeout=self.ttl)
+        if self.local_ttl:
+            self.local.set(key, snapshot, timeout=self.local_ttl)
+
+    def invalidate(self, user_id):
+        key = self.key(user_id)
+        self.local.delete(key)
+        self.cache.delete(key)
+
+
+user_snapshot_cache = UserSnapshotCache()
@@ -0,0 +1,74 @@
+"""
+contain stateless registration challenges, used instead of PhoneNumberValidation records when
+REGISTRATION_CHALLENGE_ENABLED. the client gets a signed, time limited token bound to its phone_number and to a keyed
+hash of the sms code, and sends it back with the code. verifying is cpu work only, a nonce of every used challenge is
+kept in cache until the challenge expires so it can not be confirmed twice.
+"""
+import secrets
+
+from asgiref.sync import sync_to_async
+from django.core import signing
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from users.models import UserPreRegister, UserSignUpTry
+
+from samplino.settings import REGISTRATION_CHALLENGE_TTL, REGISTRATION_CHALLENGE_ALIAS
+
+__all__ = ["make_challenge", "verify_challenge", "issue_challenge", "confirm_challenge", "aissue_challenge",
+           "aconfirm_challenge"]
+
+SALT = "users.challenges"
+
+
+def code_hash(phone_number: str, nonce: str, code: str) -> str:
+    """ keyed with SECRET_KEY, a leaked challenge does not allow guessing the code offline """
+    return salted_hmac(SALT, f"{phone_number}:{nonce}:{code}", algorithm="sha256").hexdigest()
+
+
+def make_challenge(phone_number: str, code: str) -> str:
+    nonce = secrets.token_urlsafe(12)
+    return signing.dumps({"p": phone_number, "n": nonce, "c": code_hash(phone_number, nonce, code)}, salt=SALT)
+
+
+def verify_challenge(challenge: str, phone_number: str, code: str) -> str | None:
+    """ will return nonce of challenge if it is valid, not expired and made for phone_number and code, else None """
+    try:
+        data = signing.loads(challenge, salt=SALT, max_age=REGISTRATION_CHALLENGE_TTL)
+    except signing.BadSignature:  # includes SignatureExpired
+        return None
+    if data["p"] != phone_number or not constant_time_compare(data["c"], code_hash(phone_number, data["n"], code)):
+        return None
+    return data["n"]
+
+
+def issue_challenge(phone_number: str, user_ip, sms_code: str) -> str:
+    """ stateless version of PhoneNumberValidation.add_new_validation_code, will return the challenge """
+    UserSignUpTry.add_try(phone_number=phone_number, user_ip=user_ip)
+    return make_challenge(phone_number, sms_code)
+
+
+def confirm_challenge(challenge: str, phone_number: str, code: str, user_ip) -> str | None:
+    """ stateless version of PhoneNumberValidation.confirm_code, will return a new registration id or None """
+    nonce = verify_challenge(challenge, phone_number, code) if challenge else None
+    # add is atomic, of concurrent confirmations of a challenge only one stores its nonce
+    if nonce is not None and caches[REGISTRATION_CHALLENGE_ALIAS].add(
+            f"challenge:used:{nonce}", True, timeout=REGISTRATION_CHALLENGE_TTL):
+        with transaction.atomic():
+            unique_registration_id = UserPreRegister.start(phone_number)
+            UserSignUpTry.add_try(phone_number=phone_number, user_ip=user_ip, is_success=True)
+        return unique_registration_id
+    UserSignUpTry.add_try(phone_number=phone_number, user_ip=user_ip)
+    return None
+
+
+async def aissue_challenge(phone_number: str, user_ip, sms_code: str) -> str:
+    """ async version of issue_challenge """
+    return await sync_to_async(issue_challenge)(phone_number=phone_number, user_ip=user_ip, sms_code=sms_code)
+
+
+async def aconfirm_challenge(challenge: str, phone_number: str, code: str, user_ip) -> str | None:
+    """ async version of confirm_challenge """
+    return await sync_to_async(confirm_challenge)(challenge=challenge, phone_number=phone_number, code=code,
+                                                  user_ip=user_ip)
@@ -0,0 +1,138 @@
+""" contain the in memory index which answers "this phone_number is surely not registered" without database """
+import hashlib
+import math
+import struct
+import threading
+import time
+
+from django.core.cache import caches
+
+from users.caches import is_shared_cache
+
+from samplino.settings import (EXISTENCE_INDEX_ALIAS, EXISTENCE_INDEX_ERROR_RATE, EXISTENCE_INDEX_REFRESH,
+                               EXISTENCE_INDEX_RECENT_TTL)
+
+__all__ = ["BloomFilter", "PhoneExistenceIndex", "phone_existence_index"]
+
+_HEADER = struct.Struct("!QI")  # bits, hashes
+
+
+class BloomFilter:
+    """ bloom filter over strings, sized for `capacity` items with `error_rate` false positives """
+
+    def __init__(self, capacity: int, error_rate: float, bits: int = None, hashes: int = None, data: bytes = None):
+        capacity = max(capacity, 1)
+        self.bits = bits or max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, round(self.bits / capacity * math.log(2)))
+        self.data = bytearray(data) if data is not None else bytearray((self.bits + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return ((first + i * second) % self.bits for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def to_bytes(self) -> bytes:
+        return _HEADER.pack(self.bits, self.hashes) + bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, value: bytes) -> "BloomFilter":
+        bits, hashes = _HEADER.unpack_from(value)
+        return cls(capacity=1, error_rate=0.5, bits=bits, hashes=hashes, data=value[_HEADER.size:])
+
+
+class PhoneExistenceIndex:
+    """
+    bloom filter of registered phone_numbers, published in the shared cache by rebuild() (`manage.py
+    rebuild_existence_index`, run it from cron well within EXISTENCE_INDEX_RECENT_TTL) and copied into every
+    process, the copy is refreshed every EXISTENCE_INDEX_REFRESH seconds.
+    a user created after the published filter was built is added to the local copy and to a "recent" key of the
+    shared cache which lives EXISTENCE_INDEX_RECENT_TTL, so a filter older than that is not used.
+    might_exist() False is definite and costs at most one cache get, True must be checked in database. it is always
+    True while no usable filter is published, and when cache_alias is not shared by every process (e.g.
+    LocMemCache), a user created in another process would be missing from its recent keys.
+    """
+    bloom_key = "existence:bloom"
+
+    def __init__(self, cache_alias: str = EXISTENCE_INDEX_ALIAS, error_rate: float = EXISTENCE_INDEX_ERROR_RATE,
+                 refresh: int = EXISTENCE_INDEX_REFRESH, recent_ttl: int = EXISTENCE_INDEX_RECENT_TTL):
+        self.cache_alias = cache_alias
+        self.error_rate = error_rate
+        self.refresh = refresh
+        self.recent_ttl = recent_ttl
+        self.bloom = None
+        self.loaded_at = -math.inf
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def recent_key(phone_number: str) -> str:
+        return f"existence:recent:{phone_number}"
+
+    def might_exist(self, phone_number: str) -> bool:
+        bloom = self.get_bloom()
+        if bloom is None or phone_number in bloom:
+            return True
+        return self.cache.get(self.recent_key(phone_number)) is not None
+
+    def add(self, phone_number: str):
+        """ will add a newly registered phone_number, called on every created user """
+        self.cache.set(self.recent_key(phone_number), True, timeout=self.recent_ttl)
+        with self._lock:
+            if self.bloom is not None:
+                self.bloom.add(phone_number)
+
+    def add_many(self, phone_numbers: list):
+        """ will add phone_numbers of users created without post_save (bulk_create), with one cache call """
+        self.cache.set_many({self.recent_key(phone_number): True for phone_number in phone_numbers},
+                            timeout=self.recent_ttl)
+        with self._lock:
+            if self.bloom is not None:
+                for phone_number in phone_numbers:
+                    self.bloom.add(phone_number)
+
+    def get_bloom(self) -> BloomFilter | None:
+        """
+        will return local copy of the published filter, reloading it when it is too old, None if there is no usable
+        one. it is never built here, a request must not scan the user table
+        """
+        if not is_shared_cache(self.cache_alias):
+            return None
+        if time.monotonic() - self.loaded_at < self.refresh:
+            return self.bloom
+        with self._lock:
+            if time.monotonic() - self.loaded_at >= self.refresh:
+                published = self.cache.get(self.bloom_key)
+                # recent keys of users created before an older filter was built may be gone
+                if published is None or time.time() - published[0] >= self.recent_ttl:
+                    self.bloom = None
+                else:
+                    self.bloom = BloomFilter.from_bytes(published[1])
+                self.loaded_at = time.monotonic()
+            return self.bloom
+
+    def rebuild(self) -> BloomFilter:
+        """ will build a filter of all users from database, publish it and use it in this process """
+        from users.models import CustomUser
+
+        built_at = time.time()
+        # room for new users until next rebuild
+        bloom = BloomFilter(capacity=max(1024, CustomUser.objects.count() * 2), error_rate=self.error_rate)
+        for phone_number in CustomUser.objects.values_list("phone_number", flat=True).iterator(chunk_size=10000):
+            bloom.add(phone_number)
+        self.cache.set(self.bloom_key, (built_at, bloom.to_bytes()), timeout=None)
+        with self._lock:
+            self.bloom, self.loaded_at = bloom, time.monotonic()
+        return bloom
+
+
+phone_existence_index = PhoneExistenceIndex()
@@ -0,0 +1,203 @@
+""" contain the executor which runs password hashing out of request threads, in a pool of processes """
+import contextlib
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from functools import lru_cache
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password, get_hasher, identify_hasher, make_password
+
+from users.instrumentation import stage
+
+from samplino.settings import (PASSWORD_HASHING_WORKERS, PASSWORD_HASHING_MAX_PENDING,
+                               PASSWORD_HASHING_QUEUE_TIMEOUT)
+
+__all__ = ["HashingUnavailable", "HashingOverloaded", "HashingExecutor", "get_hashing_executor", "authenticate"]
+
+
+class HashingUnavailable(Exception):
+    """ raised when a hash can not run now, callers answer 503 and must not count it against the user """
+
+
+class HashingOverloaded(HashingUnavailable):
+    """ raised when PASSWORD_HASHING_MAX_PENDING hashes are waiting and no slot got free in time """
+
+
+def _init_worker(settings_module: str):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    import django
+    django.setup()
+
+
+def _timed(func, *args):
+    """ runs in worker, returns result of func and when it started and finished """
+    started = time.time()
+    result = func(*args)
+    return result, started, time.time()
+
+
+def _check_password(password: str, encoded: str):
+    """ will return (is_correct, must_update) like django's check_password with a setter """
+    is_correct = check_password(password, encoded)
+    if not is_correct:
+        return False, False
+    preferred = get_hasher()
+    return True, identify_hasher(encoded).algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+class HashingExecutor:
+    """
+    runs password hashing in `workers` processes (so it escapes the GIL of request threads), or in the calling
+    thread when workers is 0. at most `max_pending` hashes are queued or running, a caller waits `queue_timeout`
+    seconds for a slot and then gets HashingOverloaded. a broken pool (a worker died) raises HashingUnavailable and
+    is replaced on next use.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASHING_WORKERS, max_pending: int = PASSWORD_HASHING_MAX_PENDING,
+                 queue_timeout: float = PASSWORD_HASHING_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = 0
+        self.counters = {"hashed": 0, "rejected": 0}
+        # seconds between submit and start of work, and seconds of work
+        self.queue_time = {"count": 0, "sum": 0.0, "max": 0.0}
+        self.hash_time = {"count": 0, "sum": 0.0, "max": 0.0}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # spawn, forking a process with running threads (sms workers, try buffer) is not safe
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker, initargs=(os.environ.get("DJANGO_SETTINGS_MODULE"),))
+            return self._pool
+
+    def reset_pool(self, pool: ProcessPoolExecutor):
+        """ will drop a broken pool, unless another caller already replaced it """
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, func, *args):
+        """ will run func(*args) in the pool and wait for its result """
+        with stage("hash"):
+            return self._run(func, *args)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """ will hold one of max_pending slots, raise HashingOverloaded if none got free in queue_timeout seconds """
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.counters["rejected"] += 1
+            raise HashingOverloaded()
+        with self._lock:
+            self.pending += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.pending -= 1
+            self.slots.release()
+
+    def _run(self, func, *args):
+        with self.slot():
+            submitted = time.time()
+            if self.workers:
+                pool = self.pool
+                try:
+                    result, started, finished = pool.submit(_timed, func, *args).result()
+                except BrokenExecutor as e:
+                    self.reset_pool(pool)
+                    raise HashingUnavailable() from e
+            else:
+                result, started, finished = _timed(func, *args)
+        with self._lock:
+            self.counters["hashed"] += 1
+            for stats, value in ((self.queue_time, started - submitted), (self.hash_time, finished - started)):
+                stats["count"] += 1
+                stats["sum"] += value
+                stats["max"] = max(stats["max"], value)
+        return result
+
+    def make_password(self, password: str | None) -> str:
+        return self.run(make_password, password)
+
+    def make_passwords(self, passwords: list) -> list:
+        """
+        will hash many passwords at once for bulk imports, spread over every worker. it takes no slot of
+        max_pending, requests of this process queue behind it in the pool
+        """
+        if not passwords:
+            return []
+        if not self.workers:
+            hashed = [make_password(password) for password in passwords]
+        else:
+            chunksize = max(1, len(passwords) // (self.workers * 4))
+            pool = self.pool
+            try:
+                hashed = list(pool.map(make_password, passwords, chunksize=chunksize))
+            except BrokenExecutor as e:
+                self.reset_pool(pool)
+                raise HashingUnavailable() from e
+        with self._lock:
+            self.counters["hashed"] += len(passwords)
+        return hashed
+
+    def check_password(self, password: str, encoded: str):
+        """ will return (is_correct, must_update) """
+        return self.run(_check_password, password, encoded)
+
+    def dummy_wait(self, password: str):
+        """
+        will take as long as checking password would and fail the same way, so a missing user is not told apart from a
+        wrong password. it holds a slot like a check (HashingOverloaded when there is none) and, once hashes were
+        timed, sleeps for the average queue and hash time in it without doing hash work. before that (a cold worker)
+        it hashes password for real
+        """
+        with self._lock:
+            count = self.hash_time["count"]
+            average = (self.queue_time["sum"] + self.hash_time["sum"]) / count if count else 0.0
+        if not count:
+            self.make_password(password)
+            return
+        with stage("hash"), self.slot():
+            time.sleep(average)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {"pending": self.pending, **self.counters,
+                    **{f"queue_time_{key}": value for key, value in self.queue_time.items()},
+                    **{f"hash_time_{key}": value for key, value in self.hash_time.items()}}
+
+
+@lru_cache(maxsize=None)
+def get_hashing_executor() -> HashingExecutor:
+    return HashingExecutor()
+
+
+def authenticate(phone_number: str, password: str):
+    """
+    will return the active user with given credentials or None, like ModelBackend.authenticate but with hashing
+    in the executor. a missing phone_number is rejected as slowly, and is overloaded like a wrong password, mostly
+    without hash work.
+    """
+    executor = get_hashing_executor()
+    user = get_user_model().objects.filter(phone_number=phone_number).first()
+    if user is None:
+        executor.dummy_wait(password)
+        return None
+    is_correct, must_update = executor.check_password(password, user.password)
+    if not is_correct or not user.is_active:
+        return None
+    if must_update:
+        user.password = executor.make_password(password)
+        user.save(update_fields=["password"])
+    return user
@@ -0,0 +1,174 @@
+""" contain the bulk user import used by `manage.py import_users` and UserImportView """
+import csv
+import json
+from dataclasses import dataclass, field
+from itertools import islice
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from users.existence import phone_existence_index
+from users.hashing import get_hashing_executor
+from users.models import CustomUser
+from users.validators import PHONE_NUMBER_PATTERN
+
+from samplino.settings import USER_IMPORT_CHUNK_SIZE, USER_IMPORT_MAX_ERRORS
+
+__all__ = ["FORMATS", "ImportReport", "UserImporter", "read_rows"]
+
+FORMATS = ("csv", "jsonl")
+# optional text fields of a row, checked against max_length of their model field
+TEXT_FIELDS = ("username", "email", "first_name", "last_name")
+
+
+def read_rows(lines, format: str):
+    """
+    will yield (row number, record) of every row of lines (an iterable of str, e.g. an open file), record is a dict
+    or None if the row is malformed. csv needs a header row, jsonl one object per line, blank lines are skipped
+    """
+    if format == "csv":
+        yield from enumerate(csv.DictReader(lines), start=1)
+        return
+    number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+@dataclass
+class ImportReport:
+    """ counters of an import, last_row is the last row of the last committed chunk (where to resume) """
+    rows: int = 0
+    created: int = 0
+    existing: int = 0
+    duplicate: int = 0
+    invalid: int = 0
+    last_row: int = 0
+    # (row, reason) of the first USER_IMPORT_MAX_ERRORS rejected rows
+    errors: list = field(default_factory=list)
+
+
+class UserImporter:
+    """
+    imports rows of users (phone_number and optional username, password or password_hash, email, first_name,
+    last_name) in chunks of `chunk_size`. a chunk is validated at once: every phone_number against
+    PHONE_NUMBER_PATTERN, then one query for the ones already registered. plain passwords of a chunk are hashed
+    together in the hashing pool, password_hash is stored as is (it must be an encoded django hash) and a row without
+    either gets an unusable password. each chunk is one bulk_create in its own transaction.
+    """
+
+    def __init__(self, chunk_size: int = USER_IMPORT_CHUNK_SIZE, max_errors: int = USER_IMPORT_MAX_ERRORS):
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.max_lengths = {name: CustomUser._meta.get_field(name).max_length for name in TEXT_FIELDS}
+        # phone_numbers and usernames of this run, repeating one is a duplicate
+        self.seen_phone_numbers = set()
+        self.seen_usernames = set()
+
+    def run(self, rows, report: ImportReport = None, on_chunk=None) -> ImportReport:
+        """
+        will import (row number, record) items of rows, skipping rows up to report.last_row when resuming with the
+        report of a previous run. on_chunk(report) is called after every committed chunk
+        """
+        report = report or ImportReport()
+        rows = ((number, record) for number, record in rows if number > report.last_row)
+        while chunk := list(islice(rows, self.chunk_size)):
+            self.import_chunk(chunk, report)
+            if on_chunk is not None:
+                on_chunk(report)
+        return report
+
+    def reject(self, report: ImportReport, number: int, reason: str):
+        if len(report.errors) < self.max_errors:
+            report.errors.append((number, reason))
+
+    def check(self, record) -> str | None:
+        """ will return why record can not be imported, or None """
+        if record is None:
+            return "malformed row"
+        if not PHONE_NUMBER_PATTERN.match(str(record.get("phone_number") or "")):
+            return "invalid phone_number"
+        for name, max_length in self.max_lengths.items():
+            if len(str(record.get(name) or "")) > max_length:
+                return f"{name} is longer than {max_length}"
+        if record.get("password_hash"):
+            try:
+                identify_hasher(record["password_hash"])
+            except ValueError:
+                return "unknown password_hash"
+        return None
+
+    def import_chunk(self, chunk: list, report: ImportReport):
+        report.rows += len(chunk)
+        accepted = []
+        for number, record in chunk:
+            reason = self.check(record)
+            if reason is not None:
+                report.invalid += 1
+                self.reject(report, number, reason)
+                continue
+            phone_number = str(record["phone_number"])
+            username = str(record.get("username") or phone_number)
+            if phone_number in self.seen_phone_numbers or username in self.seen_usernames:
+                report.duplicate += 1
+                self.reject(report, number, "duplicate in import")
+                continue
+            self.seen_phone_numbers.add(phone_number)
+            self.seen_usernames.add(username)
+            accepted.append((number, phone_number, username, record))
+
+        accepted = self.drop_existing(accepted, report)
+        # password_hash wins over password, nothing is hashed for it
+        passwords = [None if record.get("password_hash") else record.get("password") for *_, record in accepted]
+        hashed = iter(get_hashing_executor().make_passwords([str(password) for password in passwords if password]))
+        entries = []
+        for (number, phone_number, username, record), password in zip(accepted, passwords):
+            if record.get("password_hash"):
+                encoded = record["password_hash"]
+            else:
+                encoded = next(hashed) if password else make_password(None)
+            entries.append((number, phone_number, username, CustomUser(
+                phone_number=phone_number, username=username, password=encoded,
+                **{name: str(record.get(name) or "") for name in TEXT_FIELDS[1:]})))
+        while entries:
+            try:
+                with transaction.atomic():
+                    CustomUser.objects.bulk_create([user for *_, user in entries])
+                break
+            except IntegrityError:
+                # registered by someone else since they were checked, check again
+                remaining = self.drop_existing(entries, report)
+                if len(remaining) == len(entries):
+                    raise
+                entries = remaining
+        # bulk_create sends no post_save, the existence index is told here
+        phone_existence_index.add_many([phone_number for _, phone_number, *_ in entries])
+        report.created += len(entries)
+        report.last_row = chunk[-1][0]
+
+    def drop_existing(self, entries: list, report: ImportReport) -> list:
+        """ will return (number, phone_number, username, ...) entries not registered yet, with one query """
+        if not entries:
+            return entries
+        taken = CustomUser.objects.filter(Q(phone_number__in=[phone_number for _, phone_number, *_ in entries]) |
+                                          Q(username__in=[username for _, _, username, _ in entries]))
+        taken_phone_numbers, taken_usernames = set(), set()
+        for phone_number, username in taken.values_list("phone_number", "username"):
+            taken_phone_numbers.add(phone_number)
+            taken_usernames.add(username)
+        remaining = []
+        for entry in entries:
+            number, phone_number, username, _ = entry
+            if phone_number in taken_phone_numbers or username in taken_usernames:
+                report.existing += 1
+                self.reject(report, number, "already registered")
+            else:
+                remaining.append(entry)
+        return remaining
@@ -0,0 +1,132 @@
+""" contain per request stage timings of views and their export in prometheus text format """
+import bisect
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from samplino.settings import INSTRUMENTATION_ENABLED, INSTRUMENTATION_SAMPLE_RATE, INSTRUMENTATION_BUCKETS
+
+__all__ = ["StageRecorder", "recorder", "stage", "record_query", "current_timings"]
+
+# timings of the sampled request running in this context, None when it is not sampled. sync_to_async copies the
+# context into its thread, so helpers called from async views record into the same object
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def current_timings() -> dict | None:
+    return _timings.get()
+
+
+@contextmanager
+def stage(name: str):
+    """ will add the time spent in this block to stage `name` of the current request, if it is sampled """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def record_query(execute, sql, params, many, context):
+    """ database execute wrapper, counts queries and their time as stage "db" of the current request """
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings["db"] = timings.get("db", 0.0) + time.perf_counter() - start
+        timings["db_queries"] = timings.get("db_queries", 0) + 1
+
+
+class StageRecorder:
+    """
+    aggregates stage timings of a sample_rate share of requests into a histogram per (view, stage).
+    stages may be nested (e.g. "db" queries run inside "ban_check"), "total" is the whole request.
+    """
+
+    def __init__(self, enabled: bool = INSTRUMENTATION_ENABLED, sample_rate: float = INSTRUMENTATION_SAMPLE_RATE,
+                 buckets: tuple = INSTRUMENTATION_BUCKETS):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.buckets = tuple(sorted(buckets))
+        # (view, stage) -> [count of every bucket and +Inf, sum]
+        self.histograms = {}
+        # view -> [sampled requests, database queries]
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def request(self, view_name):
+        """
+        will record the block as one request of the view returned by view_name() when it ends, view_name is called
+        late since the view is resolved inside the block
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            yield
+            return
+        timings = {}
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings["total"] = time.perf_counter() - start
+            _timings.reset(token)
+            self.observe(view_name(), timings)
+
+    def observe(self, view: str, timings: dict):
+        queries = timings.pop("db_queries", 0)
+        with self._lock:
+            counters = self.requests.setdefault(view, [0, 0])
+            counters[0] += 1
+            counters[1] += queries
+            for name, seconds in timings.items():
+                histogram = self.histograms.setdefault((view, name), [0] * (len(self.buckets) + 1) + [0.0])
+                histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+                histogram[-1] += seconds
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.requests.clear()
+
+    def export(self) -> str:
+        """ will return recorded stages, sms dispatcher and hashing executor metrics in prometheus text format """
+        from users.hashing import get_hashing_executor
+        from users.sms import get_sms_dispatcher
+
+        with self._lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            requests = {key: list(value) for key, value in self.requests.items()}
+        lines = ["# HELP samplino_sampled_requests_total requests whose stages were recorded",
+                 "# TYPE samplino_sampled_requests_total counter"]
+        lines += [f'samplino_sampled_requests_total{{view="{view}"}} {count}' for view, (count, _) in requests.items()]
+        lines += ["# HELP samplino_db_queries_total database queries of sampled requests",
+                  "# TYPE samplino_db_queries_total counter"]
+        lines += [f'samplino_db_queries_total{{view="{view}"}} {queries}' for view, (_, queries) in requests.items()]
+        lines += ["# HELP samplino_stage_seconds time sampled requests spent in a stage of a view",
+                  "# TYPE samplino_stage_seconds histogram"]
+        for (view, name), histogram in sorted(histograms.items()):
+            labels = f'view="{view}",stage="{name}"'
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], histogram[:-1]):
+                cumulative += count
+                lines.append(f'samplino_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"samplino_stage_seconds_sum{{{labels}}} {histogram[-1]}")
+            lines.append(f"samplino_stage_seconds_count{{{labels}}} {cumulative}")
+        for prefix, metrics in (("sms", get_sms_dispatcher().metrics()),
+                                ("hashing", get_hashing_executor().metrics())):
+            for key, value in metrics.items():
+                lines += [f"# TYPE samplino_{prefix}_{key} gauge", f"samplino_{prefix}_{key} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+recorder = StageRecorder()
@@ -0,0 +1,242 @@
+""" contain limiter backends which decide if a phone_number/ip is banned from signing in or up """
+import datetime
+import math
+import time
+from functools import lru_cache
+
+from django.apps import apps
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from users.buffers import try_buffer
+from users.caches import ban_cache, network_ban_index
+from users.networks import network_of
+
+from samplino.settings import (SMS_MAX_WRONG_RETRY, BAN_RETRY_DURATION, LIMITER_BACKEND, LIMITER_CACHE_ALIAS,
+                               LIMITER_WINDOW, BAN_CACHE_ENABLED, LIMITER_NETWORK_MAX_WRONG_RETRY,
+                               BAN_ESCALATION_FACTOR, BAN_MAX_DURATION, BAN_LEVEL_DECAY)
+
+__all__ = ["SIGN_IN", "SIGN_UP", "MAX_BAN_LEVEL", "ban_duration", "decayed_level", "next_ban_level",
+           "BaseLimiterBackend", "DatabaseLimiterBackend", "CacheLimiterBackend", "get_limiter"]
+
+SIGN_IN = "signin"
+SIGN_UP = "signup"
+
+# scope -> (try model, ban model)
+LIMITER_SCOPES = {
+    SIGN_IN: ("users.UserSignInTry", "users.BannedFromSignIn"),
+    SIGN_UP: ("users.UserSignUpTry", "users.BannedFromSignUp"),
+}
+
+# first level lasting BAN_MAX_DURATION, a higher one would not ban any longer
+MAX_BAN_LEVEL = 1 if BAN_ESCALATION_FACTOR <= 1 or BAN_MAX_DURATION <= BAN_RETRY_DURATION else 1 + math.ceil(
+    math.log(BAN_MAX_DURATION / BAN_RETRY_DURATION, BAN_ESCALATION_FACTOR))
+
+
+def ban_duration(level: int, base: datetime.timedelta = BAN_RETRY_DURATION) -> datetime.timedelta:
+    """ will return how long a ban of level (1 for a first ban) lasts """
+    return min(base * BAN_ESCALATION_FACTOR ** (level - 1), BAN_MAX_DURATION)
+
+
+def decayed_level(level: int, banned_until, now) -> int:
+    """ will return ban level of a key at now, one lower for every BAN_LEVEL_DECAY passed since its ban ended """
+    if not level or banned_until is None or banned_until >= now:
+        return level
+    return max(0, level - int((now - banned_until) / BAN_LEVEL_DECAY))
+
+
+def next_ban_level(states, now) -> int:
+    """ will return level of a new ban of keys with (ban level, banned_until) states, one above the highest """
+    return min(max([decayed_level(level, banned_until, now) for level, banned_until in states], default=0) + 1,
+               MAX_BAN_LEVEL)
+
+
+class BaseLimiterBackend:
+    """ base class for limiter backends, a backend is asked about bans and told about every try """
+
+    def is_banned(self, scope: str, phone_number: str, user_ip: str) -> bool:
+        """ will check if user is banned in given scope """
+        raise NotImplementedError
+
+    def add_try(self, scope: str, phone_number: str, user_ip: str, is_success: bool = False):
+        """ will be called after a try record is stored, a failed try may ban the user """
+        raise NotImplementedError
+
+    @staticmethod
+    def get_models(scope: str):
+        """ will return (try model, ban model) of given scope """
+        try_model, ban_model = LIMITER_SCOPES[scope]
+        return apps.get_model(try_model), apps.get_model(ban_model)
+
+
+class DatabaseLimiterBackend(BaseLimiterBackend):
+    """
+    counts failures per phone_number and per ip in LimiterCounter records, with one atomic upsert per failed try.
+    a counter restarts when its window is older than LIMITER_WINDOW. a ban is created by the one try whose
+    conditional update claims SMS_MAX_WRONG_RETRY failures of a counter, so concurrent tries can neither pass the
+    threshold nor create duplicate bans. the ban level and end of ban of a key are kept in its LimiterCounter too and
+    checked there, BannedFromSign* records are the history of bans.
+    failures of the network of ip are counted the same way, with LIMITER_NETWORK_MAX_WRONG_RETRY, and ban the whole
+    network in BannedNetwork, checked in network_ban_index before anything else.
+    """
+
+    def is_banned(self, scope: str, phone_number: str, user_ip: str) -> bool:
+        if network_ban_index.is_banned(scope, user_ip):
+            return True
+        if not BAN_CACHE_ENABLED:
+            return self.get_banned_until(scope, phone_number, user_ip) is not None
+        is_banned, versions = ban_cache.get(scope, phone_number, user_ip)
+        if is_banned is not None:
+            return is_banned
+        banned_until = self.get_banned_until(scope, phone_number, user_ip)
+        ban_cache.set(scope, phone_number, user_ip, banned_until, versions)
+        return banned_until is not None
+
+    def get_banned_until(self, scope: str, phone_number: str, user_ip: str):
+        """ will return end of the active ban of user, None if user is not banned """
+        # two probes of the (scope, key) unique index, however many bans the keys or anyone else had before
+        return apps.get_model("users.LimiterCounter").objects.filter(
+            scope=scope, key__in=[f"phone:{phone_number}", f"ip:{user_ip}"], banned_until__gt=timezone.now()
+        ).order_by("-banned_until").values_list("banned_until", flat=True).first()
+
+    def add_try(self, scope: str, phone_number: str, user_ip: str, is_success: bool = False):
+        if is_success:
+            return
+        counter_model = apps.get_model("users.LimiterCounter")
+        now = timezone.now()
+        network = network_of(user_ip)
+        keys = [f"phone:{phone_number}", f"ip:{user_ip}"] + ([f"net:{network}"] if network else [])
+        failures = counter_model.add_failure(scope, keys, now, now - LIMITER_WINDOW)
+        network_failures = failures.pop(f"net:{network}", 0)
+        if network_failures >= LIMITER_NETWORK_MAX_WRONG_RETRY and counter_model.claim_ban(
+                scope, f"net:{network}", LIMITER_NETWORK_MAX_WRONG_RETRY):
+            self.ban_network(scope, network, now)
+        for key, count in failures.items():
+            # a ban covers both phone_number and ip, failures of the other one are used by it too
+            if count >= SMS_MAX_WRONG_RETRY and counter_model.claim_ban(
+                    scope, key, SMS_MAX_WRONG_RETRY, [other for other in failures if other != key]):
+                self.ban(scope, phone_number, user_ip, now)
+                return
+
+    def ban(self, scope: str, phone_number: str, user_ip: str, now):
+        """
+        will ban phone_number and ip at their next ban level and mark their failed tries of the window as used for it
+        """
+        try_model, ban_model = self.get_models(scope)
+        banned_until = apps.get_model("users.LimiterCounter").escalate_ban(
+            scope, [f"phone:{phone_number}", f"ip:{user_ip}"], now)
+        # post_save of ban models invalidates cached "not banned" answers
+        ban_model.objects.create(phone_number=phone_number, user_ip=user_ip, banned_until=banned_until)
+        since = now - LIMITER_WINDOW
+        tries = try_model.objects.filter(is_used_for_ban=False, is_success=False, created__gte=since)
+        tries.filter(phone_number=phone_number).update(is_used_for_ban=True)
+        tries.filter(user_ip=user_ip).update(is_used_for_ban=True)
+        try_buffer.mark_used_for_ban(try_buffer.pending_failures(try_model, phone_number, user_ip, since.timestamp()))
+
+    def ban_network(self, scope: str, network: str, now):
+        """
+        will ban every address of network at its next ban level, its tries are not marked since their ips have their
+        own counters
+        """
+        banned_until = apps.get_model("users.LimiterCounter").escalate_ban(scope, [f"net:{network}"], now)
+        # post_save of BannedNetwork reloads network_ban_index
+        apps.get_model("users.BannedNetwork").objects.create(scope=scope, network=network, banned_until=banned_until)
+
+
+class CacheLimiterBackend(BaseLimiterBackend):
+    """
+    keeps sliding window failure counters and bans keyed by phone_number and by ip in django cache framework.
+    the counter of a key is estimated from two fixed buckets: current + previous * (not yet passed part of window),
+    so checking a ban is a single get_many and never touches sql tables. use a shared cache (redis/memcached) when
+    running more than one process, LocMemCache only limits the current process.
+    the network of ip has its own counter and ban key, with max_network_wrong_retry. BannedNetwork records (e.g.
+    ranges banned by hand) are not checked by this backend. bans escalate like in database backend, the (ban level,
+    banned_until) state of a key is kept in its own cache key until its level decayed to 0.
+    """
+
+    def __init__(self, cache_alias: str = LIMITER_CACHE_ALIAS, window=LIMITER_WINDOW,
+                 max_wrong_retry: int = SMS_MAX_WRONG_RETRY, base_ban_duration=BAN_RETRY_DURATION,
+                 max_network_wrong_retry: int = LIMITER_NETWORK_MAX_WRONG_RETRY):
+        self.cache_alias = cache_alias
+        self.window = int(window.total_seconds())
+        self.max_wrong_retry = max_wrong_retry
+        self.max_network_wrong_retry = max_network_wrong_retry
+        # duration of a first ban, escalated by ban_duration()
+        self.base_ban_duration = base_ban_duration
+
+    @property
+    def cache(self):
+        """ caches are thread local, so get it on every access """
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def get_keys(phone_number: str, user_ip: str):
+        network = network_of(user_ip)
+        return [("phone", phone_number), ("ip", user_ip)] + ([("net", network)] if network else [])
+
+    @staticmethod
+    def ban_key(scope: str, kind: str, value: str) -> str:
+        return f"limiter:{scope}:ban:{kind}:{value}"
+
+    @staticmethod
+    def counter_key(scope: str, kind: str, value: str, bucket: int) -> str:
+        return f"limiter:{scope}:fail:{kind}:{value}:{bucket}"
+
+    @staticmethod
+    def level_key(scope: str, kind: str, value: str) -> str:
+        return f"limiter:{scope}:level:{kind}:{value}"
+
+    def is_banned(self, scope: str, phone_number: str, user_ip: str) -> bool:
+        keys = [self.ban_key(scope, kind, value) for kind, value in self.get_keys(phone_number, user_ip)]
+        return bool(self.cache.get_many(keys))
+
+    def add_try(self, scope: str, phone_number: str, user_ip: str, is_success: bool = False):
+        if is_success:
+            return
+        now = time.time()
+        bucket, passed = divmod(now, self.window)
+        bucket = int(bucket)
+        previous_weight = 1 - passed / self.window
+        keys = self.get_keys(phone_number, user_ip)
+        for kind, value in reversed(keys):  # network first, a ban of phone and ip stops counting
+            current = self.incr(self.counter_key(scope, kind, value, bucket))
+            previous = self.cache.get(self.counter_key(scope, kind, value, bucket - 1), 0)
+            estimated = current + previous * previous_weight
+            if kind == "net":
+                if estimated >= self.max_network_wrong_retry:
+                    self.ban(scope, [(kind, value)], bucket)
+            elif estimated >= self.max_wrong_retry:
+                self.ban(scope, keys[:2], bucket)
+                return
+
+    def incr(self, key: str) -> int:
+        """ atomically increase a counter which lives for two windows """
+        self.cache.add(key, 0, timeout=self.window * 2)
+        try:
+            return self.cache.incr(key)
+        except ValueError:  # expired between add and incr
+            self.cache.set(key, 1, timeout=self.window * 2)
+            return 1
+
+    def ban(self, scope: str, keys: list, bucket: int):
+        """
+        will ban (kind, value) keys, both phone_number and ip or a network, at their next ban level and reset their
+        counters as used tries do in database backend
+        """
+        now = timezone.now()
+        states = self.cache.get_many([self.level_key(scope, kind, value) for kind, value in keys])
+        level = next_ban_level(states.values(), now)
+        duration = ban_duration(level, self.base_ban_duration)
+        self.cache.set_many({self.ban_key(scope, kind, value): True for kind, value in keys},
+                            timeout=int(duration.total_seconds()))
+        self.cache.set_many({self.level_key(scope, kind, value): (level, now + duration) for kind, value in keys},
+                            timeout=int((duration + BAN_LEVEL_DECAY * level).total_seconds()))
+        self.cache.delete_many([self.counter_key(scope, kind, value, b)
+                                for kind, value in keys for b in (bucket, bucket - 1)])
+
+
+@lru_cache(maxsize=None)
+def get_limiter() -> BaseLimiterBackend:
+    """ will return the configured limiter backend instance """
+    return import_string(LIMITER_BACKEND)()
@@ -0,0 +1,45 @@
+""" run a benchmark suite against a throwaway test database """
+import json
+import logging
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+
+from users.benchmarks import SUITES
+
+
+class Command(BaseCommand):
+    help = ("run a benchmark suite (e.g. `endpoints --rows 1000000 --output run.json`, `wsgi_asgi --concurrency 200`) "
+            "on a fresh test database")
+
+    def add_arguments(self, parser):
+        parser.add_argument("suite", choices=sorted(SUITES))
+        parser.add_argument("--rows", type=int, default=1_000_000, help="number of seeded rows")
+        parser.add_argument("--lookups", type=int, default=1000, help="number of measured calls")
+        parser.add_argument("--concurrency", type=int, default=50, help="concurrent requests of load tests")
+        parser.add_argument("--seed", type=int, default=0, help="random seed of data generator")
+        parser.add_argument("--output", help="also write results as json to this file")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        # load tests answer thousands of 4xx/5xx on purpose, they are counted in results instead of logged
+        logging.getLogger("django.request").setLevel(logging.CRITICAL)
+        with tempfile.TemporaryDirectory() as directory:
+            # an in memory sqlite test database is one shared cache connection, concurrent writers of load tests
+            # would fail with "table is locked" instead of waiting like they do on a file
+            for connection in connections.all():
+                if connection.vendor == "sqlite":
+                    connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, f"{connection.alias}.sqlite3")
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                results = SUITES[options["suite"]](stdout=self.stdout, **options)
+            finally:
+                teardown_databases(old_config, verbosity=0)
+        results = json.dumps({"suite": options["suite"], **results}, indent=2)
+        self.stdout.write(results)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(results)
@@ -0,0 +1,60 @@
+""" import users from a csv or jsonl file in chunks, resumable from a checkpoint file """
+import dataclasses
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.imports import FORMATS, ImportReport, UserImporter, read_rows
+
+from samplino.settings import USER_IMPORT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = ("import users (phone_number, optional username, password or password_hash, email, first_name, last_name) "
+            "from a csv file with a header row or a jsonl file, an interrupted import continues from its checkpoint")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=FORMATS, help="format of the file, by default its extension")
+        parser.add_argument("--chunk-size", type=int, default=USER_IMPORT_CHUNK_SIZE,
+                            help="rows validated, hashed and inserted together, each chunk is one transaction")
+        parser.add_argument("--checkpoint", help="file keeping progress, by default <path>.checkpoint")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if format not in FORMATS:
+            raise CommandError(f"can not tell the format of {path}, use --format")
+        checkpoint = options["checkpoint"] or f"{path}.checkpoint"
+        # a checkpoint of another version of the file would skip the wrong rows
+        source = {"path": os.path.abspath(path), "size": os.path.getsize(path)}
+        report = ImportReport()
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as file:
+                state = json.load(file)
+            if state["source"] != source:
+                raise CommandError(f"{checkpoint} was written for another file, remove it to start over")
+            report = ImportReport(**state["report"])
+            self.stdout.write(f"resuming after row {report.last_row}")
+
+        start = time.perf_counter()
+        resumed_rows = report.rows
+
+        def on_chunk(report: ImportReport):
+            # written aside and renamed, an interrupted write never leaves a broken checkpoint
+            with open(f"{checkpoint}.tmp", "w") as file:
+                json.dump({"source": source, "report": dataclasses.asdict(report)}, file)
+            os.replace(f"{checkpoint}.tmp", checkpoint)
+            rate = (report.rows - resumed_rows) / (time.perf_counter() - start)
+            self.stdout.write(f"row {report.last_row}: {report.created} created, {report.existing} existing, "
+                              f"{report.duplicate} duplicate, {report.invalid} invalid, {rate:.0f} rows/s")
+
+        with open(path, newline="", encoding="utf-8-sig") as lines:
+            report = UserImporter(chunk_size=options["chunk_size"]).run(read_rows(lines, format), report, on_chunk)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        for number, reason in report.errors:
+            self.stdout.write(f"row {number}: {reason}")
+        self.stdout.write(f"imported {report.created} of {report.rows} rows")
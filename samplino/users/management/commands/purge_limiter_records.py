@@ -0,0 +1,65 @@
+""" delete expired limiter records in small batches, meant to be run from cron every few minutes """
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from users.limiters import MAX_BAN_LEVEL
+from users.models import (UserSignInTry, UserSignUpTry, BannedFromSignIn, BannedFromSignUp, BannedNetwork,
+                          LimiterCounter, TryRollup)
+from users.rollups import aggregated_id
+
+from samplino.settings import BAN_LEVEL_DECAY, LIMITER_RETENTION, ROLLUPS_ENABLED, ROLLUP_RETENTION
+
+
+class Command(BaseCommand):
+    help = ("delete tries and counters older than LIMITER_RETENTION (counters once their ban level decayed), expired "
+            "bans and rollups older than ROLLUP_RETENTION in bounded batches, tries and bans are kept until rolled up")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="rows deleted by each statement")
+        parser.add_argument("--sleep", type=float, default=0.05, help="seconds to sleep between batches")
+        parser.add_argument("--max-batches", type=int, default=1000,
+                            help="stop after this many batches per table, the next run will continue")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        # rollup source -> its expired records, records not rolled up yet are kept for rollup_tries
+        sources = {
+            "signin_tries": UserSignInTry.objects.filter(created__lt=now - LIMITER_RETENTION),
+            "signup_tries": UserSignUpTry.objects.filter(created__lt=now - LIMITER_RETENTION),
+            "signin_bans": BannedFromSignIn.objects.filter(banned_until__lt=now),
+            "signup_bans": BannedFromSignUp.objects.filter(banned_until__lt=now),
+        }
+        querysets = [queryset.filter(id__lte=aggregated_id(source)) if ROLLUPS_ENABLED else queryset
+                     for source, queryset in sources.items()]
+        querysets += [
+            BannedNetwork.objects.filter(banned_until__lt=now),
+            # an older window restarts on next failure anyway, an upsert racing with the delete recreates the record.
+            # counters are kept until their ban level decayed to 0
+            LimiterCounter.objects.filter(Q(banned_until__isnull=True) |
+                                          Q(banned_until__lt=now - BAN_LEVEL_DECAY * MAX_BAN_LEVEL),
+                                          window_start__lt=now - LIMITER_RETENTION),
+            TryRollup.objects.filter(bucket__lt=now - ROLLUP_RETENTION),
+        ]
+        for queryset in querysets:
+            deleted = self.purge(queryset, options["batch_size"], options["sleep"], options["max_batches"])
+            self.stdout.write(f"{queryset.model.__name__}: deleted {deleted} records")
+
+    @staticmethod
+    def purge(queryset, batch_size: int, sleep: float, max_batches: int) -> int:
+        """
+        will delete records of queryset by primary key, one short autocommit statement per batch, so no lock is held
+        for long and writers of the hot path can run between batches
+        """
+        deleted = 0
+        for _ in range(max_batches):
+            pks = list(queryset.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            deleted += queryset.model.objects.filter(pk__in=pks).delete()[0]
+            if len(pks) < batch_size:
+                break
+            time.sleep(sleep)
+        return deleted
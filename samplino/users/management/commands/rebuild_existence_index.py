@@ -0,0 +1,12 @@
+""" rebuild the bloom filter of registered phone_numbers """
+from django.core.management.base import BaseCommand
+
+from users.existence import phone_existence_index
+
+
+class Command(BaseCommand):
+    help = "rebuild the existence index from database and publish it to the shared cache"
+
+    def handle(self, *args, **options):
+        bloom = phone_existence_index.rebuild()
+        self.stdout.write(f"published existence index of {bloom.bits} bits and {bloom.hashes} hashes")
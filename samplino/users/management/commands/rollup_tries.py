@@ -0,0 +1,22 @@
+""" add new try and ban records to their hourly rollups, meant to be run from cron every minute """
+from django.core.management.base import BaseCommand
+
+from users.rollups import SOURCES, aggregate
+
+from samplino.settings import ROLLUP_BATCH_SIZE, ROLLUP_LAG
+
+
+class Command(BaseCommand):
+    help = "add try and ban records created since the last run to TryRollup, in batches from per table cursors"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=ROLLUP_BATCH_SIZE, help="records added by each batch")
+        parser.add_argument("--lag", type=int, default=ROLLUP_LAG,
+                            help="records created in the last seconds are left for the next run")
+        parser.add_argument("--max-batches", type=int, default=100,
+                            help="stop after this many batches per table, the next run will continue")
+
+    def handle(self, *args, **options):
+        for source in SOURCES:
+            added = aggregate(source, options["max_batches"], batch_size=options["batch_size"], lag=options["lag"])
+            self.stdout.write(f"{source}: added {added} records")
@@ -3,6 +3,8 @@ __all__ = ["CustomUserManager"]
 
 from django.contrib.auth.base_user import BaseUserManager
 
+from users.hashing import get_hashing_executor
+
 
 class CustomUserManager(BaseUserManager):
     """ Custom user manager for our custom user model """
@@ -11,7 +13,7 @@ class CustomUserManager(BaseUserManager):
         if not phone_number:
             raise ValueError('The phone_number field must be set')
         user = self.model(phone_number=phone_number, **extra_fields)
-        user.set_password(password)
+        user.password = get_hashing_executor().make_password(password)
         user.save()
         return user
 
@@ -0,0 +1,87 @@
+""" contain middlewares of users app """
+import math
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+
+from users.instrumentation import recorder, stage
+from users.ratelimit import get_rate_limit_rules, get_rate_store
+from users.utils import get_user_ip
+
+from samplino.settings import RATE_LIMIT_ENABLED
+
+__all__ = ["InstrumentationMiddleware", "RateLimitMiddleware"]
+
+
+def get_view_name(request) -> str:
+    """ will return url name of the resolved view, every unresolved path shares one name to bound label values """
+    resolver_match = getattr(request, "resolver_match", None)
+    return resolver_match.view_name if resolver_match is not None and resolver_match.view_name else "unmatched"
+
+
+class InstrumentationMiddleware:
+    """ will record stage timings of a sample of requests with users.instrumentation.recorder, sync and async """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with recorder.request(lambda: get_view_name(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with recorder.request(lambda: get_view_name(request)):
+            return await self.get_response(request)
+
+
+class RateLimitMiddleware:
+    """
+    will answer 429 to requests exceeding a rule of RATE_LIMIT_RULES before any view, serializer or query runs.
+    every matching rule counts the request, a state lookup of the rate store per rule is all it costs.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not RATE_LIMIT_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.rules = get_rate_limit_rules()
+        self.store = get_rate_store()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.check(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        return self.check(request) or await self.get_response(request)
+
+    def check(self, request):
+        """ will return a 429 response if request is limited else None """
+        with stage("rate_limit"):
+            for rule in self.rules:
+                if not rule.pattern.match(request.path_info):
+                    continue
+                if rule.key == "ip":
+                    value = get_user_ip(request)
+                elif rule.key == "phone":
+                    value = request.POST.get("phone_number") if request.method == "POST" else None
+                else:
+                    value = request.path_info
+                if not value:
+                    continue
+                retry_after = self.store.hit(f"{rule.name}:{value}", rule.interval, rule.tolerance)
+                if retry_after:
+                    return JsonResponse({"detail": "Request was throttled."}, status=429,
+                                        headers={"Retry-After": str(math.ceil(retry_after))})
+        return None
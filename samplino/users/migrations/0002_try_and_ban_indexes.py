@@ -0,0 +1,85 @@
+# Generated by Django 5.0.7 on 2026-10-17 17:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bannedfromsignin',
+            name='phone_number',
+            field=models.CharField(max_length=16, verbose_name='phone number'),
+        ),
+        migrations.AlterField(
+            model_name='bannedfromsignin',
+            name='user_ip',
+            field=models.GenericIPAddressField(verbose_name='user ip while trying to log in'),
+        ),
+        migrations.AlterField(
+            model_name='bannedfromsignup',
+            name='phone_number',
+            field=models.CharField(max_length=16, verbose_name='phone number'),
+        ),
+        migrations.AlterField(
+            model_name='bannedfromsignup',
+            name='user_ip',
+            field=models.GenericIPAddressField(verbose_name='user ip while registering'),
+        ),
+        migrations.AlterField(
+            model_name='usersignintry',
+            name='phone_number',
+            field=models.CharField(max_length=16, verbose_name='phone number'),
+        ),
+        migrations.AlterField(
+            model_name='usersignintry',
+            name='user_ip',
+            field=models.GenericIPAddressField(verbose_name='user ip while trying to log in'),
+        ),
+        migrations.AlterField(
+            model_name='usersignuptry',
+            name='phone_number',
+            field=models.CharField(max_length=16, verbose_name='phone number'),
+        ),
+        migrations.AlterField(
+            model_name='usersignuptry',
+            name='user_ip',
+            field=models.GenericIPAddressField(verbose_name='user ip while registering'),
+        ),
+        migrations.AddIndex(
+            model_name='bannedfromsignin',
+            index=models.Index(fields=['phone_number', 'banned_until'], name='signin_ban_phone_until_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bannedfromsignin',
+            index=models.Index(fields=['user_ip', 'banned_until'], name='signin_ban_ip_until_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bannedfromsignup',
+            index=models.Index(fields=['phone_number', 'banned_until'], name='signup_ban_phone_until_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bannedfromsignup',
+            index=models.Index(fields=['user_ip', 'banned_until'], name='signup_ban_ip_until_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignintry',
+            index=models.Index(condition=models.Q(('is_success', False), ('is_used_for_ban', False)), fields=['phone_number'], name='signin_try_phone_unused_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignintry',
+            index=models.Index(condition=models.Q(('is_success', False), ('is_used_for_ban', False)), fields=['user_ip'], name='signin_try_ip_unused_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignuptry',
+            index=models.Index(condition=models.Q(('is_success', False), ('is_used_for_ban', False)), fields=['phone_number'], name='signup_try_phone_unused_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignuptry',
+            index=models.Index(condition=models.Q(('is_success', False), ('is_used_for_ban', False)), fields=['user_ip'], name='signup_try_ip_unused_idx'),
+        ),
+    ]
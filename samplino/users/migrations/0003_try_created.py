@@ -0,0 +1,66 @@
+# Generated by Django 5.0.7 on 2026-10-17 17:33
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_try_and_ban_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='usersignintry',
+            name='signin_try_phone_unused_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='usersignintry',
+            name='signin_try_ip_unused_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='usersignuptry',
+            name='signup_try_phone_unused_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='usersignuptry',
+            name='signup_try_ip_unused_idx',
+        ),
+        migrations.AddField(
+            model_name='usersignintry',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='created at'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='usersignuptry',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='created at'),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='usersignintry',
+            index=models.Index(condition=models.Q(('is_success', False), ('is_used_for_ban', False)), fields=['phone_number', 'created'], name='signin_try_phone_unused_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignintry',
+            index=models.Index(condition=models.Q(('is_success', False), ('is_used_for_ban', False)), fields=['user_ip', 'created'], name='signin_try_ip_unused_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignintry',
+            index=models.Index(fields=['created'], name='signin_try_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignuptry',
+            index=models.Index(condition=models.Q(('is_success', False), ('is_used_for_ban', False)), fields=['phone_number', 'created'], name='signup_try_phone_unused_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignuptry',
+            index=models.Index(condition=models.Q(('is_success', False), ('is_used_for_ban', False)), fields=['user_ip', 'created'], name='signup_try_ip_unused_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersignuptry',
+            index=models.Index(fields=['created'], name='signup_try_created_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.7 on 2026-10-17 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_try_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LimiterCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=16, verbose_name='limiter scope')),
+                ('key', models.CharField(max_length=64, verbose_name='kind and value of limited key')),
+                ('failures', models.PositiveIntegerField(default=0, verbose_name='failures in current window')),
+                ('window_start', models.DateTimeField(verbose_name='first failure of current window')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='limitercounter',
+            constraint=models.UniqueConstraint(fields=('scope', 'key'), name='limiter_counter_scope_key_uniq'),
+        ),
+    ]
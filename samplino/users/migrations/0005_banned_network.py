@@ -0,0 +1,25 @@
+# Generated by Django 5.0.7 on 2026-10-17 17:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_limiter_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BannedNetwork',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=16, verbose_name='limiter scope')),
+                ('network', models.CharField(max_length=43, verbose_name='network in cidr notation')),
+                ('banned_until', models.DateTimeField(verbose_name='can not retry until')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['scope', 'banned_until'], name='banned_network_scope_until_idx')],
+            },
+        ),
+    ]
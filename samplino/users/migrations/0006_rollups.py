@@ -0,0 +1,53 @@
+# Generated by Django 5.0.7 on 2026-10-17 18:23
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_banned_network'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCursor',
+            fields=[
+                ('source', models.CharField(max_length=32, primary_key=True, serialize=False, verbose_name='aggregated table')),
+                ('last_id', models.BigIntegerField(default=0, verbose_name='last aggregated id')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='bannedfromsignin',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='created at'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='bannedfromsignup',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='created at'),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='TryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=16, verbose_name='limiter scope')),
+                ('kind', models.CharField(max_length=8, verbose_name='ip, phone or all')),
+                ('key', models.CharField(max_length=64, verbose_name='ip or phone_number')),
+                ('bucket', models.DateTimeField(verbose_name='start of hour')),
+                ('failures', models.PositiveIntegerField(default=0, verbose_name='failed tries')),
+                ('successes', models.PositiveIntegerField(default=0, verbose_name='successful tries')),
+                ('bans', models.PositiveIntegerField(default=0, verbose_name='bans')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['scope', 'kind', 'bucket'], name='try_rollup_kind_bucket_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='tryrollup',
+            constraint=models.UniqueConstraint(fields=('scope', 'kind', 'key', 'bucket'), name='try_rollup_key_bucket_uniq'),
+        ),
+    ]
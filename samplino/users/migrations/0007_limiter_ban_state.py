@@ -0,0 +1,41 @@
+# Generated by Django 5.0.7 on 2026-10-17 18:29
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def copy_active_bans(apps, schema_editor):
+    """ bans are checked in LimiterCounter from now on, active ones are copied there as first level bans """
+    LimiterCounter = apps.get_model('users', 'LimiterCounter')
+    now = timezone.now()
+    for scope, model_name in [('signin', 'BannedFromSignIn'), ('signup', 'BannedFromSignUp')]:
+        banned_until = {}
+        bans = apps.get_model('users', model_name).objects.filter(banned_until__gt=now)
+        for phone_number, user_ip, until in bans.values_list('phone_number', 'user_ip', 'banned_until').iterator():
+            for key in (f'phone:{phone_number}', f'ip:{user_ip}'):
+                banned_until[key] = max(until, banned_until.get(key, until))
+        for key, until in banned_until.items():
+            LimiterCounter.objects.update_or_create(
+                scope=scope, key=key, defaults={'ban_level': 1, 'banned_until': until},
+                create_defaults={'ban_level': 1, 'banned_until': until, 'window_start': now})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='limitercounter',
+            name='ban_level',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='level of last ban'),
+        ),
+        migrations.AddField(
+            model_name='limitercounter',
+            name='banned_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='end of last ban'),
+        ),
+        migrations.RunPython(copy_active_bans, migrations.RunPython.noop),
+    ]
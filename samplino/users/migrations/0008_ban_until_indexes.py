@@ -0,0 +1,37 @@
+# Generated by Django 5.0.7 on 2026-10-17 19:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_limiter_ban_state'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='bannedfromsignin',
+            name='signin_ban_phone_until_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='bannedfromsignin',
+            name='signin_ban_ip_until_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='bannedfromsignup',
+            name='signup_ban_phone_until_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='bannedfromsignup',
+            name='signup_ban_ip_until_idx',
+        ),
+        migrations.AddIndex(
+            model_name='bannedfromsignin',
+            index=models.Index(fields=['banned_until'], name='signin_ban_until_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bannedfromsignup',
+            index=models.Index(fields=['banned_until'], name='signup_ban_until_idx'),
+        ),
+    ]
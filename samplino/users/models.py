@@ -1,19 +1,23 @@
 import secrets
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import Q
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from users.buffers import try_buffer
+from users.instrumentation import stage
+from users.limiters import SIGN_IN, SIGN_UP, get_limiter, ban_duration, next_ban_level
 from users.managers import CustomUserManager
 from users.validators import phone_number_regex_validator
 
-from samplino.settings import SMS_MAX_WRONG_RETRY, BAN_RETRY_DURATION
+from samplino.settings import TRY_BUFFER_ENABLED
 
 __all__ = ["CustomUser", "UserPreRegister", "BannedFromSignUp", "PhoneNumberValidation", "UserSignUpTry",
-           "BannedFromSignIn", "UserSignInTry"]
+           "BannedFromSignIn", "UserSignInTry", "BannedNetwork", "LimiterCounter", "TryRollup", "RollupCursor"]
 
 
 class CustomUser(AbstractUser):
@@ -51,13 +55,39 @@ class PhoneNumberValidation(models.Model):
             "last_sent_sms_datetime": timezone.now()
         })
 
-    def create_user_pre_register(self) -> str:
-        """ will create a UserPreRegister record according to this record """
-        unique_registration_id = secrets.token_urlsafe(32)
-        UserPreRegister.objects.create(phone_number=self.phone_number, unique_registration_id=unique_registration_id)
-        self.is_validated = True
-        self.save(update_fields=["is_validated", "updated"])
-        return unique_registration_id
+    @staticmethod
+    def confirm_code(phone_number: str, code: str, user_ip) -> str | None:
+        """
+        will return a new registration id if code is the unused last code sent to phone_number, else None.
+        the record is claimed by a conditional update, so of concurrent confirmations only one succeeds, and it is
+        claimed in the same transaction that creates (or renews) the UserPreRegister record and adds the try.
+        """
+        with transaction.atomic():
+            # we normally should have considered using sms sent time too, but it was not requested
+            is_claimed = PhoneNumberValidation.objects.filter(
+                phone_number=phone_number, last_sent_sms_code=code, is_validated=False
+            ).update(is_validated=True, updated=timezone.now())
+            if is_claimed:
+                unique_registration_id = UserPreRegister.start(phone_number)
+                UserSignUpTry.add_try(phone_number=phone_number, user_ip=user_ip, is_success=True)
+                return unique_registration_id
+        UserSignUpTry.add_try(phone_number=phone_number, user_ip=user_ip)
+        return None
+
+    @staticmethod
+    async def aadd_new_validation_code(phone_number: str, user_ip, sms_code):
+        """ async version of add_new_validation_code """
+        await sync_to_async(UserSignUpTry.add_try)(phone_number=phone_number, user_ip=user_ip)
+        await PhoneNumberValidation.objects.aupdate_or_create(phone_number=phone_number, defaults={
+            "last_sent_sms_code": sms_code,
+            "last_sent_sms_datetime": timezone.now()
+        })
+
+    @staticmethod
+    async def aconfirm_code(phone_number: str, code: str, user_ip) -> str | None:
+        """ async version of confirm_code """
+        return await sync_to_async(PhoneNumberValidation.confirm_code)(phone_number=phone_number, code=code,
+                                                                       user_ip=user_ip)
 
 
 class UserPreRegister(models.Model):
@@ -75,75 +105,272 @@ class UserPreRegister(models.Model):
                                               max_length=32, unique=True)
     is_registered = models.BooleanField(_("is user registered using this record?"), default=False)
 
+    @staticmethod
+    def start(phone_number: str) -> str:
+        """ will create or renew (with a new id) the record of a confirmed phone_number in one upsert, return its id """
+        unique_registration_id = secrets.token_urlsafe(24)  # 32 characters
+        UserPreRegister.objects.bulk_create(
+            [UserPreRegister(phone_number=phone_number, unique_registration_id=unique_registration_id)],
+            update_conflicts=True, unique_fields=["phone_number"],
+            update_fields=["unique_registration_id", "start_time", "is_registered"])
+        return unique_registration_id
+
 
 class UserSignUpTry(models.Model):
     """ will hold records of signup tries for every try """
-    phone_number = models.CharField(_("phone number"), max_length=16, db_index=True)
-    user_ip = models.GenericIPAddressField(_("user ip while registering"), db_index=True)
+    phone_number = models.CharField(_("phone number"), max_length=16)
+    user_ip = models.GenericIPAddressField(_("user ip while registering"))
     is_success = models.BooleanField(_("did this try resulted in a success"))
     is_used_for_ban = models.BooleanField(_("is this record used for banning"), default=False)
+    created = models.DateTimeField(_("created at"), auto_now_add=True)
+
+    class Meta:
+        # partial indexes matching the unused failed tries counted by DatabaseLimiterBackend in LIMITER_WINDOW,
+        # and an index on created for purge_limiter_records
+        indexes = [
+            models.Index(fields=["phone_number", "created"], condition=Q(is_used_for_ban=False, is_success=False),
+                         name="signup_try_phone_unused_idx"),
+            models.Index(fields=["user_ip", "created"], condition=Q(is_used_for_ban=False, is_success=False),
+                         name="signup_try_ip_unused_idx"),
+            models.Index(fields=["created"], name="signup_try_created_idx"),
+        ]
 
     @staticmethod
     def add_try(phone_number: str, user_ip: str, is_success: bool = False):
-        """ will add a retry record """
-        UserSignUpTry.objects.create(phone_number=phone_number, user_ip=user_ip, is_success=is_success)
+        """ will add a retry record, through try_buffer if TRY_BUFFER_ENABLED """
+        with stage("try_insert"):
+            if TRY_BUFFER_ENABLED:
+                try_buffer.add(UserSignUpTry(phone_number=phone_number, user_ip=user_ip, is_success=is_success))
+            else:
+                UserSignUpTry.objects.create(phone_number=phone_number, user_ip=user_ip, is_success=is_success)
+            get_limiter().add_try(SIGN_UP, phone_number=phone_number, user_ip=user_ip, is_success=is_success)
 
 
 class UserSignInTry(models.Model):
     """ will hold records of login tries for every try """
-    phone_number = models.CharField(_("phone number"), max_length=16, db_index=True)
-    user_ip = models.GenericIPAddressField(_("user ip while trying to log in"), db_index=True)
+    phone_number = models.CharField(_("phone number"), max_length=16)
+    user_ip = models.GenericIPAddressField(_("user ip while trying to log in"))
     is_success = models.BooleanField(_("did this try resulted in a success"))
     is_used_for_ban = models.BooleanField(_("is this record used for banning"), default=False)
+    created = models.DateTimeField(_("created at"), auto_now_add=True)
+
+    class Meta:
+        # partial indexes matching the unused failed tries counted by DatabaseLimiterBackend in LIMITER_WINDOW,
+        # and an index on created for purge_limiter_records
+        indexes = [
+            models.Index(fields=["phone_number", "created"], condition=Q(is_used_for_ban=False, is_success=False),
+                         name="signin_try_phone_unused_idx"),
+            models.Index(fields=["user_ip", "created"], condition=Q(is_used_for_ban=False, is_success=False),
+                         name="signin_try_ip_unused_idx"),
+            models.Index(fields=["created"], name="signin_try_created_idx"),
+        ]
 
     @staticmethod
     def add_try(phone_number: str, user_ip: str, is_success: bool = False):
-        """ will add a retry record """
-        UserSignInTry.objects.create(phone_number=phone_number, user_ip=user_ip, is_success=is_success)
+        """ will add a retry record, through try_buffer if TRY_BUFFER_ENABLED """
+        with stage("try_insert"):
+            if TRY_BUFFER_ENABLED:
+                try_buffer.add(UserSignInTry(phone_number=phone_number, user_ip=user_ip, is_success=is_success))
+            else:
+                UserSignInTry.objects.create(phone_number=phone_number, user_ip=user_ip, is_success=is_success)
+            get_limiter().add_try(SIGN_IN, phone_number=phone_number, user_ip=user_ip, is_success=is_success)
 
 
 class BannedFromSignUp(models.Model):
     """ records of users/ips that are banned for signup and its durations """
-    phone_number = models.CharField(_("phone number"), max_length=16, db_index=True)
-    user_ip = models.GenericIPAddressField(_("user ip while registering"), db_index=True)
+    phone_number = models.CharField(_("phone number"), max_length=16)
+    user_ip = models.GenericIPAddressField(_("user ip while registering"))
     banned_until = models.DateTimeField(_("can not retry until"), null=True)
+    created = models.DateTimeField(_("created at"), auto_now_add=True)
+
+    class Meta:
+        # bans are checked in LimiterCounter, these records are only read by purge_limiter_records
+        indexes = [
+            models.Index(fields=["banned_until"], name="signup_ban_until_idx"),
+        ]
 
     @staticmethod
     def is_banned(phone_number: str, user_ip: str) -> bool:
         """ will check if user is or should be banned from singing up """
-        is_banned = BannedFromSignUp.objects.filter(Q(phone_number=phone_number) |
-                                                    Q(user_ip=user_ip), banned_until__gt=timezone.now()).exists()
-        if is_banned is True:
-            return True
-        signup_tries = UserSignUpTry.objects.filter(Q(phone_number=phone_number) | Q(user_ip=user_ip),
-                                                    is_used_for_ban=False, is_success=False)
-        if signup_tries.count() >= SMS_MAX_WRONG_RETRY:
-            BannedFromSignUp.objects.create(phone_number=phone_number, user_ip=user_ip,
-                                            banned_until=timezone.now() + BAN_RETRY_DURATION)
-            signup_tries.update(is_used_for_ban=True)
-            return True
-        return False
+        with stage("ban_check"):
+            return get_limiter().is_banned(SIGN_UP, phone_number=phone_number, user_ip=user_ip)
 
 
 class BannedFromSignIn(models.Model):
     """ records of users/ips that are banned for login and its durations """
-    phone_number = models.CharField(_("phone number"), max_length=16, db_index=True)
-    user_ip = models.GenericIPAddressField(_("user ip while trying to log in"), db_index=True)
+    phone_number = models.CharField(_("phone number"), max_length=16)
+    user_ip = models.GenericIPAddressField(_("user ip while trying to log in"))
     banned_until = models.DateTimeField(_("can not retry until"), null=True)
+    created = models.DateTimeField(_("created at"), auto_now_add=True)
+
+    class Meta:
+        # bans are checked in LimiterCounter, these records are only read by purge_limiter_records
+        indexes = [
+            models.Index(fields=["banned_until"], name="signin_ban_until_idx"),
+        ]
 
     @staticmethod
     def is_banned(phone_number: str, user_ip: str) -> bool:
         """ will check if user is or should be banned from singing in """
-        is_banned = BannedFromSignIn.objects.filter(Q(phone_number=phone_number) |
-                                                 Q(user_ip=user_ip), banned_until__gt=timezone.now()).exists()
-        if is_banned is True:
-            return True
-        signup_tries = UserSignInTry.objects.filter(Q(phone_number=phone_number) | Q(user_ip=user_ip),
-                                                    is_used_for_ban=False, is_success=False)
-        if signup_tries.count() >= SMS_MAX_WRONG_RETRY:
-            BannedFromSignIn.objects.create(phone_number=phone_number, user_ip=user_ip,
-                                            banned_until=timezone.now() + BAN_RETRY_DURATION)
-            signup_tries.update(is_used_for_ban=True)
-            return True
-        return False
+        with stage("ban_check"):
+            return get_limiter().is_banned(SIGN_IN, phone_number=phone_number, user_ip=user_ip)
+
+
+class BannedNetwork(models.Model):
+    """
+    records of ip networks banned in a limiter scope, created when failures of a network prefix (see
+    LIMITER_IPV4_PREFIX/LIMITER_IPV6_PREFIX) pass LIMITER_NETWORK_MAX_WRONG_RETRY, or by hand to block any range
+    """
+    scope = models.CharField(_("limiter scope"), max_length=16)
+    network = models.CharField(_("network in cidr notation"), max_length=43)
+    banned_until = models.DateTimeField(_("can not retry until"))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["scope", "banned_until"], name="banned_network_scope_until_idx"),
+        ]
+
+
+class LimiterCounter(models.Model):
+    """
+    failures of one phone_number, ip or network ("phone:<number>" / "ip:<address>" / "net:<cidr>" key) in its current
+    window and its ban state (level of its last ban and when that ban ends), one record per key which is updated in
+    place. only sqlite (3.35+) and postgresql are supported, they have ON CONFLICT/RETURNING.
+    """
+    scope = models.CharField(_("limiter scope"), max_length=16)
+    key = models.CharField(_("kind and value of limited key"), max_length=64)
+    failures = models.PositiveIntegerField(_("failures in current window"), default=0)
+    window_start = models.DateTimeField(_("first failure of current window"))
+    ban_level = models.PositiveSmallIntegerField(_("level of last ban"), default=0)
+    banned_until = models.DateTimeField(_("end of last ban"), null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "key"], name="limiter_counter_scope_key_uniq"),
+        ]
+
+    @staticmethod
+    def add_failure(scope: str, keys: list, now, window_start_before) -> dict:
+        """
+        will add one failure to every key with a single atomic upsert and return {key: failures}, a counter whose
+        window started before window_start_before restarts at 1
+        """
+        table, scope_, key_, failures, window_start, ban_level = map(connection.ops.quote_name, [
+            LimiterCounter._meta.db_table, "scope", "key", "failures", "window_start", "ban_level"])
+        now = connection.ops.adapt_datetimefield_value(now)
+        expired = connection.ops.adapt_datetimefield_value(window_start_before)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({scope_}, {key_}, {failures}, {window_start}, {ban_level}) "
+                f"VALUES {', '.join(['(%s, %s, 1, %s, 0)'] * len(keys))} "
+                f"ON CONFLICT ({scope_}, {key_}) DO UPDATE SET "
+                f"{failures} = CASE WHEN {table}.{window_start} < %s THEN 1 ELSE {table}.{failures} + 1 END, "
+                f"{window_start} = CASE WHEN {table}.{window_start} < %s THEN excluded.{window_start} "
+                f"ELSE {table}.{window_start} END "
+                f"RETURNING {key_}, {failures}",
+                [value for key in keys for value in (scope, key, now)] + [expired, expired])
+            return dict(cursor.fetchall())
+
+    @staticmethod
+    def claim_ban(scope: str, key: str, failures: int, reset_keys: list = ()) -> bool:
+        """
+        will take `failures` failures from counter of key if it has them, in one conditional update, and restart the
+        counters of reset_keys (the other keys the ban covers) from zero in the same transaction.
+        only one of concurrent callers can claim the same failures, so each claim stands for exactly one ban
+        """
+        with transaction.atomic():
+            if not LimiterCounter.objects.filter(scope=scope, key=key, failures__gte=failures).update(
+                    failures=models.F("failures") - failures):
+                return False
+            if reset_keys:
+                LimiterCounter.objects.filter(scope=scope, key__in=reset_keys).update(failures=0)
+        return True
+
+    @staticmethod
+    def escalate_ban(scope: str, keys: list, now):
+        """
+        will ban keys at the level after the highest (decayed) one of them and return when the ban ends. the state of
+        every key is replaced by a conditional update on the state it was read with, if a concurrent ban changed one
+        of them first they are read again. keys without a record get theirs by hold_ban
+        """
+        while True:
+            states = list(LimiterCounter.objects.filter(scope=scope, key__in=keys).values_list(
+                "key", "ban_level", "banned_until"))
+            level = next_ban_level([state[1:] for state in states], now)
+            banned_until = now + ban_duration(level)
+            with transaction.atomic():
+                claimed = sum(LimiterCounter.objects.filter(scope=scope, key=key, ban_level=ban_level,
+                                                            banned_until=until).update(ban_level=level,
+                                                                                       banned_until=banned_until)
+                              for key, ban_level, until in states)
+                if claimed == len(states):
+                    return banned_until
+                transaction.set_rollback(True)
+
+    @staticmethod
+    def hold_ban(scope: str, keys: list, banned_until, now):
+        """
+        will ban keys until banned_until with a single upsert, a ban of a key which ends later is kept and the ban
+        level is not changed
+        """
+        table, scope_, key_, failures, window_start, ban_level, banned_until_ = map(connection.ops.quote_name, [
+            LimiterCounter._meta.db_table, "scope", "key", "failures", "window_start", "ban_level", "banned_until"])
+        now = connection.ops.adapt_datetimefield_value(now)
+        banned_until = connection.ops.adapt_datetimefield_value(banned_until)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({scope_}, {key_}, {failures}, {window_start}, {ban_level}, {banned_until_}) "
+                f"VALUES {', '.join(['(%s, %s, 0, %s, 0, %s)'] * len(keys))} "
+                f"ON CONFLICT ({scope_}, {key_}) DO UPDATE SET {banned_until_} = CASE "
+                f"WHEN {table}.{banned_until_} IS NULL OR {table}.{banned_until_} < excluded.{banned_until_} "
+                f"THEN excluded.{banned_until_} ELSE {table}.{banned_until_} END",
+                [value for key in keys for value in (scope, key, now, banned_until)])
+
+
+class TryRollup(models.Model):
+    """
+    tries and bans of a limiter scope summed per hour (bucket) for one ip or phone_number, or for every try ("all"
+    kind with empty key), added by users.rollups.aggregate_batch. analytics read these instead of try tables.
+    """
+    scope = models.CharField(_("limiter scope"), max_length=16)
+    kind = models.CharField(_("ip, phone or all"), max_length=8)
+    key = models.CharField(_("ip or phone_number"), max_length=64)
+    bucket = models.DateTimeField(_("start of hour"))
+    failures = models.PositiveIntegerField(_("failed tries"), default=0)
+    successes = models.PositiveIntegerField(_("successful tries"), default=0)
+    bans = models.PositiveIntegerField(_("bans"), default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "kind", "key", "bucket"], name="try_rollup_key_bucket_uniq"),
+        ]
+        # top offenders of a time range
+        indexes = [
+            models.Index(fields=["scope", "kind", "bucket"], name="try_rollup_kind_bucket_idx"),
+        ]
+
+    @staticmethod
+    def add(scope: str, rollups: list, batch_size: int = 100):
+        """
+        will add (kind, key, bucket, failures, successes, bans) rollups to their records, with atomic upserts of
+        `batch_size` rollups each
+        """
+        table, *columns = map(connection.ops.quote_name, [
+            TryRollup._meta.db_table, "scope", "kind", "key", "bucket", "failures", "successes", "bans"])
+        counters = columns[-3:]
+        with connection.cursor() as cursor:
+            for offset in range(0, len(rollups), batch_size):
+                batch = rollups[offset:offset + batch_size]
+                cursor.execute(
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(batch))} "
+                    f"ON CONFLICT ({', '.join(columns[:4])}) DO UPDATE SET "
+                    + ", ".join(f"{column} = {table}.{column} + excluded.{column}" for column in counters),
+                    [value for kind, key, bucket, *counts in batch
+                     for value in (scope, kind, key, connection.ops.adapt_datetimefield_value(bucket), *counts)])
+
 
+class RollupCursor(models.Model):
+    """ id of the last record of a try or ban table (source) added to TryRollup """
+    source = models.CharField(_("aggregated table"), max_length=32, primary_key=True)
+    last_id = models.BigIntegerField(_("last aggregated id"), default=0)
@@ -0,0 +1,61 @@
+""" contain ip network helpers, a set of networks searched in O(log n) and prefix aggregation of addresses """
+import bisect
+import ipaddress
+
+from samplino.settings import LIMITER_IPV4_PREFIX, LIMITER_IPV6_PREFIX
+
+__all__ = ["NetworkSet", "network_of"]
+
+# ipv4 addresses are kept in the ipv4 mapped part of ipv6 space (::ffff:0:0/96), so one sorted list holds both
+_IPV4_OFFSET = 0xffff << 32
+
+
+def _to_int(address) -> int:
+    if address.version == 4:
+        return _IPV4_OFFSET + int(address)
+    return int(address)
+
+
+class NetworkSet:
+    """
+    immutable set of ip networks stored as sorted, merged integer ranges, `address in network_set` is one binary
+    search however many networks it holds. invalid addresses are never contained.
+    """
+
+    def __init__(self, networks=()):
+        ranges = sorted(
+            (_to_int(network.network_address), _to_int(network.broadcast_address))
+            for network in (ipaddress.ip_network(network, strict=False) for network in networks))
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    def __contains__(self, address) -> bool:
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        value = _to_int(address.ipv4_mapped or address) if address.version == 6 else _to_int(address)
+        index = bisect.bisect_right(self.starts, value) - 1
+        return index >= 0 and value <= self.ends[index]
+
+    def __len__(self) -> int:
+        """ number of merged ranges """
+        return len(self.starts)
+
+
+def network_of(address: str, ipv4_prefix: int = LIMITER_IPV4_PREFIX, ipv6_prefix: int = LIMITER_IPV6_PREFIX):
+    """ will return the network (e.g. "10.1.2.0/24") address is aggregated into, None if address is not valid """
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    prefix = ipv4_prefix if address.version == 4 else ipv6_prefix
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
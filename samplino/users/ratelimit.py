@@ -0,0 +1,112 @@
+""" contain the GCRA (token bucket) rate limiter applied to requests by RateLimitMiddleware """
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from users.caches import LRUCache
+
+from samplino.settings import RATE_LIMIT_STORE, RATE_LIMIT_RULES, RATE_LIMIT_CACHE_ALIAS, RATE_LIMIT_LOCAL_SIZE
+
+__all__ = ["RateLimitRule", "BaseRateStore", "LocalRateStore", "CacheRateStore", "parse_rate", "get_rate_store",
+           "get_rate_limit_rules"]
+
+PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 60 * 60 * 24}
+KEYS = ("ip", "phone", "route")
+
+
+def parse_rate(rate: str) -> float:
+    """ will return seconds between two requests of a rate like "10/m" """
+    count, period = rate.split("/")
+    return PERIODS[period[0]] / int(count)
+
+
+@dataclass
+class RateLimitRule:
+    """
+    requests of paths matching `path` (a regex matched at the start) are limited to `rate` per key, with up to
+    `burst` of them at once. key is "ip", "phone" (phone_number of posted data, requests without it are not limited)
+    or "route" (every client together).
+    """
+    name: str
+    path: str
+    key: str
+    rate: str
+    burst: int = 1
+    interval: float = field(init=False)
+    tolerance: float = field(init=False)
+    pattern: re.Pattern = field(init=False)
+
+    def __post_init__(self):
+        if self.key not in KEYS:
+            raise ValueError(f"rate limit rule {self.name} key must be one of {KEYS}")
+        self.interval = parse_rate(self.rate)
+        self.tolerance = self.interval * (self.burst - 1)
+        self.pattern = re.compile(self.path)
+
+
+def gcra(tat: float | None, now: float, interval: float, tolerance: float):
+    """
+    generic cell rate algorithm, a token bucket kept as one number: tat, the theoretical time the bucket is full
+    again. will return (new tat, 0) if the request is allowed else (None, seconds until it would be)
+    """
+    tat = now if tat is None or tat < now else tat
+    if tat - now > tolerance:
+        return None, tat - now - tolerance
+    return tat + interval, 0.0
+
+
+class BaseRateStore:
+    """ base of rate limiter states, hit() must be cheap enough to run on every request """
+
+    def hit(self, key: str, interval: float, tolerance: float) -> float:
+        """ will count a request of key and return 0 if it is allowed else seconds to wait """
+        raise NotImplementedError
+
+
+class LocalRateStore(BaseRateStore):
+    """ states in this process only, exact and lock protected, every process limits on its own """
+
+    def __init__(self, max_size: int = RATE_LIMIT_LOCAL_SIZE):
+        self.states = LRUCache(max_size)
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, interval: float, tolerance: float) -> float:
+        now = time.time()
+        with self._lock:
+            tat, retry_after = gcra(self.states.get(key), now, interval, tolerance)
+            if tat is not None:
+                self.states.set(key, tat, timeout=tat - now)
+        return retry_after
+
+
+class CacheRateStore(BaseRateStore):
+    """
+    states shared by every process in RATE_LIMIT_CACHE_ALIAS cache. get and set are not atomic, so requests of one
+    key racing in different processes may each pass, exceeding the burst by at most the number of racing requests.
+    """
+
+    def __init__(self, cache_alias: str = RATE_LIMIT_CACHE_ALIAS):
+        self.cache_alias = cache_alias
+
+    def hit(self, key: str, interval: float, tolerance: float) -> float:
+        cache = caches[self.cache_alias]
+        now = time.time()
+        tat, retry_after = gcra(cache.get(f"ratelimit:{key}"), now, interval, tolerance)
+        if tat is not None:
+            cache.set(f"ratelimit:{key}", tat, timeout=max(1, int(tat - now) + 1))
+        return retry_after
+
+
+@lru_cache(maxsize=None)
+def get_rate_store() -> BaseRateStore:
+    return import_string(RATE_LIMIT_STORE)()
+
+
+@lru_cache(maxsize=None)
+def get_rate_limit_rules() -> tuple:
+    return tuple(RateLimitRule(**rule) for rule in RATE_LIMIT_RULES)
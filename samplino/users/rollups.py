@@ -0,0 +1,95 @@
+"""
+contain the incremental aggregation of try and ban tables into TryRollup, and the analytics queries reading it.
+every source table is read forward from its RollupCursor by primary key, so a run only touches records added since
+the previous one and analytics never scan try tables.
+"""
+import datetime
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from users.limiters import SIGN_IN, SIGN_UP
+from users.models import RollupCursor, TryRollup
+
+from samplino.settings import ROLLUP_BATCH_SIZE, ROLLUP_LAG
+
+__all__ = ["SOURCES", "KINDS", "aggregate_batch", "aggregate", "aggregated_id", "top_offenders", "time_series"]
+
+# source name (key of its cursor) -> (model, limiter scope, counted as tries or bans)
+SOURCES = {
+    "signin_tries": ("users.UserSignInTry", SIGN_IN, "tries"),
+    "signup_tries": ("users.UserSignUpTry", SIGN_UP, "tries"),
+    "signin_bans": ("users.BannedFromSignIn", SIGN_IN, "bans"),
+    "signup_bans": ("users.BannedFromSignUp", SIGN_UP, "bans"),
+}
+# rollup kind -> field of source records it is keyed by, "all" sums every record of a bucket under an empty key
+KINDS = {"ip": "user_ip", "phone": "phone_number", "all": None}
+
+
+def aggregated_id(source: str) -> int:
+    """ will return id of the last record of source which is in TryRollup, 0 if none is """
+    return RollupCursor.objects.filter(source=source).values_list("last_id", flat=True).first() or 0
+
+
+def aggregate_batch(source: str, batch_size: int = ROLLUP_BATCH_SIZE, lag: int = ROLLUP_LAG) -> int:
+    """
+    will add the next up to `batch_size` records of source, created more than `lag` seconds ago, to TryRollup and
+    return how many were added. records are taken by id range and the lag lets transactions which took an id
+    before a newer record commit first. the cursor is claimed by a conditional update in the same transaction as
+    the rollups, so of concurrent runs only one adds a range
+    """
+    model_name, scope, counted = SOURCES[source]
+    model = apps.get_model(model_name)
+    last_id = RollupCursor.objects.get_or_create(source=source)[0].last_id
+    ids = model.objects.filter(id__gt=last_id, created__lt=timezone.now() - datetime.timedelta(seconds=lag)
+                               ).order_by("id").values_list("id", flat=True)
+    upto = next(iter(ids[batch_size - 1:batch_size]), None) or ids.last()
+    if upto is None:
+        return 0
+    records = model.objects.filter(id__gt=last_id, id__lte=upto).annotate(bucket=TruncHour("created"))
+    if counted == "tries":
+        counters = {"failures": Count("id", filter=Q(is_success=False)),
+                    "successes": Count("id", filter=Q(is_success=True))}
+    else:
+        counters = {"bans": Count("id")}
+    with transaction.atomic():
+        if not RollupCursor.objects.filter(source=source, last_id=last_id).update(last_id=upto):
+            return 0
+        added = 0
+        for kind, field in KINDS.items():
+            rollups = []
+            for row in records.values("bucket", *filter(None, [field])).annotate(**counters).order_by():
+                rollups.append((kind, row[field] if field else "", row["bucket"], row.get("failures", 0),
+                                row.get("successes", 0), row.get("bans", 0)))
+            if field is None:
+                added = sum(sum(rollup[3:]) for rollup in rollups)
+            TryRollup.add(scope, rollups)
+    return added
+
+
+def aggregate(source: str, max_batches: int, **kwargs) -> int:
+    """ will run aggregate_batch until source is caught up or max_batches ran, return records added """
+    added = 0
+    for _ in range(max_batches):
+        batch = aggregate_batch(source, **kwargs)
+        if not batch:
+            break
+        added += batch
+    return added
+
+
+def top_offenders(scope: str, kind: str, since, limit: int) -> list:
+    """ will return keys of kind with most failures (then bans) since `since`, with their totals """
+    return list(
+        TryRollup.objects.filter(scope=scope, kind=kind, bucket__gte=since).values("key")
+        .annotate(failures=Sum("failures"), successes=Sum("successes"), bans=Sum("bans"))
+        .order_by("-failures", "-bans", "key")[:limit])
+
+
+def time_series(scope: str, since, kind: str = "all", key: str = "") -> list:
+    """ will return hourly totals of one key (of every try with kind "all") since `since` """
+    return list(TryRollup.objects.filter(scope=scope, kind=kind, key=key, bucket__gte=since).order_by("bucket")
+                .values("bucket", "failures", "successes", "bans"))
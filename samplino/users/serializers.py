@@ -1,24 +1,48 @@
+from django.db import IntegrityError, transaction
+
 from rest_framework import serializers
 
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.hashing import get_hashing_executor
+from users.limiters import SIGN_IN, SIGN_UP
 from users.models import CustomUser, UserPreRegister
+from users.tokens import get_token_denylist
+from users.validators import PHONE_NUMBER_PATTERN, phone_number_regex_validator
 
-from samplino.settings import REGISTRATION_SMS_CODE_LENGTH
-__all__ = ["UserPhoneNumberSerializer", "PhoneNumberValidationSerializer",
-           "UserRegisterSerializer", "UserSignInSerializer"]
+from samplino.settings import REGISTRATION_SMS_CODE_LENGTH, ROLLUP_RETENTION
+__all__ = ["PhoneNumberField", "UserPhoneNumberSerializer", "PhoneNumberValidationSerializer",
+           "UserRegisterSerializer", "UserSignInSerializer", "RotatingTokenRefreshSerializer", "LogoutSerializer",
+           "SuspiciousActivitySerializer"]
 
 
-class UserPhoneNumberSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = CustomUser
-        fields = ['phone_number']
+class PhoneNumberField(serializers.CharField):
+    """
+    phone_number of CustomUser checked by PHONE_NUMBER_PATTERN alone, compiled once, without the model field
+    introspection of a ModelSerializer and the unique check query of phone_number
+    """
+    default_error_messages = {"invalid": phone_number_regex_validator.message}
 
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data)
+        if not PHONE_NUMBER_PATTERN.match(value):
+            self.fail("invalid")
+        return value
 
-class PhoneNumberValidationSerializer(serializers.ModelSerializer):
-    code = serializers.CharField(max_length=REGISTRATION_SMS_CODE_LENGTH, min_length=REGISTRATION_SMS_CODE_LENGTH)
 
-    class Meta:
-        model = CustomUser
-        fields = ['phone_number', 'code']
+class UserPhoneNumberSerializer(serializers.Serializer):
+    # views answer registered numbers themselves (through phone_existence_index), validation never queries
+    phone_number = PhoneNumberField()
+
+
+class PhoneNumberValidationSerializer(serializers.Serializer):
+    phone_number = PhoneNumberField()
+    code = serializers.CharField(max_length=REGISTRATION_SMS_CODE_LENGTH, min_length=REGISTRATION_SMS_CODE_LENGTH)
+    # sent back when REGISTRATION_CHALLENGE_ENABLED
+    challenge = serializers.CharField(max_length=256, required=False)
 
 
 class UserSignInSerializer(serializers.Serializer):
@@ -35,27 +59,81 @@ class UserRegisterSerializer(serializers.ModelSerializer):
         write_only_fields = ('password',)
 
     def create(self, validated_data):
-        user = CustomUser.objects.create(
-            phone_number=validated_data['phone_number'],
-            username=validated_data['username'],
-            email=validated_data['email'],
-            first_name=validated_data['first_name'],
-            last_name=validated_data['last_name']
-        )
-        user.set_password(validated_data['password'])
-        user.save()
-
-        return user
+        """
+        will claim the registration id and create the user in one transaction, the claim is a conditional update
+        so of concurrent registrations with one id only one creates a user
+        """
+        # hashed before the transaction, it must not hold database locks
+        password = get_hashing_executor().make_password(validated_data['password'])
+        try:
+            with transaction.atomic():
+                is_claimed = UserPreRegister.objects.filter(unique_registration_id=validated_data['registration_id'],
+                                                            is_registered=False).update(is_registered=True)
+                if not is_claimed:
+                    raise serializers.ValidationError({"registration_id": "is not a valid value"})
+                return CustomUser.objects.create(
+                    phone_number=validated_data['phone_number'],
+                    username=validated_data['username'],
+                    password=password,
+                    email=validated_data.get('email', ''),
+                    first_name=validated_data.get('first_name', ''),
+                    last_name=validated_data.get('last_name', '')
+                )
+        except IntegrityError:
+            # phone_number is not checked for uniqueness on confirmation, a registration id of a number registered
+            # since then fails here, and the claim is rolled back with the transaction
+            raise serializers.ValidationError({"phone_number": ["user already registered"]})
 
     def validate(self, data):
-        """ will validate the registration id and add phon_number """
-        registration_id = data["registration_id"]
-        pre_register = UserPreRegister.objects.filter(unique_registration_id=registration_id, is_registered=False)
-        if pre_register.exists() is False:
+        """ will validate the registration id and add phon_number, the id is claimed in create """
+        phone_number = UserPreRegister.objects.filter(
+            unique_registration_id=data["registration_id"], is_registered=False
+        ).values_list("phone_number", flat=True).first()
+        if phone_number is None:
             raise serializers.ValidationError({"registration_id": "is not a valid value"})
-        pre_register = pre_register.get()
-        pre_register.is_registered = True
-        pre_register.save()
-        data["phone_number"] = pre_register.phone_number
+        data["phone_number"] = phone_number
         return data
 
+
+class SuspiciousActivitySerializer(serializers.Serializer):
+    """ query of SuspiciousActivityView, with a key the time series is of that ip or phone_number """
+    scope = serializers.ChoiceField(choices=[SIGN_IN, SIGN_UP], default=SIGN_IN)
+    kind = serializers.ChoiceField(choices=["ip", "phone"], default="ip")
+    key = serializers.CharField(max_length=64, required=False)
+    hours = serializers.IntegerField(min_value=1, max_value=ROLLUP_RETENTION.days * 24, default=24)
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=20)
+
+
+def deny_refresh_token(refresh: RefreshToken):
+    """ will revoke refresh, raise TokenError if it was already revoked (used or logged out) """
+    if not get_token_denylist().deny(refresh[api_settings.JTI_CLAIM], refresh["exp"]):
+        raise TokenError("Token is blacklisted")
+
+
+class RotatingTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    like TokenRefreshSerializer but tokens revoked in token denylist are rejected, and with ROTATE_REFRESH_TOKENS a
+    refresh token is accepted once, it is revoked when used
+    """
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            deny_refresh_token(refresh)
+        elif get_token_denylist().is_denied(refresh[api_settings.JTI_CLAIM]):
+            raise TokenError("Token is blacklisted")
+        data = {"access": str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data["refresh"] = str(refresh)
+        return data
+
+
+class LogoutSerializer(serializers.Serializer):
+    refresh = serializers.CharField()
+
+    def validate(self, attrs):
+        deny_refresh_token(RefreshToken(attrs["refresh"]))
+        return attrs
@@ -0,0 +1,65 @@
+""" contain signal receivers of users app """
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from users.caches import ban_cache, network_ban_index, user_snapshot_cache
+from users.existence import phone_existence_index
+from users.instrumentation import record_query
+from users.limiters import SIGN_IN, SIGN_UP
+from users.models import CustomUser, BannedFromSignIn, BannedFromSignUp, BannedNetwork, LimiterCounter
+from users.utils import set_sqlite_pragmas
+
+from samplino.settings import SQLITE_PRAGMAS
+
+
+@receiver(post_save, sender=BannedFromSignIn)
+@receiver(post_save, sender=BannedFromSignUp)
+def hold_ban_state(sender, instance, **kwargs):
+    """ bans are checked in LimiterCounter state, a ban saved out of the limiter (e.g. by admin) is copied there """
+    scope = SIGN_IN if sender is BannedFromSignIn else SIGN_UP
+    LimiterCounter.hold_ban(scope, [f"phone:{instance.phone_number}", f"ip:{instance.user_ip}"], instance.banned_until,
+                            timezone.now())
+
+
+@receiver(post_save, sender=BannedFromSignIn)
+@receiver(post_save, sender=BannedFromSignUp)
+def invalidate_ban_cache(sender, instance, **kwargs):
+    """ a ban saved out of the limiter (e.g. by admin) must not wait for cached "not banned" answers to expire """
+    scope = SIGN_IN if sender is BannedFromSignIn else SIGN_UP
+    ban_cache.invalidate(scope, instance.phone_number, instance.user_ip)
+
+
+@receiver(post_save, sender=BannedNetwork)
+def invalidate_network_ban_index(sender, instance, **kwargs):
+    """ a network ban is enforced at once in the process which saved it, others reload within NETWORK_BAN_REFRESH """
+    network_ban_index.invalidate(instance.scope)
+
+
+@receiver(post_save, sender=CustomUser)
+def add_to_existence_index(sender, instance, created, **kwargs):
+    """ a new user must never be answered as missing by phone_existence_index """
+    if created:
+        phone_existence_index.add(instance.phone_number)
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_user_snapshot(sender, instance, **kwargs):
+    """ a deactivated, deleted or changed user must not be authenticated from its old snapshot """
+    user_snapshot_cache.invalidate(instance.pk)
+
+
+@receiver(connection_created)
+def add_query_recorder(sender, connection, **kwargs):
+    """ queries of sampled requests are counted and timed on every connection, including ones of async views """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """ pragmas other than journal_mode only last as long as their connection, so every new one sets SQLITE_PRAGMAS """
+    if connection.vendor == "sqlite":
+        set_sqlite_pragmas(connection, SQLITE_PRAGMAS)
@@ -0,0 +1,172 @@
+""" contain sms providers and the dispatcher which sends queued sms with a pool of worker threads """
+import collections
+import logging
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from samplino.settings import (DEBUG, SMS_PROVIDER, SMS_WORKERS, SMS_QUEUE_SIZE, SMS_BATCH_SIZE, SMS_MAX_RETRIES,
+                               SMS_RETRY_BACKOFF)
+
+__all__ = ["SMSMessage", "SMSProviderError", "SMSQueueFull", "BaseSMSProvider", "FakeSMSProvider", "SMSDispatcher",
+           "get_sms_provider_class", "get_sms_dispatcher"]
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SMSMessage:
+    number: str
+    text: str
+    enqueued_at: float = 0.0
+
+
+class SMSProviderError(Exception):
+    """ raised by providers when a batch could not be sent and should be retried """
+
+
+class SMSQueueFull(Exception):
+    """ raised when the dispatcher queue is full and the sms was not accepted """
+
+
+class BaseSMSProvider:
+    """ base class of sms gateways """
+
+    def send_batch(self, messages: list):
+        """ will send all messages or raise SMSProviderError """
+        raise NotImplementedError
+
+
+class FakeSMSProvider(BaseSMSProvider):
+    """ local provider for development and tests, never sends anything and keeps the last `outbox_size` messages """
+
+    def __init__(self, delay: float = 0.0, failure_rate: float = 0.0, outbox_size: int = 1000):
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.outbox = collections.deque(maxlen=outbox_size)
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages: list):
+        time.sleep(self.delay)
+        if random.random() < self.failure_rate:
+            raise SMSProviderError("fake provider failure")
+        with self._lock:
+            self.outbox.extend(messages)
+
+
+class SMSDispatcher:
+    """
+    bounded queue of sms in front of a provider. `workers` threads take up to `batch_size` waiting messages at once
+    and send them as one batch, a failed batch is retried `max_retries` times with exponential backoff and jitter.
+    """
+
+    def __init__(self, provider: BaseSMSProvider, workers: int = SMS_WORKERS, queue_size: int = SMS_QUEUE_SIZE,
+                 batch_size: int = SMS_BATCH_SIZE, max_retries: int = SMS_MAX_RETRIES,
+                 retry_backoff: float = SMS_RETRY_BACKOFF):
+        self.provider = provider
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.counters = {"enqueued": 0, "rejected": 0, "sent": 0, "failed": 0, "retried": 0}
+        # seconds from enqueue to successful send
+        self.latency = {"count": 0, "sum": 0.0, "max": 0.0}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def enqueue(self, number: str, text: str):
+        """ will queue a sms without waiting, raise SMSQueueFull if queue is full """
+        self.start()
+        try:
+            self.queue.put_nowait(SMSMessage(number=number, text=text, enqueued_at=time.monotonic()))
+        except queue.Full:
+            self._count("rejected")
+            raise SMSQueueFull()
+        self._count("enqueued")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {"queue_depth": self.queue.qsize(), **self.counters,
+                    **{f"send_latency_{key}": value for key, value in self.latency.items()}}
+
+    def join(self):
+        """ will block until every queued sms is sent or given up """
+        self.queue.join()
+
+    def start(self):
+        """ will start worker threads on first use """
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"sms-worker-{number}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _send(self, batch: list):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.provider.send_batch(batch)
+            except Exception:
+                if attempt == self.max_retries:
+                    logger.exception("giving up sending %s sms", len(batch))
+                    self._count("failed", len(batch))
+                    return
+                self._count("retried", len(batch))
+                time.sleep(self.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+                continue
+            now = time.monotonic()
+            with self._lock:
+                self.counters["sent"] += len(batch)
+                for message in batch:
+                    latency = now - message.enqueued_at
+                    self.latency["count"] += 1
+                    self.latency["sum"] += latency
+                    self.latency["max"] = max(self.latency["max"], latency)
+            return
+
+
+def get_sms_provider_class() -> type:
+    """
+    will return class of configured SMS_PROVIDER, raise ImproperlyConfigured if it is unset or, without DEBUG, is
+    FakeSMSProvider which would silently drop every sms
+    """
+    if not SMS_PROVIDER:
+        raise ImproperlyConfigured("SMS_PROVIDER is not set")
+    provider_class = import_string(SMS_PROVIDER)
+    if not DEBUG and issubclass(provider_class, FakeSMSProvider):
+        raise ImproperlyConfigured(f"SMS_PROVIDER {SMS_PROVIDER} never sends sms, it is for DEBUG only")
+    return provider_class
+
+
+@lru_cache(maxsize=None)
+def get_sms_dispatcher() -> SMSDispatcher:
+    """ will return the dispatcher of configured SMS_PROVIDER """
+    return SMSDispatcher(provider=get_sms_provider_class()())
@@ -1,3 +1,1178 @@
-from django.test import TestCase
+import dataclasses
+import datetime
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.exceptions import AuthenticationFailed
+
+from users.authentication import CachedJWTAuthentication
+from users.buffers import TryBuffer
+from users.caches import UserSnapshotCache, ban_cache, network_ban_index, user_snapshot_cache
+from users.existence import PhoneExistenceIndex, phone_existence_index
+from users.hashing import HashingExecutor, HashingOverloaded, HashingUnavailable
+from users.imports import ImportReport, UserImporter, read_rows
+from users.instrumentation import recorder
+from users.limiters import SIGN_IN, SIGN_UP, MAX_BAN_LEVEL, CacheLimiterBackend, ban_duration, decayed_level
+from users.networks import NetworkSet, network_of
+from users.ratelimit import LocalRateStore, get_rate_limit_rules, get_rate_store
+from users.rollups import aggregate
+from users.serializers import PhoneNumberValidationSerializer, UserPhoneNumberSerializer
+from users.sms import (BaseSMSProvider, FakeSMSProvider, SMSDispatcher, SMSMessage, SMSProviderError, SMSQueueFull,
+                       get_sms_provider_class)
+from users.tokens import LocalTokenDenylist, get_token_denylist
+from users.utils import get_user_ip, user_exists
+from users.views import get_token_pair
+from users.models import (BannedFromSignIn, BannedNetwork, CustomUser, LimiterCounter, PhoneNumberValidation,
+                          TryRollup, UserPreRegister, UserSignInTry, UserSignUpTry)
+
+from samplino.settings import (BAN_ESCALATION_FACTOR, BAN_LEVEL_DECAY, BAN_MAX_DURATION, BAN_RETRY_DURATION,
+                               EXISTENCE_INDEX_RECENT_TTL, LIMITER_NETWORK_MAX_WRONG_RETRY, LIMITER_RETENTION,
+                               SMS_MAX_WRONG_RETRY, SQLITE_PRAGMAS)
+
+
+def reset_shared_state():
+    """ caches and in process states outlive a test, requests of one test must not be limited by another's """
+    for cache in caches.all():
+        cache.clear()
+    ban_cache.local.clear()
+    get_rate_store().states.clear()
+    network_ban_index.indexes.clear()
+    user_snapshot_cache.local.clear()
+    get_token_denylist.cache_clear()
+    phone_existence_index.bloom, phone_existence_index.loaded_at = None, -math.inf
+
+
+class ConcurrentBanEscalationTests(TransactionTestCase):
+    """ failed tries arriving at the same time must ban exactly once per SMS_MAX_WRONG_RETRY failures """
+    phone_number = "09120000000"
+
+    def fail_concurrently(self, count: int):
+        """ will add `count` failed tries of phone_number from as many threads (and ips) at once """
+        barrier = threading.Barrier(count)
+        errors = []
+
+        def fail(number):
+            try:
+                barrier.wait()
+                UserSignInTry.add_try(phone_number=self.phone_number, user_ip=f"10.0.{number // 256}.{number % 256}")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=fail, args=(number,)) for number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_below_threshold_does_not_ban(self):
+        self.fail_concurrently(SMS_MAX_WRONG_RETRY - 1)
+        self.assertFalse(BannedFromSignIn.objects.exists())
+        self.assertFalse(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip="10.1.1.1"))
+
+    def test_threshold_bans_once(self):
+        self.fail_concurrently(SMS_MAX_WRONG_RETRY)
+        self.assertEqual(BannedFromSignIn.objects.count(), 1)
+        self.assertTrue(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip="10.1.1.1"))
+
+    def test_just_below_second_ban_bans_once(self):
+        self.fail_concurrently(2 * SMS_MAX_WRONG_RETRY - 1)
+        self.assertEqual(BannedFromSignIn.objects.count(), 1)
+
+    def test_burst_bans_once_per_threshold(self):
+        count = 10 * SMS_MAX_WRONG_RETRY + 1
+        self.fail_concurrently(count)
+        self.assertEqual(BannedFromSignIn.objects.count(), count // SMS_MAX_WRONG_RETRY)
+        self.assertEqual(UserSignInTry.objects.count(), count)
+        counter = LimiterCounter.objects.get(key=f"phone:{self.phone_number}")
+        self.assertEqual(counter.failures, count % SMS_MAX_WRONG_RETRY)
+
+
+class SQLiteWriteContentionTests(TransactionTestCase):
+    """ transactions which read before they write (update_or_create, claims) queue for the lock instead of failing """
+    phone_numbers = ["09120000041", "09120000042"]
+
+    def setUp(self):
+        reset_shared_state()
+
+    def run_concurrently(self, func, count: int = 16) -> list:
+        """ will call func(number) from count threads at once, return what they raised or returned """
+        barrier = threading.Barrier(count)
+        results = []
+
+        def run(number):
+            try:
+                barrier.wait()
+                results.append(func(number))
+            except Exception as e:
+                results.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(number,)) for number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_send_registration_sms_never_fails(self):
+        # two requests per number, within the burst of the signup-phone rate limit
+        def send(number):
+            return Client().post(reverse("send_registration_sms"), {"phone_number": f"091200000{50 + number % 8}"},
+                                 REMOTE_ADDR=f"10.4.0.{number + 1}").status_code
+
+        self.assertEqual(set(self.run_concurrently(send)), {200})
+        self.assertEqual(PhoneNumberValidation.objects.count(), 8)
+
+    def test_confirm_and_escalate_never_fail(self):
+        for phone_number in self.phone_numbers:
+            PhoneNumberValidation.objects.create(phone_number=phone_number, last_sent_sms_code="123456",
+                                                 last_sent_sms_datetime=timezone.now())
+        UserSignInTry.add_try(phone_number=self.phone_numbers[0], user_ip="10.4.1.1")
+
+        def confirm_or_escalate(number):
+            if number % 2:
+                return PhoneNumberValidation.confirm_code(self.phone_numbers[number % 4 // 2], "123456",
+                                                          f"10.4.0.{number + 1}")
+            return LimiterCounter.escalate_ban(SIGN_IN, [f"phone:{self.phone_numbers[0]}", "ip:10.4.1.1"],
+                                               timezone.now())
+
+        results = self.run_concurrently(confirm_or_escalate)
+        self.assertEqual([result for result in results if isinstance(result, Exception)], [])
+        # each code is claimed once, each escalation got its own level
+        self.assertEqual(len([result for result in results if isinstance(result, str)]), 2)
+        self.assertEqual(LimiterCounter.objects.get(key="ip:10.4.1.1").ban_level, MAX_BAN_LEVEL)
+
+
+class RegistrationQueryCountTests(TestCase):
+    """ confirming a code and finishing registration claim their records with one conditional update """
+    phone_number = "09120000001"
+    code = "123456"
+
+    def setUp(self):
+        reset_shared_state()
+        network_ban_index.get(SIGN_UP)  # loaded once per NETWORK_BAN_REFRESH, not by every request
+        PhoneNumberValidation.objects.create(phone_number=self.phone_number, last_sent_sms_code=self.code,
+                                             last_sent_sms_datetime=timezone.now())
+
+    def confirm(self, code: str) -> dict:
+        response = self.client.post(reverse("confirm_registration_sms"),
+                                    {"phone_number": self.phone_number, "code": code})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def register(self, registration_id: str, username: str = "user"):
+        return self.client.post(reverse("finish_registration"),
+                                {"registration_id": registration_id, "username": username, "password": "password"})
+
+    def test_confirm_queries(self):
+        # ban check, then savepoint, claim, pre register upsert, success try, release
+        with self.assertNumQueries(6):
+            data = self.confirm(self.code)
+        self.assertTrue(data["success"])
+        self.assertEqual(len(data["registerId"]), 32)
+        self.assertTrue(UserPreRegister.objects.filter(unique_registration_id=data["registerId"]).exists())
+        self.assertTrue(PhoneNumberValidation.objects.get(phone_number=self.phone_number).is_validated)
+        self.assertTrue(UserSignUpTry.objects.get().is_success)
+
+    def test_wrong_code_queries(self):
+        # ban check, then savepoint, failed claim, release, failed try, limiter counter
+        with self.assertNumQueries(6):
+            data = self.confirm("654321")
+        self.assertFalse(data["success"])
+        self.assertFalse(UserPreRegister.objects.exists())
+        self.assertFalse(PhoneNumberValidation.objects.get(phone_number=self.phone_number).is_validated)
+        self.assertFalse(UserSignUpTry.objects.get().is_success)
+
+    def test_code_is_claimed_once(self):
+        self.assertTrue(self.confirm(self.code)["success"])
+        self.assertFalse(self.confirm(self.code)["success"])
+        self.assertEqual(UserPreRegister.objects.count(), 1)
+
+    def test_new_code_renews_pre_register(self):
+        first_id = self.confirm(self.code)["registerId"]
+        PhoneNumberValidation.objects.filter(phone_number=self.phone_number).update(is_validated=False)
+        second_id = self.confirm(self.code)["registerId"]
+        self.assertNotEqual(first_id, second_id)
+        self.assertEqual(UserPreRegister.objects.get().unique_registration_id, second_id)
+
+    def test_register_queries(self):
+        registration_id = self.confirm(self.code)["registerId"]
+        # serializer unique username check, pre register lookup, then savepoint, claim, user insert, release
+        with self.assertNumQueries(6):
+            response = self.register(registration_id)
+        self.assertEqual(response.status_code, 201)
+        user = CustomUser.objects.get(phone_number=self.phone_number)
+        self.assertTrue(user.check_password("password"))
+        self.assertTrue(UserPreRegister.objects.get().is_registered)
+
+    def test_registration_id_is_claimed_once(self):
+        registration_id = self.confirm(self.code)["registerId"]
+        self.assertEqual(self.register(registration_id).status_code, 201)
+        self.assertEqual(self.register(registration_id, username="another").status_code, 400)
+        self.assertEqual(CustomUser.objects.count(), 1)
+
+    def test_validation_has_no_queries(self):
+        CustomUser.objects.create_user(phone_number=self.phone_number, password="password")
+        with self.assertNumQueries(0):
+            self.assertTrue(PhoneNumberValidationSerializer(
+                data={"phone_number": self.phone_number, "code": self.code}).is_valid())
+            serializer = UserPhoneNumberSerializer(data={"phone_number": "0812345678"})
+            self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors["phone_number"], ["number you entered is invalid"])
+
+    def test_registered_number_is_not_registered_again(self):
+        registration_id = self.confirm(self.code)["registerId"]
+        CustomUser.objects.create_user(phone_number=self.phone_number, password="password")
+        response = self.register(registration_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"phone_number": ["user already registered"]})
+        # the claim was rolled back with the user insert
+        self.assertFalse(UserPreRegister.objects.get().is_registered)
+
+
+class InstrumentationTests(TestCase):
+    """ sampled requests record their stages and are exported in prometheus text format """
+
+    def setUp(self):
+        reset_shared_state()
+        self.sample_rate, recorder.sample_rate = recorder.sample_rate, 1.0
+        recorder.reset()
+
+    def tearDown(self):
+        recorder.sample_rate = self.sample_rate
+        recorder.reset()
+
+    def test_sign_in_stages(self):
+        CustomUser.objects.create_user(phone_number="09120000002", password="password")
+        response = self.client.post(reverse("token_sign_in"), {"phone_number": "09120000002", "password": "password"})
+        self.assertEqual(response.status_code, 200)
+        for name in ("total", "ban_check", "hash", "token", "db"):
+            self.assertIn(("token_sign_in", name), recorder.histograms)
+        self.assertGreater(recorder.requests["token_sign_in"][1], 0)
+
+        metrics = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn('samplino_stage_seconds_count{view="token_sign_in",stage="hash"} 1', metrics)
+        self.assertIn('samplino_sampled_requests_total{view="token_sign_in"} 1', metrics)
+        self.assertIn("samplino_hashing_pending 0", metrics)
+
+    def test_metrics_are_local_only(self):
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1").status_code, 404)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class HashingExecutorTests(TestCase):
+    """ HashingExecutor bounds pending hashes, survives a broken pool and never answers a missing user fast """
+
+    def setUp(self):
+        reset_shared_state()
+
+    def test_make_and_check_password(self):
+        executor = HashingExecutor(workers=0)
+        encoded = executor.make_password("password")
+        self.assertEqual(executor.check_password("password", encoded), (True, False))
+        self.assertEqual(executor.check_password("wrong", encoded), (False, False))
+        metrics = executor.metrics()
+        self.assertEqual((metrics["hashed"], metrics["hash_time_count"], metrics["pending"]), (3, 3, 0))
+
+    def test_overloaded_when_no_slot_gets_free(self):
+        executor = HashingExecutor(workers=0, max_pending=1, queue_timeout=0.01)
+        executor.slots.acquire()
+        with self.assertRaises(HashingOverloaded):
+            executor.make_password("password")
+        executor.slots.release()
+        self.assertEqual(executor.metrics()["rejected"], 1)
+        executor.make_password("password")
+        self.assertEqual(executor.metrics()["hashed"], 1)
+
+    def test_broken_pool_is_replaced(self):
+        executor = HashingExecutor(workers=1, max_pending=1)
+        pool = mock.Mock()
+        pool.submit.side_effect = pool.map.side_effect = BrokenProcessPool("a worker died")
+        for hash_passwords in (lambda: executor.make_password("password"), lambda: executor.make_passwords(["a"])):
+            executor._pool = pool
+            with self.assertRaises(HashingUnavailable):
+                hash_passwords()
+            self.assertIsNone(executor._pool)
+        self.assertEqual(pool.shutdown.call_count, 2)
+        # the slot is given back
+        self.assertTrue(executor.slots.acquire(blocking=False))
+
+    def test_dummy_wait_hashes_until_hashes_are_timed(self):
+        executor = HashingExecutor(workers=0)
+        with mock.patch("users.hashing.time.sleep") as sleep:
+            executor.dummy_wait("password")
+            sleep.assert_not_called()
+            self.assertEqual(executor.metrics()["hashed"], 1)
+
+            executor.dummy_wait("password")
+            metrics = executor.metrics()
+            sleep.assert_called_once_with(metrics["queue_time_sum"] + metrics["hash_time_sum"])
+            self.assertEqual(metrics["hashed"], 1)
+
+    def test_dummy_wait_holds_a_slot(self):
+        executor = HashingExecutor(workers=0, max_pending=1, queue_timeout=0.01)
+        executor.make_password("password")
+        with mock.patch("users.hashing.time.sleep", side_effect=lambda _: self.assertEqual(executor.pending, 1)):
+            executor.dummy_wait("password")
+        executor.slots.acquire()
+        with self.assertRaises(HashingOverloaded):
+            executor.dummy_wait("password")
+        self.assertEqual(executor.metrics()["rejected"], 1)
+
+    def test_unavailable_hashing_is_not_a_sign_in_try(self):
+        CustomUser.objects.create_user(phone_number="09120000004", password="password")
+        data = {"phone_number": "09120000004", "password": "password"}
+        overloaded = HashingExecutor(workers=0, max_pending=1, queue_timeout=0.01)
+        overloaded.slots.acquire()
+        broken = HashingExecutor(workers=1)
+        broken._pool = mock.Mock(**{"submit.side_effect": BrokenProcessPool("a worker died")})
+        for executor in (overloaded, broken):
+            with mock.patch("users.hashing.get_hashing_executor", return_value=executor):
+                self.assertEqual(self.client.post(reverse("token_sign_in"), data).status_code, 503)
+        self.assertFalse(UserSignInTry.objects.exists())
+
+    def test_overloaded_answer_does_not_tell_if_user_exists(self):
+        CustomUser.objects.create_user(phone_number="09120000004", password="password")
+        executor = HashingExecutor(workers=0, max_pending=1, queue_timeout=0.01)
+        # warm, so a missing user only waits
+        executor.make_password("password")
+        executor.slots.acquire()
+        with mock.patch("users.hashing.get_hashing_executor", return_value=executor):
+            statuses = [self.client.post(reverse("token_sign_in"), {"phone_number": phone_number,
+                                                                    "password": "wrong"}).status_code
+                        for phone_number in ("09120000004", "09120000005")]
+        self.assertEqual(statuses, [503, 503])
+        self.assertFalse(UserSignInTry.objects.exists())
+
+
+class TryBufferTests(TestCase):
+    """ TryBuffer writes buffered try records in bulk at exit and survives failures """
+
+    @staticmethod
+    def tries(count: int) -> list:
+        return [UserSignInTry(phone_number=f"0912000{number:04d}", user_ip="10.6.0.1", is_success=False)
+                for number in range(count)]
+
+    def test_flush_at_exit(self):
+        buffer = TryBuffer(flush_size=100, flush_interval=3600)
+        with mock.patch("users.buffers.atexit.register") as register:
+            for record in self.tries(2):
+                buffer.add(record)
+        register.assert_called_once_with(buffer.flush)
+        register.call_args.args[0]()
+        self.assertEqual(UserSignInTry.objects.count(), 2)
+
+    def test_failed_flush_keeps_records(self):
+        buffer = TryBuffer(flush_size=100, flush_interval=3600, max_size=2)
+        for record in self.tries(3):
+            buffer.add(record)
+        with mock.patch.object(UserSignInTry.objects, "bulk_create", side_effect=DatabaseError("locked")), \
+                self.assertLogs("users.buffers", "ERROR"):
+            buffer.flush()
+        # kept for the next flush, but not more than max_size
+        self.assertEqual(buffer.dropped, 1)
+        self.assertEqual(len(buffer.pending_failures(UserSignInTry, "", "10.6.0.1", 0)), 2)
+        buffer.flush()
+        self.assertEqual(sorted(UserSignInTry.objects.values_list("phone_number", flat=True)),
+                         ["09120000001", "09120000002"])
+
+
+@mock.patch("users.models.TRY_BUFFER_ENABLED", True)
+class TryBufferInTransactionTests(TestCase):
+    """ a buffer filled inside confirm_code's transaction is flushed after it commits, never inside it """
+    phone_number = "09120000042"
+
+    def setUp(self):
+        reset_shared_state()
+        PhoneNumberValidation.objects.create(phone_number=self.phone_number, last_sent_sms_code="123456",
+                                             last_sent_sms_datetime=timezone.now())
+        self.buffer = TryBuffer(flush_size=2, flush_interval=3600)
+        # records left in the buffer must not be flushed at exit, after the test database is gone
+        for patcher in (mock.patch("users.models.try_buffer", self.buffer),
+                        mock.patch("users.buffers.atexit.register")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def confirm(self):
+        return PhoneNumberValidation.confirm_code(phone_number=self.phone_number, code="123456", user_ip="10.6.0.2")
+
+    def test_flush_after_commit(self):
+        self.buffer.add(UserSignUpTry(phone_number=self.phone_number, user_ip="10.6.0.2", is_success=False))
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertIsNotNone(self.confirm())
+            self.assertFalse(UserSignUpTry.objects.exists())
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEqual(UserSignUpTry.objects.count(), 2)
+
+    def test_failed_flush_keeps_confirmation(self):
+        # is_success is not nullable, the flush of this record fails in the database
+        self.buffer.add(UserSignUpTry(phone_number=self.phone_number, user_ip="10.6.0.2", is_success=None))
+        with self.assertLogs("users.buffers", "ERROR"), self.captureOnCommitCallbacks(execute=True):
+            register_id = self.confirm()
+        self.assertTrue(UserPreRegister.objects.filter(unique_registration_id=register_id).exists())
+        self.assertTrue(PhoneNumberValidation.objects.get(phone_number=self.phone_number).is_validated)
+        self.assertEqual(len(self.buffer.pending_failures(UserSignUpTry, "", "10.6.0.2", 0)), 1)
+
+
+class TryBufferAutocommitTests(TransactionTestCase):
+    """ TryBuffer flushes in the calling thread out of a transaction, and from its flusher thread's connection """
+
+    def test_flush_when_full(self):
+        buffer = TryBuffer(flush_size=3, flush_interval=3600)
+        for record in TryBufferTests.tries(2):
+            buffer.add(record)
+        self.assertFalse(UserSignInTry.objects.exists())
+        self.assertEqual(len(buffer.pending_failures(UserSignInTry, "09120000000", "10.6.9.9", 0)), 1)
+        buffer.add(TryBufferTests.tries(3)[2])
+        self.assertEqual(UserSignInTry.objects.count(), 3)
+        self.assertEqual(buffer.pending_failures(UserSignInTry, "09120000000", "10.6.0.1", 0), [])
+
+    def test_flush_every_interval(self):
+        buffer = TryBuffer(flush_size=100, flush_interval=0.05)
+        buffer.add(UserSignInTry(phone_number="09120000001", user_ip="10.6.0.1", is_success=False))
+        for _ in range(100):
+            if UserSignInTry.objects.exists():
+                break
+            time.sleep(0.05)
+        self.assertEqual(UserSignInTry.objects.count(), 1)
+
+
+class SMSDispatcherTests(TestCase):
+    """ SMSDispatcher sends queued sms in batches, retries failed batches and rejects sms when its queue is full """
+
+    def setUp(self):
+        reset_shared_state()
+
+    def test_send(self):
+        provider = FakeSMSProvider()
+        dispatcher = SMSDispatcher(provider, workers=1, batch_size=10)
+        for number in range(3):
+            dispatcher.enqueue(number=f"0912000000{number}", text="code")
+        dispatcher.join()
+        self.assertEqual([message.number for message in provider.outbox], ["09120000000", "09120000001", "09120000002"])
+        metrics = dispatcher.metrics()
+        self.assertEqual((metrics["enqueued"], metrics["sent"], metrics["send_latency_count"], metrics["queue_depth"]),
+                         (3, 3, 3, 0))
+
+    def test_retry_with_backoff(self):
+        provider = mock.Mock(spec=BaseSMSProvider)
+        provider.send_batch.side_effect = [SMSProviderError("down"), SMSProviderError("down"), None]
+        dispatcher = SMSDispatcher(provider, workers=1, max_retries=3, retry_backoff=0.5)
+        with mock.patch("users.sms.time.sleep") as sleep, mock.patch("users.sms.random.uniform", return_value=1.0):
+            dispatcher.enqueue(number="09120000001", text="code")
+            dispatcher.join()
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.5, 1.0])
+        metrics = dispatcher.metrics()
+        self.assertEqual((metrics["retried"], metrics["sent"], metrics["failed"]), (2, 1, 0))
+
+    def test_give_up_after_max_retries(self):
+        provider = mock.Mock(spec=BaseSMSProvider)
+        provider.send_batch.side_effect = SMSProviderError("down")
+        dispatcher = SMSDispatcher(provider, workers=1, max_retries=2, retry_backoff=0)
+        with self.assertLogs("users.sms", "ERROR"):
+            dispatcher.enqueue(number="09120000001", text="code")
+            dispatcher.join()
+        self.assertEqual(provider.send_batch.call_count, 3)
+        metrics = dispatcher.metrics()
+        self.assertEqual((metrics["retried"], metrics["sent"], metrics["failed"]), (2, 0, 1))
+
+    def test_queue_full(self):
+        # no worker takes the queued sms
+        dispatcher = SMSDispatcher(FakeSMSProvider(), workers=0, queue_size=1)
+        dispatcher.enqueue(number="09120000001", text="code")
+        with self.assertRaises(SMSQueueFull):
+            dispatcher.enqueue(number="09120000002", text="code")
+        metrics = dispatcher.metrics()
+        self.assertEqual((metrics["enqueued"], metrics["rejected"], metrics["queue_depth"]), (1, 1, 1))
+
+        with mock.patch("users.utils.get_sms_dispatcher", return_value=dispatcher):
+            response = self.client.post(reverse("send_registration_sms"), {"phone_number": "09120000003"})
+        self.assertEqual(response.status_code, 503)
+
+    def test_fake_outbox_is_capped(self):
+        provider = FakeSMSProvider(outbox_size=2)
+        provider.send_batch([SMSMessage(number=f"0912000000{number}", text="code") for number in range(3)])
+        self.assertEqual([message.number for message in provider.outbox], ["09120000001", "09120000002"])
+
+    def test_provider_must_be_configured(self):
+        with mock.patch("users.sms.SMS_PROVIDER", None), self.assertRaises(ImproperlyConfigured):
+            get_sms_provider_class()
+        with mock.patch("users.sms.DEBUG", False):
+            with self.assertRaises(ImproperlyConfigured):
+                get_sms_provider_class()
+            with mock.patch("users.sms.SMS_PROVIDER", "users.sms.BaseSMSProvider"):
+                self.assertIs(get_sms_provider_class(), BaseSMSProvider)
+
+
+class AsyncViewTests(TransactionTestCase):
+    """ /user/async/ routes answer like their sync versions, committed data as they query from other threads """
+
+    def setUp(self):
+        reset_shared_state()
+        CustomUser.objects.create_user(phone_number="09120000008", password="password")
+
+    async def sign_in(self, password: str, view: str = "token_sign_in_async"):
+        return await self.async_client.post(reverse(view), {"phone_number": "09120000008", "password": password})
+
+    async def test_user_exists(self):
+        for phone_number, exist in (("09120000008", True), ("09120000009", False)):
+            response = await self.async_client.post(reverse("user_exists_async"), {"phone_number": phone_number})
+            self.assertEqual((response.status_code, response.json()), (200, {"exist": exist}))
+
+    async def test_sign_in(self):
+        response = await self.sign_in("password")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {"refresh", "access"})
+        self.assertEqual(await UserSignInTry.objects.acount(), 0)
+
+    async def test_wrong_password(self):
+        response = await self.sign_in("wrong")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {"detail": "No active account found with the given credentials",
+                                           "code": "no_active_account"})
+        self.assertEqual(response.json(), (await self.sign_in("wrong", view="token_sign_in")).json())
+        self.assertEqual(await UserSignInTry.objects.acount(), 2)
+
+    async def test_banned_after_wrong_passwords(self):
+        for _ in range(SMS_MAX_WRONG_RETRY):
+            self.assertEqual((await self.sign_in("wrong")).status_code, 401)
+        self.assertEqual((await self.sign_in("password")).status_code, 429)
+
+
+class RateLimitTests(TestCase):
+    """ RATE_LIMIT_RULES are enforced before views run """
+
+    def setUp(self):
+        reset_shared_state()
+
+    def test_phone_burst_then_limited(self):
+        rule = next(rule for rule in get_rate_limit_rules() if rule.name == "signup-phone")
+        data = {"phone_number": "09120000003"}
+        for _ in range(rule.burst):
+            self.assertEqual(self.client.post(reverse("send_registration_sms"), data).status_code, 200)
+        # answered before the view, which would ban (403) after SMS_MAX_WRONG_RETRY tries
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse("send_registration_sms"), data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(int(response["Retry-After"]), math.ceil(rule.interval))
+        # other phone_numbers are not limited by this rule (another ip, this one is banned by now)
+        response = self.client.post(reverse("send_registration_sms"), {"phone_number": "09120000004"},
+                                    REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(response.status_code, 200)
+
+    def test_gcra_refills_at_rate(self):
+        store = LocalRateStore()
+        interval, tolerance = 1.0, 2.0  # burst of 3
+        self.assertEqual([store.hit("key", interval, tolerance) > 0 for _ in range(4)], [False, False, False, True])
+        tat = store.states.get("key")
+        store.states.set("key", tat - interval, timeout=60)  # one interval later
+        self.assertEqual(store.hit("key", interval, tolerance), 0)
+        self.assertGreater(store.hit("key", interval, tolerance), 0)
+
+
+class NetworkBanTests(TestCase):
+    """ failures are aggregated per network and a banned network blocks all of its addresses """
+
+    def setUp(self):
+        reset_shared_state()
+
+    def test_network_set(self):
+        networks = NetworkSet(["10.0.0.0/24", "10.0.1.0/24", "192.168.1.7", "2001:db8::/64"])
+        self.assertEqual(len(networks), 3)  # the two /24s are merged
+        for address in ("10.0.0.0", "10.0.1.255", "192.168.1.7", "::ffff:10.0.0.9", "2001:db8::1"):
+            self.assertIn(address, networks)
+        for address in ("10.0.2.0", "192.168.1.8", "2001:db8:0:1::1", "::a00:1", "not an ip", ""):
+            self.assertNotIn(address, networks)
+
+    def test_network_of(self):
+        self.assertEqual(network_of("10.1.2.3"), "10.1.2.0/24")
+        self.assertEqual(network_of("::ffff:10.1.2.3"), "10.1.2.0/24")
+        self.assertEqual(network_of("2001:db8::1:2:3:4"), "2001:db8::/64")
+        self.assertIsNone(network_of("unknown"))
+
+    def test_rotating_addresses_ban_network(self):
+        for number in range(LIMITER_NETWORK_MAX_WRONG_RETRY):
+            self.assertFalse(BannedFromSignIn.is_banned(phone_number=f"0912{number:07d}", user_ip="10.2.3.1"))
+            UserSignInTry.add_try(phone_number=f"0912{number:07d}", user_ip=f"10.2.3.{number + 1}")
+        self.assertFalse(BannedFromSignIn.objects.exists())
+        self.assertEqual(BannedNetwork.objects.get().network, "10.2.3.0/24")
+        # the ban reloaded the index of this process, then addresses of the network are answered from it
+        self.assertTrue(BannedFromSignIn.is_banned(phone_number="09129999999", user_ip="10.2.3.200"))
+        with self.assertNumQueries(0):
+            self.assertTrue(BannedFromSignIn.is_banned(phone_number="09129999998", user_ip="10.2.3.201"))
+        self.assertFalse(BannedFromSignIn.is_banned(phone_number="09129999999", user_ip="10.2.4.1"))
+
+
+class UserIpTests(TestCase):
+    """ X-Forwarded-For is read from the right and only through TRUSTED_PROXIES """
+
+    def get_user_ip(self, remote_addr: str, forwarded_for: str = None) -> str:
+        headers = {"X-Forwarded-For": forwarded_for} if forwarded_for is not None else {}
+        return get_user_ip(RequestFactory().post("/", REMOTE_ADDR=remote_addr, headers=headers))
+
+    def test_untrusted_peer_ignores_header(self):
+        self.assertEqual(self.get_user_ip("10.0.0.1", "1.2.3.4"), "10.0.0.1")
+
+    def test_rightmost_untrusted_address(self):
+        self.assertEqual(self.get_user_ip("127.0.0.1", "1.2.3.4, 10.0.0.1"), "10.0.0.1")
+        self.assertEqual(self.get_user_ip("127.0.0.1", "1.2.3.4,10.0.0.1, 127.0.0.1"), "10.0.0.1")
+        self.assertEqual(self.get_user_ip("::1", "::ffff:10.0.0.1"), "10.0.0.1")
+
+    def test_chain_of_trusted_proxies(self):
+        self.assertEqual(self.get_user_ip("127.0.0.1"), "127.0.0.1")
+        self.assertEqual(self.get_user_ip("127.0.0.1", "127.0.0.1"), "127.0.0.1")
+        # an entry which is no address was not written by a proxy, the last trusted hop is used
+        self.assertEqual(self.get_user_ip("127.0.0.1", "1.2.3.4, forged, 127.0.0.1"), "127.0.0.1")
+
+    def test_resolved_once_per_request(self):
+        request = RequestFactory().post("/", REMOTE_ADDR="127.0.0.1", headers={"X-Forwarded-For": "10.0.0.1"})
+        self.assertEqual(get_user_ip(request), "10.0.0.1")
+        request.META["HTTP_X_FORWARDED_FOR"] = "10.0.0.2"
+        self.assertEqual(get_user_ip(request), "10.0.0.1")
+
+
+class SQLitePragmaTests(TestCase):
+    """ every new sqlite connection is tuned by SQLITE_PRAGMAS """
+
+    def test_new_connection_is_tuned(self):
+        new_connection = connections.create_connection("default")
+        try:
+            with new_connection.cursor() as cursor:
+                pragmas = {name: cursor.execute(f"PRAGMA {name}").fetchone()[0] for name in SQLITE_PRAGMAS}
+        finally:
+            new_connection.close()
+        self.assertEqual(pragmas["journal_mode"], "wal")
+        self.assertEqual(pragmas["busy_timeout"], SQLITE_PRAGMAS["busy_timeout"])
+        self.assertEqual(pragmas["synchronous"], 1)  # normal
+
+
+@mock.patch("users.views.REGISTRATION_CHALLENGE_ENABLED", True)
+class RegistrationChallengeTests(TestCase):
+    """ with REGISTRATION_CHALLENGE_ENABLED registration codes are verified from signed challenges """
+    phone_number = "09120000005"
+
+    def setUp(self):
+        reset_shared_state()
+        network_ban_index.get(SIGN_UP)
+
+    def send(self) -> str:
+        response = self.client.post(reverse("send_registration_sms"), {"phone_number": self.phone_number})
+        self.assertEqual(response.status_code, 200)
+        return response.json()["challenge"]
+
+    def confirm(self, challenge: str, code: str = "123456", phone_number: str = None) -> dict:
+        return self.client.post(reverse("confirm_registration_sms"), {
+            "phone_number": phone_number or self.phone_number, "code": code, "challenge": challenge}).json()
+
+    @mock.patch("users.caches.is_shared_cache", return_value=True)
+    def test_confirm_without_validation_records(self, _):
+        challenge = self.send()
+        # ban check is cached by send (one process, locmem is shared), then savepoint, pre register upsert, success
+        # try, release
+        with self.assertNumQueries(4):
+            data = self.confirm(challenge)
+        self.assertTrue(data["success"])
+        self.assertEqual(UserPreRegister.objects.get().unique_registration_id, data["registerId"])
+        self.assertFalse(PhoneNumberValidation.objects.exists())
+
+    def test_challenge_is_used_once(self):
+        challenge = self.send()
+        self.assertTrue(self.confirm(challenge)["success"])
+        self.assertFalse(self.confirm(challenge)["success"])
+
+    def test_challenge_is_bound_to_phone_number_and_code(self):
+        challenge = self.send()
+        self.assertFalse(self.confirm(challenge, code="654321")["success"])
+        self.assertFalse(self.confirm(challenge, phone_number="09120000006")["success"])
+        self.assertFalse(self.confirm(challenge[:-1] + ("A" if challenge[-1] != "A" else "B"))["success"])
+        self.assertFalse(UserPreRegister.objects.exists())
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    """ users of authenticated requests come from cached snapshots, dropped when the user is saved """
+
+    def setUp(self):
+        reset_shared_state()
+        self.user = CustomUser.objects.create_user(phone_number="09120000007", password="password")
+        self.authorization = f"Bearer {get_token_pair(self.user)['access']}"
+
+    def authenticate(self):
+        request = RequestFactory().get("/", headers={"Authorization": self.authorization})
+        return CachedJWTAuthentication().authenticate(request)[0]
+
+    def test_snapshot_is_cached(self):
+        with self.assertNumQueries(1):
+            self.authenticate()
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+        self.assertEqual((user.pk, user.phone_number, user.is_active), (self.user.pk, "09120000007", True))
+
+    def test_saved_user_is_reloaded(self):
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_user_saves_only_snapshot_fields(self):
+        user = self.authenticate()
+        user.username = "renamed"
+        user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.username, "renamed")
+        self.assertTrue(self.user.check_password("password"))
+
+    @mock.patch("users.caches.is_shared_cache", return_value=True)
+    def test_deactivation_reaches_other_processes(self, _):
+        # another process, same shared cache alias but its own in process tier
+        other = UserSnapshotCache(local_ttl=1)
+        with mock.patch("users.authentication.user_snapshot_cache", other):
+            self.authenticate()
+            self.user.is_active = False
+            self.user.save()
+            # its local copy is used for local_ttl seconds more, then the dropped shared snapshot is reloaded
+            self.assertTrue(self.authenticate().is_active)
+            with mock.patch("users.caches.time.monotonic", return_value=time.monotonic() + 1):
+                with self.assertRaises(AuthenticationFailed):
+                    self.authenticate()
+
+    def test_per_process_alias_is_not_used(self):
+        self.authenticate()
+        self.assertIsNone(caches[user_snapshot_cache.cache_alias].get(user_snapshot_cache.key(self.user.pk)))
+        # nor is a long in process ttl
+        self.assertEqual(UserSnapshotCache(local_ttl=60).local_ttl, 5)
+
+
+class TokenRotationTests(TestCase):
+    """ refresh tokens are used once and revoked by logout, without queries """
+
+    def setUp(self):
+        reset_shared_state()
+        self.tokens = get_token_pair(CustomUser.objects.create_user(phone_number="09120000008", password="password"))
+
+    def refresh(self, token: str):
+        return self.client.post(reverse("token_refresh"), {"refresh": token})
+
+    def test_refresh_rotates(self):
+        with self.assertNumQueries(0):
+            response = self.refresh(self.tokens["refresh"])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.json()["refresh"], self.tokens["refresh"])
+        self.assertEqual(self.refresh(self.tokens["refresh"]).status_code, 401)
+        self.assertEqual(self.refresh(response.json()["refresh"]).status_code, 200)
+
+    def test_logout_revokes_tokens(self):
+        authorization = {"Authorization": f"Bearer {self.tokens['access']}"}
+        response = self.client.post(reverse("token_logout"), {"refresh": self.tokens["refresh"]}, headers=authorization)
+        self.assertEqual(response.status_code, 205)
+        self.assertEqual(self.refresh(self.tokens["refresh"]).status_code, 401)
+        response = self.client.post(reverse("token_logout"), {"refresh": self.tokens["refresh"]}, headers=authorization)
+        self.assertEqual(response.status_code, 401)
+
+    def test_local_denylist_evicts_expired(self):
+        denylist = LocalTokenDenylist()
+        self.assertTrue(denylist.deny("expired", time.time() - 1))
+        self.assertTrue(denylist.deny("live", time.time() + 60))
+        self.assertFalse(denylist.deny("live", time.time() + 60))
+        self.assertEqual(set(denylist.expires), {"live"})
+        self.assertTrue(denylist.is_denied("live"))
+        self.assertFalse(denylist.is_denied("expired"))
+
+
+class UserImportTests(TestCase):
+    """ users are imported in chunks, rejected rows are reported and an import resumes from its checkpoint """
+    rows = ("phone_number,username,password,password_hash\n"
+            "09120000011,,secret,\n"
+            "09120000012,hashed,,{hash}\n"
+            "0812,,,\n"
+            "09120000011,,,\n"
+            "09120000010,,,\n"
+            "09120000013,,,\n")
+
+    def setUp(self):
+        reset_shared_state()
+        CustomUser.objects.create_user(phone_number="09120000010", password="password")
+        self.rows = self.rows.format(hash=make_password("hashed-secret"))
+
+    def test_import(self):
+        report = UserImporter(chunk_size=2).run(read_rows(io.StringIO(self.rows), "csv"))
+        self.assertEqual((report.rows, report.created, report.existing, report.duplicate, report.invalid),
+                         (6, 3, 1, 1, 1))
+        self.assertEqual(report.errors, [(3, "invalid phone_number"), (4, "duplicate in import"),
+                                         (5, "already registered")])
+        self.assertTrue(CustomUser.objects.get(phone_number="09120000011").check_password("secret"))
+        self.assertTrue(CustomUser.objects.get(username="hashed").check_password("hashed-secret"))
+        self.assertFalse(CustomUser.objects.get(phone_number="09120000013").has_usable_password())
+        self.assertTrue(phone_existence_index.might_exist("09120000013"))
+
+    def test_command_resumes_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.csv")
+            with open(path, "w") as file:
+                file.write(self.rows)
+            with open(f"{path}.checkpoint", "w") as file:
+                json.dump({"source": {"path": path, "size": os.path.getsize(path)},
+                           "report": dataclasses.asdict(ImportReport(rows=2, created=2, last_row=2))}, file)
+            call_command("import_users", path, stdout=io.StringIO())
+            self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+        # rows 1 and 2 count as imported by the interrupted run, 09120000011 of row 4 is no duplicate of this one
+        self.assertEqual(set(CustomUser.objects.values_list("phone_number", flat=True)),
+                         {"09120000010", "09120000011", "09120000013"})
+
+    def test_api_is_for_staff(self):
+        user = CustomUser.objects.create_user(phone_number="09120000014", username="staff", password="password")
+        upload = {"file": SimpleUploadedFile("users.jsonl", b'{"phone_number": "09120000015"}\n')}
+        authorization = {"Authorization": f"Bearer {get_token_pair(user)['access']}"}
+        self.assertEqual(self.client.post(reverse("user_import"), upload, headers=authorization).status_code, 403)
+        CustomUser.objects.filter(pk=user.pk).update(is_staff=True)
+        user_snapshot_cache.invalidate(user.pk)
+        upload["file"].seek(0)
+        response = self.client.post(reverse("user_import"), upload, headers=authorization)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["created"], 1)
+        self.assertTrue(CustomUser.objects.filter(phone_number="09120000015").exists())
+
+
+class TryRollupTests(TestCase):
+    """ tries and bans are rolled up from cursors, analytics and purge work with the rollups """
+
+    def setUp(self):
+        reset_shared_state()
+        self.add_tries([("09120000021", "10.0.0.1", False)] * 3 + [("09120000022", "10.0.0.2", False),
+                                                                  ("09120000022", "10.0.0.2", True)])
+        BannedFromSignIn.objects.create(phone_number="09120000021", user_ip="10.0.0.1", banned_until=timezone.now())
+
+    @staticmethod
+    def add_tries(tries: list, age=datetime.timedelta(minutes=5)):
+        created = [UserSignInTry.objects.create(phone_number=phone_number, user_ip=ip, is_success=is_success)
+                   for phone_number, ip, is_success in tries]
+        UserSignInTry.objects.filter(pk__in=[record.pk for record in created]).update(created=timezone.now() - age)
+
+    def test_aggregate_incrementally(self):
+        self.assertEqual(aggregate("signin_tries", 10, batch_size=2), 5)
+        self.assertEqual(aggregate("signin_tries", 10, batch_size=2), 0)
+        # not old enough, a transaction which took an earlier id may still be writing
+        self.add_tries([("09120000021", "10.0.0.1", False)], age=datetime.timedelta())
+        self.assertEqual(aggregate("signin_tries", 10), 0)
+        self.add_tries([("09120000023", "10.0.0.1", False)])
+        self.assertEqual(aggregate("signin_tries", 10), 2)
+        # tries of a few minutes ago and of now may be in two hourly buckets
+        rollups = TryRollup.objects.filter(scope=SIGN_IN, kind="ip", key="10.0.0.1")
+        self.assertEqual([sum(values) for values in zip(*rollups.values_list("failures", "successes"))], [5, 0])
+        self.assertEqual(sum(TryRollup.objects.filter(kind="all").values_list("failures", flat=True)), 6)
+
+    def test_purge_keeps_records_not_rolled_up(self):
+        UserSignInTry.objects.update(created=timezone.now() - datetime.timedelta(days=30))
+        call_command("purge_limiter_records", stdout=io.StringIO())
+        self.assertEqual(UserSignInTry.objects.count(), 5)
+        self.assertEqual(BannedFromSignIn.objects.count(), 1)
+        call_command("rollup_tries", lag=0, stdout=io.StringIO())
+        call_command("purge_limiter_records", stdout=io.StringIO())
+        self.assertFalse(UserSignInTry.objects.exists())
+        self.assertFalse(BannedFromSignIn.objects.exists())
+
+    def test_analytics_read_rollups_only(self):
+        call_command("rollup_tries", lag=0, stdout=io.StringIO())
+        user = CustomUser.objects.create_user(phone_number="09120000024", password="password", is_staff=True)
+        headers = {"Authorization": f"Bearer {get_token_pair(user)['access']}"}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("suspicious_activity"), {"kind": "ip"}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if "usersignintry" in query["sql"].lower()])
+        top = response.json()["top"]
+        self.assertEqual(top[0], {"key": "10.0.0.1", "failures": 3, "successes": 0, "bans": 1})
+        self.assertEqual(top[1]["key"], "10.0.0.2")
+        self.assertEqual(sum(bucket["failures"] for bucket in response.json()["series"]), 4)
+        CustomUser.objects.filter(pk=user.pk).update(is_staff=False)
+        user_snapshot_cache.invalidate(user.pk)
+        self.assertEqual(self.client.get(reverse("suspicious_activity"), headers=headers).status_code, 403)
+
+
+@mock.patch("users.management.commands.purge_limiter_records.ROLLUPS_ENABLED", False)
+class PurgeLimiterRecordsTests(TestCase):
+    """ purge_limiter_records deletes expired records in bounded batches and keeps the ones still needed """
+
+    def setUp(self):
+        now = timezone.now()
+        for age, count in ((LIMITER_RETENTION + datetime.timedelta(hours=1), 5),
+                           (LIMITER_RETENTION - datetime.timedelta(hours=1), 2)):
+            created = [UserSignInTry.objects.create(phone_number="09120000041", user_ip="10.4.0.1", is_success=False)
+                       for _ in range(count)]
+            UserSignInTry.objects.filter(pk__in=[record.pk for record in created]).update(created=now - age)
+        for banned_until in (now - datetime.timedelta(minutes=1), now + BAN_RETRY_DURATION):
+            BannedFromSignIn.objects.create(phone_number="09120000041", user_ip="10.4.0.1", banned_until=banned_until)
+
+    @staticmethod
+    def purge(**options) -> str:
+        stdout = io.StringIO()
+        call_command("purge_limiter_records", sleep=0, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_purge_in_batches(self):
+        with CaptureQueriesContext(connection) as queries:
+            output = self.purge(batch_size=2)
+        self.assertIn("UserSignInTry: deleted 5 records", output)
+        self.assertIn("BannedFromSignIn: deleted 1 records", output)
+        deletes = [query for query in queries if query["sql"].startswith('DELETE FROM "users_usersignintry"')]
+        self.assertEqual(len(deletes), 3)
+        # tries inside LIMITER_RETENTION and the active ban are kept
+        self.assertEqual(UserSignInTry.objects.count(), 2)
+        self.assertGreater(BannedFromSignIn.objects.get().banned_until, timezone.now())
+
+    def test_max_batches(self):
+        self.assertIn("UserSignInTry: deleted 4 records", self.purge(batch_size=2, max_batches=2))
+        self.assertEqual(UserSignInTry.objects.count(), 3)
+        # the next run continues
+        self.assertIn("UserSignInTry: deleted 1 records", self.purge(batch_size=2, max_batches=2))
+        self.assertEqual(UserSignInTry.objects.count(), 2)
+
+
+class ProgressiveBanTests(TestCase):
+    """ bans of a key escalate and decay in its LimiterCounter record, which ban checks read """
+    phone_number = "09120000031"
+    user_ip = "10.3.0.1"
+
+    def setUp(self):
+        reset_shared_state()
+
+    def ban(self) -> LimiterCounter:
+        for _ in range(SMS_MAX_WRONG_RETRY):
+            UserSignInTry.add_try(phone_number=self.phone_number, user_ip=self.user_ip)
+        return LimiterCounter.objects.get(scope=SIGN_IN, key=f"phone:{self.phone_number}")
+
+    def end_ban(self, ago: datetime.timedelta):
+        LimiterCounter.objects.filter(banned_until__isnull=False).update(banned_until=timezone.now() - ago)
+
+    def test_ban_durations(self):
+        self.assertEqual(ban_duration(1), BAN_RETRY_DURATION)
+        self.assertEqual(ban_duration(2), BAN_RETRY_DURATION * BAN_ESCALATION_FACTOR)
+        self.assertEqual(ban_duration(MAX_BAN_LEVEL), BAN_MAX_DURATION)
+        self.assertLess(ban_duration(MAX_BAN_LEVEL - 1), BAN_MAX_DURATION)
+        now = timezone.now()
+        self.assertEqual(decayed_level(3, now + BAN_LEVEL_DECAY, now), 3)
+        self.assertEqual(decayed_level(3, now - BAN_LEVEL_DECAY * 2, now), 1)
+        self.assertEqual(decayed_level(3, now - BAN_LEVEL_DECAY * 5, now), 0)
+
+    def test_repeat_bans_escalate_in_place(self):
+        counter = self.ban()
+        self.assertEqual(counter.ban_level, 1)
+        self.assertTrue(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip="10.3.9.9"))
+        self.end_ban(datetime.timedelta(minutes=1))
+        counter = self.ban()
+        self.assertEqual(counter.ban_level, 2)
+        self.assertAlmostEqual(counter.banned_until - timezone.now(), ban_duration(2),
+                               delta=datetime.timedelta(minutes=1))
+        self.assertEqual(LimiterCounter.objects.get(key=f"ip:{self.user_ip}").ban_level, 2)
+        # phone, ip and network records, updated in place
+        self.assertEqual(LimiterCounter.objects.count(), 3)
+        self.assertEqual(BannedFromSignIn.objects.count(), 2)
+
+    def test_levels_decay(self):
+        self.ban()
+        LimiterCounter.objects.filter(banned_until__isnull=False).update(ban_level=3)
+        self.end_ban(BAN_LEVEL_DECAY * 2 + datetime.timedelta(minutes=1))
+        self.assertEqual(self.ban().ban_level, 2)
+
+    def test_ban_uses_failures_of_phone_number_and_ip(self):
+        UserSignInTry.add_try(phone_number="09120000032", user_ip=self.user_ip)
+        for _ in range(SMS_MAX_WRONG_RETRY - 1):
+            UserSignInTry.add_try(phone_number=self.phone_number, user_ip=self.user_ip)
+        # the ip crossed the threshold, failures of the phone_number were used by its ban too
+        self.assertEqual(BannedFromSignIn.objects.count(), 1)
+        self.assertEqual(LimiterCounter.objects.get(key=f"ip:{self.user_ip}").failures, 0)
+        self.assertEqual(LimiterCounter.objects.get(key=f"phone:{self.phone_number}").failures, 0)
+        self.end_ban(datetime.timedelta(minutes=1))
+        for _ in range(SMS_MAX_WRONG_RETRY - 1):
+            UserSignInTry.add_try(phone_number=self.phone_number, user_ip="10.3.0.2")
+        self.assertEqual(BannedFromSignIn.objects.count(), 1)
+
+    def test_ban_saved_out_of_limiter_is_checked(self):
+        BannedFromSignIn.objects.create(phone_number=self.phone_number, user_ip=self.user_ip,
+                                        banned_until=timezone.now() + BAN_RETRY_DURATION)
+        self.assertTrue(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip="10.3.9.9"))
+        self.assertTrue(BannedFromSignIn.is_banned(phone_number="09120000032", user_ip=self.user_ip))
+        self.assertFalse(BannedFromSignIn.is_banned(phone_number="09120000032", user_ip="10.3.9.9"))
+
+    def test_purge_keeps_ban_levels(self):
+        self.ban()
+        LimiterCounter.objects.update(window_start=timezone.now() - datetime.timedelta(days=30))
+        self.end_ban(BAN_LEVEL_DECAY)
+        call_command("purge_limiter_records", stdout=io.StringIO())
+        # the network was not banned, its counter is gone
+        self.assertEqual(LimiterCounter.objects.count(), 2)
+        self.end_ban(BAN_LEVEL_DECAY * MAX_BAN_LEVEL + datetime.timedelta(minutes=1))
+        call_command("purge_limiter_records", stdout=io.StringIO())
+        self.assertFalse(LimiterCounter.objects.exists())
+
+    def test_cache_backend_escalates(self):
+        limiter = CacheLimiterBackend()
+        keys = [("phone", self.phone_number), ("ip", self.user_ip)]
+        for level in (1, 2):
+            limiter.ban(SIGN_IN, keys, 0)
+            self.assertEqual(limiter.cache.get(limiter.level_key(SIGN_IN, "ip", self.user_ip))[0], level)
+        self.assertTrue(limiter.is_banned(SIGN_IN, self.phone_number, "10.3.9.9"))
+
+
+class CacheLimiterBackendTests(TestCase):
+    """ CacheLimiterBackend counts failures of a sliding window estimated from two buckets and bans in the cache """
+    phone_number = "09120000035"
+    user_ip = "10.3.5.1"
+
+    def setUp(self):
+        reset_shared_state()
+        self.limiter = CacheLimiterBackend(window=datetime.timedelta(hours=1), max_wrong_retry=3,
+                                           base_ban_duration=datetime.timedelta(minutes=10))
+        # start of a bucket, later than now so keys set at it have not expired outside of at()
+        self.start = math.ceil(time.time() / 3600) * 3600
+
+    def at(self, seconds: float):
+        """ moves time of buckets and of cache expiry to seconds after start """
+        return mock.patch("time.time", return_value=self.start + seconds)
+
+    def add_tries(self, count: int, seconds: float = 0, phone_number: str = phone_number):
+        with self.at(seconds):
+            for _ in range(count):
+                self.limiter.add_try(SIGN_IN, phone_number, self.user_ip)
+
+    def is_banned(self, seconds: float = 0, phone_number: str = phone_number, user_ip: str = user_ip) -> bool:
+        with self.at(seconds):
+            return self.limiter.is_banned(SIGN_IN, phone_number, user_ip)
+
+    def test_ban_at_threshold(self):
+        self.add_tries(2)
+        with self.at(0):
+            self.limiter.add_try(SIGN_IN, self.phone_number, self.user_ip, is_success=True)
+        self.assertFalse(self.is_banned())
+        self.add_tries(1)
+        self.assertTrue(self.is_banned(phone_number="09120000036"))
+        self.assertTrue(self.is_banned(user_ip="10.3.9.9"))
+        self.assertFalse(self.is_banned(phone_number="09120000036", user_ip="10.3.9.9"))
+
+    def test_previous_bucket_counts_for_unpassed_part_of_window(self):
+        self.add_tries(2)
+        # half of previous bucket counts: 1 + 2 * 0.5
+        self.add_tries(1, 3600 * 1.5, phone_number="09120000036")
+        self.assertFalse(self.is_banned(3600 * 1.5))
+        self.add_tries(1, 3600 * 1.5)
+        self.assertTrue(self.is_banned(3600 * 1.5, user_ip="10.3.9.9"))
+
+    def test_window_rolls_over(self):
+        self.add_tries(2)
+        # two windows later both buckets are newer than these tries
+        self.add_tries(2, 3600 * 2)
+        self.assertFalse(self.is_banned(3600 * 2))
+
+    def test_ban_expires(self):
+        self.add_tries(3)
+        self.assertTrue(self.is_banned(599))
+        self.assertFalse(self.is_banned(601))
+        # counters were reset by the ban
+        self.add_tries(2, 601)
+        self.assertFalse(self.is_banned(601))
+
+
+@mock.patch("users.existence.is_shared_cache", return_value=True)
+class PhoneExistenceIndexTests(TestCase):
+    """ "not registered" is answered only from a published filter of a shared cache, never built by a request """
+    phone_number = "09120000061"
+
+    def setUp(self):
+        reset_shared_state()
+        CustomUser.objects.create_user(phone_number=self.phone_number, password="password")
+
+    def test_rebuild_publishes_filter(self, _):
+        call_command("rebuild_existence_index", stdout=io.StringIO())
+        # another process loads the published filter
+        index = PhoneExistenceIndex()
+        with self.assertNumQueries(0):
+            self.assertTrue(index.might_exist(self.phone_number))
+            self.assertFalse(index.might_exist("09120000062"))
+
+    def test_user_created_after_rebuild_exists(self, _):
+        phone_existence_index.rebuild()
+        index = PhoneExistenceIndex()
+        self.assertFalse(index.might_exist("09120000062"))
+        CustomUser.objects.create_user(phone_number="09120000062", username="09120000062", password="password")
+        # this process added it to its copy, another one finds its recent key
+        self.assertTrue(phone_existence_index.might_exist("09120000062"))
+        self.assertTrue(index.might_exist("09120000062"))
+        self.assertTrue(user_exists("09120000062"))
+
+    def test_false_positive_asks_database(self, _):
+        phone_existence_index.rebuild()
+        phone_existence_index.bloom.add("09120000063")
+        with self.assertNumQueries(1):
+            self.assertFalse(user_exists("09120000063"))
+
+    def test_without_usable_filter_asks_database(self, is_shared_cache):
+        with self.assertNumQueries(1):
+            self.assertFalse(user_exists("09120000062"))
+        # a filter older than the recent keys of users created after it
+        bloom = phone_existence_index.rebuild()
+        caches["default"].set(PhoneExistenceIndex.bloom_key,
+                              (time.time() - EXISTENCE_INDEX_RECENT_TTL, bloom.to_bytes()))
+        self.assertIsNone(PhoneExistenceIndex().get_bloom())
+        phone_existence_index.rebuild()
+        is_shared_cache.return_value = False
+        with self.assertNumQueries(1):
+            self.assertFalse(user_exists("09120000062"))
+
+
+@mock.patch("users.caches.is_shared_cache", return_value=True)
+class BanCacheTests(TestCase):
+    """ a ban is enforced at once, whatever "not banned" answers were cached before it """
+    phone_number = "09120000071"
+    user_ip = "10.7.0.1"
+
+    def setUp(self):
+        reset_shared_state()
+
+    def ban(self):
+        BannedFromSignIn.objects.create(phone_number=self.phone_number, user_ip=self.user_ip,
+                                        banned_until=timezone.now() + BAN_RETRY_DURATION)
+
+    def test_ban_after_cached_negative(self, _):
+        self.assertFalse(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip=self.user_ip))
+        with self.assertNumQueries(0):
+            self.assertFalse(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip=self.user_ip))
+        self.ban()
+        self.assertTrue(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip=self.user_ip))
+
+    def test_late_negative_after_versions_would_have_expired(self, _):
+        # a request read versions before the ban, and stores its "not banned" answer long after it
+        _, versions = ban_cache.get(SIGN_IN, self.phone_number, self.user_ip)
+        self.ban()
+        later = time.time() + ban_cache.negative_ttl * 10
+        with mock.patch("django.core.cache.backends.locmem.time.time", return_value=later):
+            ban_cache.set(SIGN_IN, self.phone_number, self.user_ip, None, versions)
+            self.assertIsNone(ban_cache.get(SIGN_IN, self.phone_number, self.user_ip)[0])
+            self.assertTrue(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip=self.user_ip))
+
+    def test_per_process_cache_keeps_no_negatives(self, is_shared_cache):
+        is_shared_cache.return_value = False
+        self.assertFalse(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip=self.user_ip))
+        with self.assertNumQueries(1):
+            self.assertFalse(BannedFromSignIn.is_banned(phone_number=self.phone_number, user_ip=self.user_ip))
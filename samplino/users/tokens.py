@@ -0,0 +1,83 @@
+""" contain the denylist of revoked (rotated or logged out) JWTs, keyed by their jti """
+import heapq
+import threading
+import time
+from functools import lru_cache
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from samplino.settings import TOKEN_DENYLIST_BACKEND, TOKEN_DENYLIST_ALIAS
+
+__all__ = ["BaseTokenDenylist", "LocalTokenDenylist", "CacheTokenDenylist", "get_token_denylist"]
+
+
+class BaseTokenDenylist:
+    """
+    base of denylists, a jti is kept until `expires_at` (unix time), the exp claim of its token, after which the
+    token is rejected by its signature anyway
+    """
+
+    def deny(self, jti: str, expires_at: float) -> bool:
+        """ will deny jti and return True, or False if it was already denied. atomic, a jti is claimed once """
+        raise NotImplementedError
+
+    def is_denied(self, jti: str) -> bool:
+        raise NotImplementedError
+
+
+class LocalTokenDenylist(BaseTokenDenylist):
+    """
+    denylist of this process only, a dict of jti -> expiry with a heap of expiries, expired jtis are evicted on every
+    deny. with more than one process a token revoked in one is still accepted by the others, use CacheTokenDenylist
+    """
+
+    def __init__(self):
+        self.expires = {}
+        self.heap = []
+        self._lock = threading.Lock()
+
+    def deny(self, jti: str, expires_at: float) -> bool:
+        now = time.time()
+        with self._lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, expired = heapq.heappop(self.heap)
+                if self.expires.get(expired, now + 1) <= now:
+                    del self.expires[expired]
+            if self.expires.get(jti, 0) > now:
+                return False
+            self.expires[jti] = expires_at
+            heapq.heappush(self.heap, (expires_at, jti))
+            return True
+
+    def is_denied(self, jti: str) -> bool:
+        return self.expires.get(jti, 0) > time.time()
+
+
+class CacheTokenDenylist(BaseTokenDenylist):
+    """ denylist shared through TOKEN_DENYLIST_ALIAS cache, an entry lives as long as its token """
+
+    def __init__(self, cache_alias: str = TOKEN_DENYLIST_ALIAS):
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def key(jti: str) -> str:
+        return f"denylist:{jti}"
+
+    def deny(self, jti: str, expires_at: float) -> bool:
+        timeout = expires_at - time.time()
+        if timeout <= 0:
+            return True
+        return self.cache.add(self.key(jti), True, timeout=int(timeout) + 1)
+
+    def is_denied(self, jti: str) -> bool:
+        return self.cache.get(self.key(jti)) is not None
+
+
+@lru_cache(maxsize=None)
+def get_token_denylist() -> BaseTokenDenylist:
+    return import_string(TOKEN_DENYLIST_BACKEND)()
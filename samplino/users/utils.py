@@ -1,15 +1,29 @@
 """ contain utility functions """
+import ipaddress
 import random
 import string
 
-from samplino.settings import REGISTRATION_SMS_CODE_LENGTH
+from asgiref.sync import sync_to_async
 
-__all__ = ["send_registration_code", "get_user_ip"]
+from users.existence import phone_existence_index
+from users.instrumentation import stage
+from users.networks import NetworkSet
+from users.models import CustomUser
+from users.sms import get_sms_dispatcher
+
+from samplino.settings import (REGISTRATION_SMS_CODE_LENGTH, REGISTRATION_SMS_TEXT, EXISTENCE_INDEX_ENABLED,
+                               TRUSTED_PROXIES)
+
+__all__ = ["send_registration_code", "get_user_ip", "user_exists", "auser_exists", "set_sqlite_pragmas"]
+
+# parsed once, checking an address is a binary search
+trusted_proxies = NetworkSet(TRUSTED_PROXIES)
 
 
 def send_sms_in_an_awesome_and_async_manner(sms_code, sms_number):
-    """ will do as thr name state """
-    ...
+    """ will do as thr name state, it only queues the sms and raise SMSQueueFull if dispatcher is overloaded """
+    with stage("sms_enqueue"):
+        get_sms_dispatcher().enqueue(number=sms_number, text=REGISTRATION_SMS_TEXT.format(code=sms_code))
 
 
 def generate_random_code(length) -> str:
@@ -26,8 +40,45 @@ def send_registration_code(phone_number) -> str:
 
 
 def get_user_ip(request) -> str:
-    """will parse a request Meta for user ip and return user_ip"""
-    if request.META.get('HTTP_X_FORWARDED_FOR', False):
-        return request.META['HTTP_X_FORWARDED_FOR'].split(',')[0]
-    return request.META.get('REMOTE_ADDR')
+    """
+    will return ip of the client, the first address of X-Forwarded-For which is not a trusted proxy when read from the
+    right (REMOTE_ADDR being the rightmost). entries left of it can be forged by the client and are ignored. the
+    result is kept on the request, every limiter call of a request gets it for free.
+    """
+    request = getattr(request, "_request", request)  # rest_framework Request
+    try:
+        return request.user_ip
+    except AttributeError:
+        pass
+    user_ip = request.META.get('REMOTE_ADDR')
+    if user_ip in trusted_proxies:
+        for address in reversed(request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+            try:
+                address = ipaddress.ip_address(address.strip())
+            except ValueError:  # not written by a trusted proxy, last trusted hop is the best we know
+                break
+            user_ip = str(address.ipv4_mapped or address) if address.version == 6 else str(address)
+            if user_ip not in trusted_proxies:
+                break
+    request.user_ip = user_ip
+    return user_ip
+
+
+def user_exists(phone_number: str) -> bool:
+    """ will check if a user is registered with phone_number, asking database only if existence index is not sure """
+    if EXISTENCE_INDEX_ENABLED and not phone_existence_index.might_exist(phone_number):
+        return False
+    return CustomUser.objects.filter(phone_number=phone_number).exists()
+
+
+async def auser_exists(phone_number: str) -> bool:
+    """ async version of user_exists """
+    if EXISTENCE_INDEX_ENABLED and not await sync_to_async(phone_existence_index.might_exist)(phone_number):
+        return False
+    return await CustomUser.objects.filter(phone_number=phone_number).aexists()
+
 
+def set_sqlite_pragmas(connection, pragmas: dict):
+    """ will run `PRAGMA name = value` of every item on the raw sqlite connection, unseen by query capturing """
+    for name, value in pragmas.items():
+        connection.connection.execute(f"PRAGMA {name} = {value}")
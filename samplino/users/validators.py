@@ -1,9 +1,14 @@
+import re
+
 from django.core.validators import RegexValidator
 from django.utils.translation import gettext_lazy as _
 
-__all__ = ["phone_number_regex_validator"]
+__all__ = ["PHONE_NUMBER_PATTERN", "phone_number_regex_validator"]
+
+PHONE_NUMBER_PATTERN = re.compile(r"^09[0-3,9]\d{8}$")
 
-phone_number_regex_validator = RegexValidator(regex=r"^09[0-3,9]\d{8}$",
+# given the pattern string, a compiled one would change the migration state of CustomUser.phone_number
+phone_number_regex_validator = RegexValidator(regex=PHONE_NUMBER_PATTERN.pattern,
                                               message=_("number you entered is invalid"),
                                               code="invalid number")
 
@@ -1,16 +1,42 @@
+import codecs
+import dataclasses
+import datetime
+import os
+
+from django.contrib.auth.models import update_last_login
+from django.http import HttpResponse, Http404
+from django.utils import timezone
+
 from rest_framework.generics import CreateAPIView
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-from rest_framework_simplejwt.views import TokenObtainPairView
-
-from users.models import (CustomUser, BannedFromSignUp, PhoneNumberValidation, UserSignUpTry,
-                          BannedFromSignIn, UserSignInTry)
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+from rest_framework_simplejwt.serializers import TokenObtainSerializer, TokenObtainPairSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+
+from users.challenges import confirm_challenge, issue_challenge
+from users.hashing import HashingUnavailable, authenticate
+from users.imports import FORMATS, ImportReport, UserImporter, read_rows
+from users.instrumentation import recorder, stage
+from users.models import (CustomUser, BannedFromSignUp, PhoneNumberValidation, BannedFromSignIn,
+                          UserSignInTry)
+from users.rollups import time_series, top_offenders
 from users.serializers import (UserPhoneNumberSerializer, PhoneNumberValidationSerializer,
-                               UserRegisterSerializer, UserSignInSerializer)
-from users.utils import get_user_ip, send_registration_code
-__all__ = ["UserExistView", "SignInView", "SendSMSForRegistrationView", "RegistrationConfirmSMSView", "UserRegisterView"]
+                               UserRegisterSerializer, UserSignInSerializer, RotatingTokenRefreshSerializer,
+                               LogoutSerializer, SuspiciousActivitySerializer)
+from users.sms import SMSQueueFull
+from users.tokens import get_token_denylist
+from users.utils import get_user_ip, send_registration_code, user_exists
+
+from samplino.settings import INSTRUMENTATION_METRICS_IPS, REGISTRATION_CHALLENGE_ENABLED
+__all__ = ["UserExistView", "SignInView", "SendSMSForRegistrationView", "RegistrationConfirmSMSView", "UserRegisterView",
+           "RotatingTokenRefreshView", "LogoutView", "UserImportView",
+           "SuspiciousActivityView", "metrics_view"]
 
 
 class UserExistView(APIView):
@@ -22,7 +48,7 @@ class UserExistView(APIView):
         """
         serializer = UserPhoneNumberSerializer(data=request.POST)
         serializer.is_valid(raise_exception=True)
-        user_exist = CustomUser.objects.filter(phone_number=serializer.data["phone_number"]).exists()
+        user_exist = user_exists(serializer.data["phone_number"])
         return Response(data={"exist": user_exist}, status=status.HTTP_200_OK)
 
 
@@ -42,11 +68,19 @@ class SendSMSForRegistrationView(APIView):
                                   "errors": ["user is restricted"]},
                             status=status.HTTP_403_FORBIDDEN)
 
-        if CustomUser.objects.filter(phone_number=phone_number).exists():
+        if user_exists(phone_number):
             return Response(data={"success": False,
                                   "errors": ["user already registered"]},
                             status=status.HTTP_409_CONFLICT)
-        sms_code = send_registration_code(phone_number=phone_number)
+        try:
+            sms_code = send_registration_code(phone_number=phone_number)
+        except SMSQueueFull:
+            return Response(data={"success": False,
+                                  "errors": ["sms service is busy, try again later"]},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if REGISTRATION_CHALLENGE_ENABLED:
+            challenge = issue_challenge(phone_number=phone_number, user_ip=user_ip, sms_code=sms_code)
+            return Response(data={"success": True, "errors": None, "challenge": challenge}, status=status.HTTP_200_OK)
         PhoneNumberValidation.add_new_validation_code(phone_number=phone_number, user_ip=user_ip, sms_code=sms_code)
         return Response(data={"success": True, "errors": None}, status=status.HTTP_200_OK)
 
@@ -65,15 +99,13 @@ class RegistrationConfirmSMSView(APIView):
             return Response(data={"success": False,
                                   "errors": ["user is restricted"]},
                             status=status.HTTP_403_FORBIDDEN)
-        validation = PhoneNumberValidation.objects.filter(phone_number=phone_number, last_sent_sms_code=code,
-                                                          is_validated=False)
-        if validation.exists():  # we normally should have considered using sms sent time too, but it was not requested
-            validation = validation.get()
-            register_id = validation.create_user_pre_register()
-            UserSignUpTry.add_try(phone_number=phone_number, user_ip=user_ip, is_success=True)
+        if REGISTRATION_CHALLENGE_ENABLED:
+            register_id = confirm_challenge(challenge=serializer.data.get("challenge"), phone_number=phone_number,
+                                            code=code, user_ip=user_ip)
+        else:
+            register_id = PhoneNumberValidation.confirm_code(phone_number=phone_number, code=code, user_ip=user_ip)
+        if register_id is not None:
             return Response({"success": True, "errors": None, "registerId": register_id})
-
-        UserSignUpTry.add_try(phone_number=phone_number, user_ip=user_ip)
         return Response(data={"success": False, "errors": ["combination is wrong!"], "registerId": None})
 
 
@@ -87,7 +119,7 @@ class SignInView(TokenObtainPairView):
     """ will take user credentials and return a JWT token, it also has a limiter to stop abusers """
 
     def post(self, request, *args, **kwargs):
-        """ inherit from parent class and also add a limiter """
+        """ like parent class but with a limiter, and password hashing in the hashing executor """
         serializer = UserSignInSerializer(data=request.POST)
         serializer.is_valid(raise_exception=True)
         user_ip = get_user_ip(request)
@@ -95,9 +127,93 @@ class SignInView(TokenObtainPairView):
         if BannedFromSignIn.is_banned(phone_number=phone_number, user_ip=user_ip):
             return Response(status=status.HTTP_429_TOO_MANY_REQUESTS)
         try:
-            response = super().post(request, *args, **kwargs)
+            user = authenticate(phone_number=phone_number, password=serializer.data["password"])
+        except HashingUnavailable:
+            # not the user's fault, no try is counted
+            return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             UserSignInTry.add_try(phone_number=phone_number, user_ip=user_ip)
             raise e
-        return response
+        if user is None:
+            UserSignInTry.add_try(phone_number=phone_number, user_ip=user_ip)
+            raise no_active_account()
+        return Response(get_token_pair(user), status=status.HTTP_200_OK)
+
+
+class RotatingTokenRefreshView(TokenRefreshView):
+    """ will take a refresh token once and return an access token and a new refresh token """
+    serializer_class = RotatingTokenRefreshSerializer
+
+
+class LogoutView(APIView):
+    """ will revoke a refresh token, and the access token of the request if it is authenticated """
 
+    def post(self, request):
+        serializer = LogoutSerializer(data=request.data)
+        try:
+            serializer.is_valid(raise_exception=True)
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+        if request.auth is not None:
+            get_token_denylist().deny(request.auth[api_settings.JTI_CLAIM], request.auth["exp"])
+        return Response(status=status.HTTP_205_RESET_CONTENT)
+
+
+class UserImportView(APIView):
+    """ will import users of an uploaded csv or jsonl file ("file"), for staff only, like `manage.py import_users` """
+    permission_classes = (IsAdminUser,)
+    parser_classes = (MultiPartParser,)
+
+    def post(self, request):
+        upload = request.FILES.get("file")
+        if upload is None:
+            return Response({"file": ["a csv or jsonl file is required"]}, status=status.HTTP_400_BAD_REQUEST)
+        format = request.data.get("format") or os.path.splitext(upload.name)[1].lstrip(".").lower()
+        if format not in FORMATS:
+            return Response({"format": [f"must be one of {', '.join(FORMATS)}"]}, status=status.HTTP_400_BAD_REQUEST)
+        report = ImportReport()
+        try:
+            # streamed line by line, chunks before a decoding error stay imported and are reported
+            UserImporter().run(read_rows(codecs.iterdecode(upload, "utf-8-sig"), format), report)
+        except UnicodeDecodeError:
+            return Response({"file": ["is not utf-8"], **dataclasses.asdict(report)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(dataclasses.asdict(report), status=status.HTTP_200_OK)
+
+
+class SuspiciousActivityView(APIView):
+    """ will answer top offenders and hourly totals of tries and bans, from TryRollup only, for staff only """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        serializer = SuspiciousActivitySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        query = serializer.validated_data
+        # from the start of the first hour, its bucket is included as a whole
+        since = (timezone.now() - datetime.timedelta(hours=query["hours"])).replace(minute=0, second=0, microsecond=0)
+        series_of = (query["kind"], query["key"]) if "key" in query else ()
+        return Response({"since": since,
+                         "top": top_offenders(query["scope"], query["kind"], since, query["limit"]),
+                         "series": time_series(query["scope"], since, *series_of)})
+
+
+def no_active_account() -> AuthenticationFailed:
+    """ will return the error TokenObtainSerializer raises for wrong credentials, answered with its "code" """
+    return AuthenticationFailed(TokenObtainSerializer.default_error_messages["no_active_account"], "no_active_account")
+
+
+def get_token_pair(user) -> dict:
+    """ will return refresh and access tokens of user, as TokenObtainPairSerializer does """
+    with stage("token"):
+        refresh = TokenObtainPairSerializer.get_token(user)
+        tokens = {"refresh": str(refresh), "access": str(refresh.access_token)}
+    if api_settings.UPDATE_LAST_LOGIN:
+        update_last_login(None, user)
+    return tokens
+
+
+def metrics_view(request):
+    """ will return recorded stage timings in prometheus text format, only to INSTRUMENTATION_METRICS_IPS """
+    if request.META.get("REMOTE_ADDR") not in INSTRUMENTATION_METRICS_IPS:
+        raise Http404()
+    return HttpResponse(recorder.export(), content_type="text/plain; version=0.0.4; charset=utf-8")